@@ -0,0 +1,127 @@
+# Copyright 2023 Nordeck IT + Consulting GmbH
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+"""Benchmarks for the hot paths of the module. They build on the mocked
+`ModuleApi` and the in-memory `SQLiteStore` of the tests, and replace the
+mocked homeserver calls with plain functions that can be slowed down to
+simulate a real homeserver.
+
+Run them with `python -m benchmarks`.
+"""
+
+import math
+from typing import Any, Callable, Coroutine, Dict, List, Optional, Tuple, TypeVar
+from unittest.mock import Mock
+
+from twisted.internet import reactor, task
+
+from synapse_guest_module import GuestModule
+from tests import SQLiteStore, create_module
+
+RV = TypeVar("RV")
+
+
+async def sleep_ms(delay_ms: float) -> None:
+    """Wait on the reactor, or return right away for a delay of `0`."""
+    if delay_ms > 0:
+        await task.deferLater(reactor, delay_ms / 1000, lambda: None)
+
+
+def create_benchmark_module(
+    config: Optional[Dict[str, Any]] = None,
+    api_latency_ms: float = 0,
+    db_latency_ms: float = 0,
+) -> Tuple[GuestModule, Mock, SQLiteStore]:
+    """Create a module like `create_module`, but every homeserver call takes
+    `api_latency_ms` and every database transaction takes `db_latency_ms`.
+
+    The mocked functions that are used in hot paths are replaced with plain
+    functions, so the mocks don't record millions of calls.
+    """
+    module, module_api, store = create_module(config)
+
+    async def run_db_interaction(
+        desc: str, f: Callable[..., RV], *args: Any, **kwargs: Any
+    ) -> RV:
+        await sleep_ms(db_latency_ms)
+        return await store.run_db_interaction(desc, f, *args, **kwargs)
+
+    async def check_user_exists(user_id: str) -> Optional[str]:
+        await sleep_ms(api_latency_ms)
+        return None
+
+    async def register_user(localpart: str, displayname: Optional[str] = None) -> str:
+        await sleep_ms(api_latency_ms)
+        return f"@{localpart}:matrix.local"
+
+    async def register_device(user_id: str) -> Tuple[str, str, None, None]:
+        await sleep_ms(api_latency_ms)
+        return "DEVICEID", "syn_registered_token", None, None
+
+    async def set_displayname(user_id: Any, displayname: str) -> None:
+        await sleep_ms(api_latency_ms)
+
+    async def deactivate_account(user_id: str, **kwargs: Any) -> bool:
+        await sleep_ms(api_latency_ms)
+        return True
+
+    def invalidate_cache_and_stream_bulk(txn: Any, cache: Any, keys: Any) -> None:
+        pass
+
+    module_api.run_db_interaction = run_db_interaction
+    module_api.check_user_exists = check_user_exists
+    module_api.register_user = register_user
+    module_api.register_device = register_device
+    module_api.set_displayname = set_displayname
+    module_api._hs.get_deactivate_account_handler().deactivate_account = (
+        deactivate_account
+    )
+    module_api._hs.get_datastores().main._invalidate_cache_and_stream_bulk = (
+        invalidate_cache_and_stream_bulk
+    )
+
+    return module, module_api, store
+
+
+def run_sync(coroutine: Coroutine[Any, Any, RV]) -> RV:
+    """Run a coroutine that doesn't wait for the reactor, without the overhead
+    of a `Deferred`.
+    """
+    try:
+        coroutine.send(None)
+    except StopIteration as e:
+        return e.value  # type: ignore[no-any-return]
+
+    coroutine.close()
+    raise RuntimeError("The coroutine did not complete synchronously")
+
+
+def summarize_latencies(samples: List[float]) -> Dict[str, float]:
+    """Return the percentiles of latency `samples` (in seconds) in ms."""
+    ordered = sorted(samples)
+    if len(ordered) == 0:
+        return {}
+
+    def percentile(p: float) -> float:
+        index = max(0, math.ceil(p / 100 * len(ordered)) - 1)
+        return round(ordered[index] * 1000, 3)
+
+    return {
+        "p50_ms": percentile(50),
+        "p90_ms": percentile(90),
+        "p95_ms": percentile(95),
+        "p99_ms": percentile(99),
+        "max_ms": percentile(100),
+    }
@@ -0,0 +1,164 @@
+# Copyright 2023 Nordeck IT + Consulting GmbH
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import argparse
+import json
+import logging
+import platform
+import sys
+import time
+from importlib.metadata import PackageNotFoundError, version
+from typing import Any, Dict, List, Optional
+
+from twisted.internet import defer, task
+
+from benchmarks.callbacks import benchmark_callbacks
+from benchmarks.reaper import benchmark_reaper
+from benchmarks.registration import benchmark_registration
+
+logger = logging.getLogger("benchmarks")
+
+SUITES = ["registration", "callbacks", "reaper"]
+
+
+def parse_list(value: str) -> List[float]:
+    return [float(item) for item in value.split(",") if item.strip() != ""]
+
+
+def get_module_version() -> Optional[str]:
+    try:
+        return version("synapse_guest_module")
+    except PackageNotFoundError:
+        return None
+
+
+async def run_benchmarks(args: argparse.Namespace) -> Dict[str, Any]:
+    """Run the selected benchmarks and return the results together with the
+    parameters, so results of different releases can be compared.
+    """
+    results: Dict[str, Any] = {
+        "module_version": get_module_version(),
+        "python_version": platform.python_version(),
+        "timestamp": int(time.time()),
+        "parameters": {
+            "api_latency_ms": args.api_latency_ms,
+            "db_latency_ms": args.db_latency_ms,
+        },
+    }
+
+    if "registration" in args.suites:
+        logger.info("Benchmark the guest registration")
+        results["registration"] = await benchmark_registration(
+            [int(level) for level in args.concurrency],
+            args.requests,
+            args.api_latency_ms,
+            args.db_latency_ms,
+        )
+
+    if "callbacks" in args.suites:
+        logger.info("Benchmark the callbacks")
+        results["callbacks"] = benchmark_callbacks(args.iterations)
+
+    if "reaper" in args.suites:
+        logger.info("Benchmark the user reaper")
+        results["reaper"] = await benchmark_reaper(
+            [int(size) for size in args.sizes],
+            args.guest_shares,
+            args.api_latency_ms,
+            args.db_latency_ms,
+        )
+
+    return results
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(
+        prog="python -m benchmarks",
+        description="Run the benchmarks of the guest module and print the results as JSON.",
+    )
+    parser.add_argument(
+        "suites",
+        nargs="*",
+        help=f"the benchmarks to run ({', '.join(SUITES)}), all by default",
+    )
+    parser.add_argument(
+        "--output", help="write the results to this file instead of stdout"
+    )
+    parser.add_argument(
+        "--api-latency-ms",
+        type=float,
+        default=0,
+        help="the time that each call of the homeserver takes",
+    )
+    parser.add_argument(
+        "--db-latency-ms",
+        type=float,
+        default=0,
+        help="the time that each database transaction takes",
+    )
+    parser.add_argument(
+        "--concurrency",
+        type=parse_list,
+        default=[1, 10, 50, 100],
+        help="comma separated numbers of concurrent clients of the registration benchmark",
+    )
+    parser.add_argument(
+        "--requests",
+        type=int,
+        default=1000,
+        help="the registrations per concurrency level",
+    )
+    parser.add_argument(
+        "--iterations",
+        type=int,
+        default=100000,
+        help="the calls per callback",
+    )
+    parser.add_argument(
+        "--sizes",
+        type=parse_list,
+        default=[10000, 100000, 1000000],
+        help="comma separated numbers of users of the reaper benchmark",
+    )
+    parser.add_argument(
+        "--guest-shares",
+        type=parse_list,
+        default=[0.1, 0.5, 0.9],
+        help="comma separated shares of guest users of the reaper benchmark",
+    )
+    args = parser.parse_args()
+
+    for suite in args.suites:
+        if suite not in SUITES:
+            parser.error(f"unknown benchmark '{suite}'")
+    if len(args.suites) == 0:
+        args.suites = SUITES
+
+    logging.basicConfig(stream=sys.stderr, level=logging.INFO)
+
+    async def run() -> None:
+        results = await run_benchmarks(args)
+
+        if args.output is None:
+            json.dump(results, sys.stdout, indent=2)
+            sys.stdout.write("\n")
+        else:
+            with open(args.output, "w") as f:
+                json.dump(results, f, indent=2)
+
+    task.react(lambda _: defer.ensureDeferred(run()))
+
+
+if __name__ == "__main__":
+    main()
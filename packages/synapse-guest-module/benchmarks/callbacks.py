@@ -0,0 +1,98 @@
+# Copyright 2023 Nordeck IT + Consulting GmbH
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+import time
+from typing import Any, Callable, Coroutine, Dict, List
+
+from synapse.module_api import ProfileInfo, UserProfile
+
+from benchmarks import create_benchmark_module, run_sync
+from tests import make_awaitable
+
+GUEST = "@guest-asdf:matrix.local"
+USER = "@user:matrix.local"
+ROOM = "!room:matrix.local"
+
+
+def benchmark_callbacks(iterations: int) -> List[Dict[str, Any]]:
+    """Measure the time of a single call of each callback, for guest users and
+    other users. The join check is measured with a warm join rule cache and
+    without a cache, so every call reads the state of the room.
+    """
+    module, module_api, _ = create_benchmark_module({"join_rule_cache_size": 10000})
+    uncached_module, uncached_module_api, _ = create_benchmark_module()
+
+    join_rules = [{"content": {"join_rule": "knock"}}]
+    module_api.get_state_events_in_room.return_value = make_awaitable(join_rules)
+    uncached_module_api.get_state_events_in_room.return_value = make_awaitable(
+        join_rules
+    )
+
+    # the guest already has the suffix, so the profile is not changed
+    guest_profile = ProfileInfo(avatar_url=None, display_name="Name (Guest)")
+
+    cases: Dict[str, Callable[[], Coroutine[Any, Any, Any]]] = {
+        "user_may_create_room/guest": lambda: module.callback_user_may_create_room(
+            GUEST
+        ),
+        "user_may_create_room/user": lambda: module.callback_user_may_create_room(USER),
+        "user_may_invite/guest": lambda: module.callback_user_may_invite(
+            GUEST, USER, ROOM
+        ),
+        "user_may_invite/user": lambda: module.callback_user_may_invite(
+            USER, GUEST, ROOM
+        ),
+        "user_may_join_room/guest_cached": lambda: module.callback_user_may_join_room(
+            GUEST, ROOM, False
+        ),
+        "user_may_join_room/guest_uncached": lambda: uncached_module.callback_user_may_join_room(
+            GUEST, ROOM, False
+        ),
+        "user_may_join_room/user": lambda: module.callback_user_may_join_room(
+            USER, ROOM, False
+        ),
+        "check_username_for_spam/guest": lambda: module.callback_check_username_for_spam(
+            UserProfile(user_id=GUEST, display_name=None, avatar_url=None)
+        ),
+        "check_username_for_spam/user": lambda: module.callback_check_username_for_spam(
+            UserProfile(user_id=USER, display_name=None, avatar_url=None)
+        ),
+        "profile_update/guest": lambda: module.profile_update(
+            GUEST, guest_profile, False, False
+        ),
+        "profile_update/user": lambda: module.profile_update(
+            USER, guest_profile, False, False
+        ),
+    }
+
+    results = []
+    for name, call in cases.items():
+        # warm up, e.g. the join rule cache
+        run_sync(call())
+
+        start = time.perf_counter_ns()
+        for _ in range(iterations):
+            run_sync(call())
+        duration = time.perf_counter_ns() - start
+
+        results.append(
+            {
+                "callback": name,
+                "iterations": iterations,
+                "ns_per_call": round(duration / iterations, 1),
+            }
+        )
+
+    return results
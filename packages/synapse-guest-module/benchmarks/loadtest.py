@@ -0,0 +1,353 @@
+# Copyright 2023 Nordeck IT + Consulting GmbH
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+"""A load test of the `POST /_synapse/client/register_guest` endpoint.
+
+Clients send registrations either in a closed loop, where each of
+`--concurrency` clients sends its next request as soon as it received a
+response, or in an open loop, where requests arrive at `--rate` per second
+regardless of the response times. The open loop shows how the endpoint
+behaves when it can't keep up, e.g. how many requests are shed.
+
+Without `--url`, the test starts a stand-in homeserver that serves the
+registration servlet of the module with the mocked `ModuleApi` of the
+benchmarks.
+
+Run it with `python -m benchmarks.loadtest`.
+"""
+
+import argparse
+import io
+import json
+import logging
+import random
+import sys
+import time
+from typing import Any, Dict, List
+
+from twisted.internet import defer
+from twisted.internet import reactor as _reactor
+from twisted.internet import task
+from twisted.internet.interfaces import IListeningPort
+from twisted.web.client import Agent, FileBodyProducer, HTTPConnectionPool, readBody
+from twisted.web.http_headers import Headers
+from twisted.web.resource import NoResource, Resource
+from twisted.web.server import NOT_DONE_YET, Request, Site
+
+from benchmarks import create_benchmark_module, sleep_ms, summarize_latencies
+from synapse_guest_module.guest_registration_servlet import GuestRegistrationServlet
+
+logger = logging.getLogger("benchmarks.loadtest")
+
+# the reactor module doesn't declare the interfaces that the reactor provides
+reactor: Any = _reactor
+
+REGISTRATION_PATH = b"/_synapse/client/register_guest"
+
+
+class RegistrationResource(Resource):
+    """Serves the registration servlet at the path of the module over plain
+    HTTP. The servlet expects the requests of a Synapse homeserver, so only its
+    handler is called and the response is written here.
+    """
+
+    isLeaf = True
+
+    def __init__(self, servlet: GuestRegistrationServlet):
+        super().__init__()
+        self._servlet = servlet
+
+    def render_POST(self, request: Request) -> Any:
+        if request.path != REGISTRATION_PATH:
+            return NoResource().render(request)
+
+        defer.ensureDeferred(self._render(request))
+        return NOT_DONE_YET
+
+    async def _render(self, request: Request) -> None:
+        try:
+            status, body = await self._servlet._async_render_POST(request)
+        except Exception as e:
+            logger.error("Failed to register a guest user: %s", e)
+            status, body = 500, {"msg": "Internal server error"}
+
+        data = json.dumps(body).encode()
+        request.setResponseCode(status)
+        request.responseHeaders.setRawHeaders(b"Content-Type", [b"application/json"])
+        request.responseHeaders.setRawHeaders(
+            b"Content-Length", [str(len(data)).encode()]
+        )
+        request.write(data)
+        request.finish()
+
+
+def start_stand_in_homeserver(
+    config: Dict[str, Any], api_latency_ms: float, db_latency_ms: float
+) -> IListeningPort:
+    """Listen on a free local port and serve the registration endpoint of a
+    module with the given `config`.
+    """
+    module, _, _ = create_benchmark_module(
+        config, api_latency_ms=api_latency_ms, db_latency_ms=db_latency_ms
+    )
+
+    site = Site(RegistrationResource(module.registration_servlet))
+
+    return reactor.listenTCP(0, site, interface="127.0.0.1")  # type: ignore[no-any-return]
+
+
+class LoadTestClient:
+    """Sends registrations to `url` and records the status and the latency of
+    every response. Requests that fail without a response are recorded as
+    `connection_error` or `timeout`.
+    """
+
+    def __init__(
+        self,
+        url: str,
+        max_connections: int,
+        timeout_seconds: float,
+        invalid_share: float,
+    ):
+        self._url = url.encode()
+        self._timeout_seconds = timeout_seconds
+        self._invalid_share = invalid_share
+
+        self._pool = HTTPConnectionPool(reactor, persistent=True)
+        self._pool.maxPersistentPerHost = max_connections
+        self._agent = Agent(reactor, pool=self._pool)
+
+        self.latencies: List[float] = []
+        self.statuses: Dict[str, int] = {}
+
+    async def send(self) -> None:
+        """Send a single registration and wait for the response."""
+        if random.random() < self._invalid_share:
+            body = b'{"displayname":""}'
+        else:
+            body = b'{"displayname":"Load Test"}'
+
+        start = time.perf_counter()
+        try:
+            d = self._agent.request(
+                b"POST",
+                self._url,
+                Headers({b"Content-Type": [b"application/json"]}),
+                FileBodyProducer(io.BytesIO(body)),  # type: ignore[arg-type]
+            )
+            d.addTimeout(self._timeout_seconds, reactor)
+            response = await d
+            await readBody(response)
+            outcome = str(response.code)
+        except defer.TimeoutError:
+            outcome = "timeout"
+        except Exception as e:
+            logger.debug("Request failed: %s", e)
+            outcome = "connection_error"
+
+        self.latencies.append(time.perf_counter() - start)
+        self.statuses[outcome] = self.statuses.get(outcome, 0) + 1
+
+    async def close(self) -> None:
+        await self._pool.closeCachedConnections()
+
+
+async def run_closed_loop(
+    client: LoadTestClient, concurrency: int, duration_seconds: float
+) -> None:
+    """Let `concurrency` clients send requests back to back."""
+    deadline = time.monotonic() + duration_seconds
+
+    async def worker() -> None:
+        while time.monotonic() < deadline:
+            await client.send()
+
+    await defer.gatherResults(
+        [defer.ensureDeferred(worker()) for _ in range(concurrency)],
+        consumeErrors=True,
+    )
+
+
+async def run_open_loop(
+    client: LoadTestClient, rate: float, duration_seconds: float
+) -> None:
+    """Send requests that arrive at `rate` per second on average, with
+    exponentially distributed gaps, no matter whether earlier requests are
+    still running.
+    """
+    start = time.monotonic()
+    next_arrival = start
+    in_flight: List["defer.Deferred[None]"] = []
+
+    while next_arrival < start + duration_seconds:
+        await sleep_ms((next_arrival - time.monotonic()) * 1000)
+        in_flight.append(defer.ensureDeferred(client.send()))
+        next_arrival += random.expovariate(rate)
+
+    await defer.gatherResults(in_flight, consumeErrors=True)
+
+
+def summarize(
+    client: LoadTestClient, duration_seconds: float, parameters: Dict[str, Any]
+) -> Dict[str, Any]:
+    """Return the throughput, the latency percentiles and the error rate. All
+    responses that are not `2xx` count as errors, including rejected
+    requests.
+    """
+    requests = len(client.latencies)
+    succeeded = sum(
+        count for status, count in client.statuses.items() if status.startswith("2")
+    )
+
+    return {
+        "parameters": parameters,
+        "duration_seconds": round(duration_seconds, 3),
+        "requests": requests,
+        "statuses": dict(sorted(client.statuses.items())),
+        "throughput_per_second": round(requests / duration_seconds, 1),
+        "success_per_second": round(succeeded / duration_seconds, 1),
+        "error_rate": round((requests - succeeded) / requests, 4) if requests else 0,
+        **summarize_latencies(client.latencies),
+    }
+
+
+async def run_load_test(args: argparse.Namespace) -> Dict[str, Any]:
+    # the interfaces of twisted are not understood by mypy
+    port: Any = None
+    url = args.url
+    if url is None:
+        port = start_stand_in_homeserver(
+            args.config, args.api_latency_ms, args.db_latency_ms
+        )
+        url = f"http://127.0.0.1:{port.getHost().port}{REGISTRATION_PATH.decode()}"
+
+    client = LoadTestClient(
+        url,
+        args.concurrency if args.rate is None else args.max_connections,
+        args.timeout,
+        args.invalid_share,
+    )
+
+    logger.info("Send registrations to %s for %s seconds", url, args.duration)
+
+    start = time.perf_counter()
+    try:
+        if args.rate is None:
+            await run_closed_loop(client, args.concurrency, args.duration)
+        else:
+            await run_open_loop(client, args.rate, args.duration)
+    finally:
+        duration = time.perf_counter() - start
+        await client.close()
+        if port is not None:
+            await port.stopListening()
+
+    return summarize(
+        client, duration, {k: v for k, v in vars(args).items() if k != "output"}
+    )
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(
+        prog="python -m benchmarks.loadtest",
+        description="Load test the guest registration and print the results as JSON.",
+    )
+    parser.add_argument(
+        "--url",
+        help="the registration endpoint of a running homeserver, a stand-in homeserver is started by default",
+    )
+    parser.add_argument(
+        "--concurrency",
+        type=int,
+        default=10,
+        help="the number of clients that send requests back to back",
+    )
+    parser.add_argument(
+        "--rate",
+        type=float,
+        help="send requests at this rate per second instead of a fixed number of clients",
+    )
+    parser.add_argument(
+        "--max-connections",
+        type=int,
+        default=100,
+        help="the number of connections that are kept open with --rate",
+    )
+    parser.add_argument(
+        "--duration",
+        type=float,
+        default=30,
+        help="the time in seconds in which new requests are sent",
+    )
+    parser.add_argument(
+        "--timeout",
+        type=float,
+        default=10,
+        help="the time in seconds after which a request is given up",
+    )
+    parser.add_argument(
+        "--invalid-share",
+        type=float,
+        default=0,
+        help="the share of requests without a display name, which are rejected with 400",
+    )
+    parser.add_argument(
+        "--api-latency-ms",
+        type=float,
+        default=0,
+        help="the time that each call of the stand-in homeserver takes",
+    )
+    parser.add_argument(
+        "--db-latency-ms",
+        type=float,
+        default=0,
+        help="the time that each database transaction of the stand-in homeserver takes",
+    )
+    parser.add_argument(
+        "--config",
+        default="{}",
+        help="the module configuration of the stand-in homeserver as JSON",
+    )
+    parser.add_argument(
+        "--output", help="write the results to this file instead of stdout"
+    )
+    args = parser.parse_args()
+
+    if args.concurrency < 1:
+        parser.error("--concurrency must be at least 1")
+    if args.rate is not None and args.rate <= 0:
+        parser.error("--rate must be positive")
+    try:
+        args.config = json.loads(args.config)
+    except ValueError:
+        parser.error("--config must be a JSON object")
+
+    logging.basicConfig(stream=sys.stderr, level=logging.INFO)
+
+    async def run() -> None:
+        results = await run_load_test(args)
+
+        if args.output is None:
+            json.dump(results, sys.stdout, indent=2)
+            sys.stdout.write("\n")
+        else:
+            with open(args.output, "w") as f:
+                json.dump(results, f, indent=2)
+
+    task.react(lambda _: defer.ensureDeferred(run()))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,94 @@
+# Copyright 2023 Nordeck IT + Consulting GmbH
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+import time
+import tracemalloc
+from typing import Any, Dict, Iterator, List, Tuple
+
+from benchmarks import create_benchmark_module
+
+
+def _seed_users(total: int, guest_share: float) -> Iterator[Tuple[str, int, int]]:
+    """Generate rows of the `users` table. The guest users are spread evenly
+    and all of them are expired.
+    """
+    for i in range(total):
+        if int((i + 1) * guest_share) > int(i * guest_share):
+            yield f"@guest-{i:08d}:matrix.local", 0, i
+        else:
+            yield f"@user-{i:08d}:matrix.local", 0, i
+
+
+async def benchmark_reaper(
+    sizes: List[int],
+    guest_shares: List[float],
+    api_latency_ms: float,
+    db_latency_ms: float,
+) -> List[Dict[str, Any]]:
+    """Measure the time and the peak memory of a reaper cycle that deactivates
+    all expired guest users, for homeservers with `sizes` users of which
+    `guest_shares` are guests.
+    """
+    results = []
+
+    for size in sizes:
+        for guest_share in guest_shares:
+            module, _, store = create_benchmark_module(
+                api_latency_ms=api_latency_ms, db_latency_ms=db_latency_ms
+            )
+            store.conn.executemany(
+                "INSERT INTO users (name, deactivated, creation_ts) VALUES (?, ?, ?)",
+                _seed_users(size, guest_share),
+            )
+            store.conn.commit()
+
+            # the registry is filled from the users table on the first use
+            start = time.perf_counter()
+            await module.registry.setup()
+            backfill_seconds = time.perf_counter() - start
+
+            start = time.perf_counter()
+            await module.reaper.run_cycle()
+            cycle_seconds = time.perf_counter() - start
+
+            (deactivated,) = store.conn.execute(
+                "SELECT COUNT(*) FROM guest_module_guests WHERE state = 'deactivated'"
+            ).fetchone()
+
+            # reactivate the guests and measure the memory in a second cycle,
+            # tracemalloc slows down the cycle a lot
+            store.conn.execute("UPDATE guest_module_guests SET state = 'active'")
+            store.conn.commit()
+
+            tracemalloc.start()
+            try:
+                await module.reaper.run_cycle()
+                _, peak_memory = tracemalloc.get_traced_memory()
+            finally:
+                tracemalloc.stop()
+
+            results.append(
+                {
+                    "users": size,
+                    "guest_share": guest_share,
+                    "deactivated": deactivated,
+                    "backfill_seconds": round(backfill_seconds, 3),
+                    "cycle_seconds": round(cycle_seconds, 3),
+                    "deactivations_per_second": round(deactivated / cycle_seconds, 1),
+                    "peak_memory_bytes": peak_memory,
+                }
+            )
+
+    return results
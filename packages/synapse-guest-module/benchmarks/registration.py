@@ -0,0 +1,80 @@
+# Copyright 2023 Nordeck IT + Consulting GmbH
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+import io
+import time
+from typing import Any, Dict, List, cast
+
+from twisted.internet import defer
+from twisted.web.server import Request
+from twisted.web.test.requesthelper import DummyRequest
+
+from benchmarks import create_benchmark_module, summarize_latencies
+
+
+async def benchmark_registration(
+    concurrency_levels: List[int],
+    requests: int,
+    api_latency_ms: float,
+    db_latency_ms: float,
+) -> List[Dict[str, Any]]:
+    """Measure the throughput and the latency of guest registrations with
+    `concurrency_levels` clients that send `requests` registrations in total.
+    """
+    results = []
+
+    for registration_mode in ("check_first", "optimistic"):
+        for concurrency in concurrency_levels:
+            module, _, _ = create_benchmark_module(
+                {"registration_mode": registration_mode},
+                api_latency_ms=api_latency_ms,
+                db_latency_ms=db_latency_ms,
+            )
+            servlet = module.registration_servlet
+
+            latencies: List[float] = []
+            statuses: Dict[int, int] = {}
+
+            async def client(count: int) -> None:
+                for _ in range(count):
+                    request = cast(Request, DummyRequest([]))
+                    request.content = io.BytesIO(b'{"displayname":"Benchmark"}')
+
+                    start = time.perf_counter()
+                    status, _ = await servlet._async_render_POST(request)
+                    latencies.append(time.perf_counter() - start)
+                    statuses[status] = statuses.get(status, 0) + 1
+
+            per_client = max(1, requests // concurrency)
+
+            start = time.perf_counter()
+            await defer.gatherResults(
+                [defer.ensureDeferred(client(per_client)) for _ in range(concurrency)],
+                consumeErrors=True,
+            )
+            duration = time.perf_counter() - start
+
+            results.append(
+                {
+                    "registration_mode": registration_mode,
+                    "concurrency": concurrency,
+                    "requests": len(latencies),
+                    "statuses": {str(k): v for k, v in sorted(statuses.items())},
+                    "throughput_per_second": round(len(latencies) / duration, 1),
+                    **summarize_latencies(latencies),
+                }
+            )
+
+    return results
@@ -0,0 +1,116 @@
+# Copyright 2023 Nordeck IT + Consulting GmbH
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import time
+from collections import OrderedDict, deque
+from typing import Deque, Tuple
+
+from synapse.logging.context import make_deferred_yieldable
+from twisted.internet import defer
+
+
+class AdmissionController:
+    """Limits the number of requests that are processed at the same time to
+    `max_in_flight`. Up to `max_queue` additional requests wait for a free
+    slot, all other requests are rejected. A `max_in_flight` of `0` disables
+    the limit.
+    """
+
+    def __init__(self, max_in_flight: int, max_queue: int):
+        self._max_in_flight = max_in_flight
+        self._max_queue = max_queue
+        self._in_flight = 0
+        self._waiting: Deque["defer.Deferred[None]"] = deque()
+
+    @property
+    def in_flight(self) -> int:
+        return self._in_flight
+
+    @property
+    def queued(self) -> int:
+        return len(self._waiting)
+
+    async def acquire(self) -> bool:
+        """Wait for a free slot. Returns `False` if the queue is full and the
+        request should be rejected. Every successful call must be followed by
+        a call to `release`.
+        """
+        if self._max_in_flight <= 0 or self._in_flight < self._max_in_flight:
+            self._in_flight += 1
+            return True
+
+        if len(self._waiting) >= self._max_queue:
+            return False
+
+        waiter: "defer.Deferred[None]" = defer.Deferred(
+            canceller=lambda d: self._waiting.remove(d)
+        )
+        self._waiting.append(waiter)
+
+        # the slot is handed over by `release`
+        await make_deferred_yieldable(waiter)
+        return True
+
+    def release(self) -> None:
+        """Free the slot of a finished request or hand it over to the next
+        waiting request.
+        """
+        if len(self._waiting) > 0:
+            self._waiting.popleft().callback(None)
+        else:
+            self._in_flight -= 1
+
+
+class ClientRateLimiter:
+    """A token bucket rate limiter per client. Each client may make `burst`
+    requests at once, and gets new tokens at `rate_per_second`. The buckets of
+    up to `max_clients` clients are kept, the least recently seen client is
+    forgotten first. A `rate_per_second` of `0` disables the limit.
+    """
+
+    def __init__(self, rate_per_second: float, burst: int, max_clients: int):
+        self._rate_per_second = rate_per_second
+        self._burst = burst
+        self._max_clients = max_clients
+
+        # client -> (tokens, time of the last update)
+        self._buckets: "OrderedDict[str, Tuple[float, float]]" = OrderedDict()
+
+    def __len__(self) -> int:
+        return len(self._buckets)
+
+    def check(self, client: str) -> float:
+        """Take a token for the `client`. Returns `0` if the request is
+        allowed, or the number of seconds until the client may try again.
+        """
+        if self._rate_per_second <= 0:
+            return 0
+
+        now = time.monotonic()
+        tokens, updated_at = self._buckets.pop(client, (float(self._burst), now))
+        tokens = min(
+            float(self._burst), tokens + (now - updated_at) * self._rate_per_second
+        )
+
+        retry_after = 0.0
+        if tokens >= 1:
+            tokens -= 1
+        else:
+            retry_after = (1 - tokens) / self._rate_per_second
+
+        self._buckets[client] = (tokens, now)
+        while len(self._buckets) > self._max_clients:
+            self._buckets.popitem(last=False)
+
+        return retry_after
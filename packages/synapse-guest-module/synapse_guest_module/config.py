@@ -12,6 +12,8 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+from typing import Optional
+
 import attr
 
 
@@ -21,3 +23,40 @@ class GuestModuleConfig:
     display_name_suffix: str
     enable_user_reaper: bool
     user_expiration_seconds: int
+    reaper_max_concurrency: int = 5
+    reaper_deactivation_mode: str = "in_process"
+    reaper_admin_api_url: str = "http://localhost:8008"
+    reaper_batch_size: int = 100
+    join_rule_cache_size: int = 0
+    join_rule_cache_ttl_seconds: int = 300
+    guest_pool_size: int = 0
+    guest_pool_entry_ttl_seconds: int = 3600
+    registration_mode: str = "check_first"
+    registration_max_in_flight: int = 0
+    registration_max_queue: int = 100
+    registration_rate_limit_per_second: float = 0
+    registration_rate_limit_burst: int = 10
+    registration_rate_limit_max_clients: int = 10000
+    reaper_lease_ttl_seconds: int = 60
+    reaper_worker_name: Optional[str] = None
+    reaper_max_attempts: int = 10
+    reaper_retry_interval_seconds: int = 60
+    reaper_lock_expired_users: bool = True
+    reaper_deactivations_per_second: float = 0
+    reaper_room_leave_limit: int = 0
+    reaper_room_leave_window_seconds: int = 60
+    bulk_registration_max_size: int = 1000
+    bulk_registration_max_concurrency: int = 10
+    slow_call_threshold_ms: int = 0
+    guest_access_token_lifetime_seconds: int = 0
+    display_name_enforcement: str = "set_displayname"
+    reaper_media_cleanup: str = "off"
+    reaper_media_per_second: float = 0
+    reaper_purge_after_seconds: int = 0
+    reaper_purge_batch_size: int = 100
+    reaper_purges_per_second: float = 0
+    reaper_purge_dry_run: bool = False
+    registration_idempotency_cache_size: int = 10000
+    registration_idempotency_ttl_seconds: int = 300
+    guest_max_joined_rooms: int = 0
+    guest_pool_worker_name: str = "master"
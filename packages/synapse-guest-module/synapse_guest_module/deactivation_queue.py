@@ -0,0 +1,317 @@
+# Copyright 2023 Nordeck IT + Consulting GmbH
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+import logging
+from typing import List, Optional, Tuple
+
+from synapse.module_api import LoggingTransaction, ModuleApi
+
+from synapse_guest_module.config import GuestModuleConfig
+from synapse_guest_module.guest_registry import GuestRegistry, GuestState
+
+logger = logging.getLogger("synapse.contrib." + __name__)
+
+# The longest time between two attempts to deactivate a guest user
+MAX_RETRY_INTERVAL_MS = 24 * 60 * 60 * 1000
+
+
+class JobState:
+    """The states of a deactivation job."""
+
+    PENDING = "pending"
+    PARKED = "parked"
+
+
+class DeactivationQueue:
+    """Stores the expired guest users that still have to be deactivated in a
+    table that is owned by the module. A failed deactivation is retried with
+    an exponential backoff, starting at `reaper_retry_interval_seconds`. After
+    `reaper_max_attempts` failed attempts, the job is parked and no longer
+    retried, so failing users don't slow down the reaper.
+    """
+
+    def __init__(
+        self,
+        api: ModuleApi,
+        config: GuestModuleConfig,
+        registry: GuestRegistry,
+    ):
+        self._api = api
+        self._config = config
+        self._registry = registry
+
+    def get_retry_interval_ms(self, attempts: int) -> int:
+        """Return the time to wait before the next attempt after `attempts`
+        failed attempts.
+        """
+        interval_ms = self._config.reaper_retry_interval_seconds * 1000
+        return int(min(interval_ms * 2 ** (attempts - 1), MAX_RETRY_INTERVAL_MS))
+
+    async def enqueue(self, user_ids: List[str], now_ts: int) -> None:
+        """Add a deactivation job for each of the expired guest users. The
+        users are marked as expired in the registry, so they are not added
+        again.
+
+        If `reaper_lock_expired_users` is enabled, the users are also locked
+        in the same transaction. The homeserver rejects all requests of a
+        locked user, so the guests lose their access right away, even if
+        their deactivation is only processed much later.
+        """
+        if len(user_ids) == 0:
+            return
+
+        await self._registry.setup()
+
+        store = None
+        if self._config.reaper_lock_expired_users:
+            store = self._api._hs.get_datastores().main
+
+        def enqueue_txn(txn: LoggingTransaction) -> None:
+            placeholders = ", ".join("?" for _ in user_ids)
+
+            # The store only locks a single user at a time and fails if the
+            # user doesn't exist, so the users are locked with a single update
+            # that skips missing users. The caches of the homeserver are
+            # invalidated like in `set_user_locked_status_txn`.
+            if store is not None:
+                txn.execute(
+                    f"UPDATE users SET locked = ? WHERE name IN ({placeholders})",
+                    [True, *user_ids],
+                )
+                keys = [(user_id,) for user_id in user_ids]
+                store._invalidate_cache_and_stream_bulk(
+                    txn, store.get_user_locked_status, keys
+                )
+                store._invalidate_cache_and_stream_bulk(txn, store.get_user_by_id, keys)
+
+            for user_id in user_ids:
+                txn.execute(
+                    """
+                    INSERT INTO guest_module_deactivation_jobs
+                        (user_id, attempts, next_attempt_ts, last_error, state)
+                    VALUES (?, 0, ?, NULL, ?)
+                    ON CONFLICT (user_id) DO NOTHING
+                    """,
+                    (user_id, now_ts, JobState.PENDING),
+                )
+
+            txn.execute(
+                f"UPDATE guest_module_guests SET state = ? WHERE user_id IN ({placeholders})",
+                [GuestState.EXPIRED, *user_ids],
+            )
+
+        await self._api.run_db_interaction(
+            "guest_module_enqueue_deactivations",
+            enqueue_txn,
+        )
+
+    async def get_due_jobs(self, now_ts: int, limit: int) -> List[str]:
+        """Return up to `limit` users whose deactivation is due at `now_ts`,
+        ordered by the time of their next attempt.
+        """
+        await self._registry.setup()
+
+        def get_due_jobs_txn(txn: LoggingTransaction) -> List[str]:
+            txn.execute(
+                """
+                SELECT user_id
+                FROM guest_module_deactivation_jobs
+                WHERE state = ?
+                AND next_attempt_ts <= ?
+                ORDER BY next_attempt_ts, user_id
+                LIMIT ?
+                """,
+                (JobState.PENDING, now_ts, limit),
+            )
+
+            return [row[0] for row in txn.fetchall()]
+
+        return await self._api.run_db_interaction(
+            "guest_module_get_due_deactivations",
+            get_due_jobs_txn,
+        )
+
+    async def complete(self, user_ids: List[str]) -> None:
+        """Remove the jobs of the deactivated users and mark the users as
+        deactivated in the registry.
+        """
+        if len(user_ids) == 0:
+            return
+
+        await self._registry.setup()
+
+        def complete_txn(txn: LoggingTransaction) -> None:
+            placeholders = ", ".join("?" for _ in user_ids)
+            txn.execute(
+                f"DELETE FROM guest_module_deactivation_jobs WHERE user_id IN ({placeholders})",
+                user_ids,
+            )
+            txn.execute(
+                f"UPDATE guest_module_guests SET state = ? WHERE user_id IN ({placeholders})",
+                [GuestState.DEACTIVATED, *user_ids],
+            )
+
+        await self._api.run_db_interaction(
+            "guest_module_complete_deactivations",
+            complete_txn,
+        )
+
+    async def fail(self, failures: List[Tuple[str, str]], now_ts: int) -> None:
+        """Record the failed attempts of the `(user_id, error)` tuples and
+        schedule the next attempts. Jobs that reached the maximum number of
+        attempts are parked, and their users are marked as parked in the
+        registry, so they no longer count towards the backlog.
+        """
+        if len(failures) == 0:
+            return
+
+        await self._registry.setup()
+
+        def fail_txn(txn: LoggingTransaction) -> List[str]:
+            parked = []
+
+            for user_id, error in failures:
+                txn.execute(
+                    "SELECT attempts FROM guest_module_deactivation_jobs WHERE user_id = ?",
+                    (user_id,),
+                )
+                row = txn.fetchone()
+                attempts = (0 if row is None else int(row[0])) + 1
+
+                state = JobState.PENDING
+                if attempts >= self._config.reaper_max_attempts:
+                    state = JobState.PARKED
+                    parked.append(user_id)
+
+                txn.execute(
+                    """
+                    UPDATE guest_module_deactivation_jobs
+                    SET attempts = ?, next_attempt_ts = ?, last_error = ?, state = ?
+                    WHERE user_id = ?
+                    """,
+                    (
+                        attempts,
+                        now_ts + self.get_retry_interval_ms(attempts),
+                        error,
+                        state,
+                        user_id,
+                    ),
+                )
+
+            if len(parked) > 0:
+                placeholders = ", ".join("?" for _ in parked)
+                txn.execute(
+                    f"UPDATE guest_module_guests SET state = ? WHERE user_id IN ({placeholders})",
+                    [GuestState.PARKED, *parked],
+                )
+
+            return parked
+
+        parked = await self._api.run_db_interaction(
+            "guest_module_fail_deactivations",
+            fail_txn,
+        )
+
+        for user_id in parked:
+            logger.warning(
+                'Giving up to deactivate user "%s" after %d attempts',
+                user_id,
+                self._config.reaper_max_attempts,
+            )
+
+    async def postpone(self, jobs: List[Tuple[str, int]]) -> None:
+        """Move the next attempt of the `(user_id, next_attempt_ts)` jobs,
+        without counting an attempt.
+        """
+        if len(jobs) == 0:
+            return
+
+        await self._registry.setup()
+
+        def postpone_txn(txn: LoggingTransaction) -> None:
+            for user_id, next_attempt_ts in jobs:
+                txn.execute(
+                    """
+                    UPDATE guest_module_deactivation_jobs
+                    SET next_attempt_ts = ?
+                    WHERE user_id = ?
+                    """,
+                    (next_attempt_ts, user_id),
+                )
+
+        await self._api.run_db_interaction(
+            "guest_module_postpone_deactivations",
+            postpone_txn,
+        )
+
+    async def count_pending(self) -> int:
+        """Return the number of pending jobs."""
+        await self._registry.setup()
+
+        def count_pending_txn(txn: LoggingTransaction) -> int:
+            txn.execute(
+                "SELECT COUNT(*) FROM guest_module_deactivation_jobs WHERE state = ?",
+                (JobState.PENDING,),
+            )
+            row = txn.fetchone()
+
+            return 0 if row is None else int(row[0])
+
+        return await self._api.run_db_interaction(
+            "guest_module_count_pending_deactivations",
+            count_pending_txn,
+        )
+
+    async def count_parked(self) -> int:
+        """Return the number of parked jobs."""
+        await self._registry.setup()
+
+        def count_parked_txn(txn: LoggingTransaction) -> int:
+            txn.execute(
+                "SELECT COUNT(*) FROM guest_module_deactivation_jobs WHERE state = ?",
+                (JobState.PARKED,),
+            )
+            row = txn.fetchone()
+
+            return 0 if row is None else int(row[0])
+
+        return await self._api.run_db_interaction(
+            "guest_module_count_parked_deactivations",
+            count_parked_txn,
+        )
+
+    async def get_next_attempt(self) -> Optional[int]:
+        """Return the time of the next attempt of a pending job, or `None` if
+        there is no pending job.
+        """
+        await self._registry.setup()
+
+        def get_next_attempt_txn(txn: LoggingTransaction) -> Optional[int]:
+            txn.execute(
+                """
+                SELECT MIN(next_attempt_ts)
+                FROM guest_module_deactivation_jobs
+                WHERE state = ?
+                """,
+                (JobState.PENDING,),
+            )
+            row = txn.fetchone()
+
+            return None if row is None or row[0] is None else int(row[0])
+
+        return await self._api.run_db_interaction(
+            "guest_module_get_next_deactivation_attempt",
+            get_next_attempt_txn,
+        )
@@ -0,0 +1,168 @@
+# Copyright 2023 Nordeck IT + Consulting GmbH
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import logging
+import time
+from collections import deque
+from typing import Awaitable, Callable, Deque, Optional
+
+import attr
+from synapse.module_api import ModuleApi
+
+from synapse_guest_module.config import GuestModuleConfig
+from synapse_guest_module.guest_registry import GuestState
+from synapse_guest_module.guest_tokens import GuestTokenIssuer
+
+logger = logging.getLogger("synapse.contrib." + __name__)
+
+# Pooled accounts are no longer handed out shortly before they expire, so the
+# reaper doesn't deactivate them while they are claimed.
+CLAIM_MARGIN_MS = 60 * 1000
+
+# How often expiring accounts are removed from the pool and the pool is refilled
+MAINTENANCE_INTERVAL_MS = 30 * 1000
+
+
+@attr.s(frozen=True, auto_attribs=True)
+class PooledGuest:
+    user_id: str
+    device_id: str
+    access_token: str
+    expires_ts: int
+    access_token_expires_ts: Optional[int] = None
+    refresh_token: Optional[str] = None
+
+
+class GuestAccountPool:
+    """Keeps up to `guest_pool_size` guest users with a device ready, so a
+    registration only has to claim one of them and set its display name. The
+    pool is refilled in the background after each claim and periodically, so
+    accounts that expire while the pool is idle are replaced. Accounts that
+    are not claimed within `guest_pool_entry_ttl_seconds` expire and are
+    deactivated by the reaper.
+    """
+
+    def __init__(
+        self,
+        config: GuestModuleConfig,
+        api: ModuleApi,
+        register_guest: Callable[
+            [Optional[str], str, Optional[int]], Awaitable[Optional[str]]
+        ],
+        tokens: GuestTokenIssuer,
+    ):
+        self._api = api
+        self._config = config
+        self._register_guest = register_guest
+        self._tokens = tokens
+        self._entries: Deque[PooledGuest] = deque()
+        self._refilling = False
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def start(self) -> None:
+        """Fill the pool and keep it filled in the background."""
+        self.start_refill()
+        self._api.looping_background_call(
+            self.maintain,
+            MAINTENANCE_INTERVAL_MS,
+            desc="guest_module_pool_maintenance",
+            run_on_all_instances=True,
+        )
+
+    def maintain(self) -> None:
+        """Remove the accounts that can no longer be claimed and refill the
+        pool.
+        """
+        self._evict_expiring()
+        self.start_refill()
+
+    def claim(self) -> Optional[PooledGuest]:
+        """Take a guest user from the pool, or return `None` if the pool is
+        empty. A refill of the pool is started in the background.
+        """
+        self._evict_expiring()
+
+        entry = None
+        if len(self._entries) > 0:
+            entry = self._entries.popleft()
+
+        self.start_refill()
+
+        return entry
+
+    def _evict_expiring(self) -> None:
+        """Remove the accounts that expire within `CLAIM_MARGIN_MS`. The
+        oldest accounts are at the front of the pool.
+        """
+        min_expires_ts = int(time.time() * 1000) + CLAIM_MARGIN_MS
+
+        while len(self._entries) > 0 and self._entries[0].expires_ts <= min_expires_ts:
+            entry = self._entries.popleft()
+            logger.debug("Removed expiring user %s from the guest pool", entry.user_id)
+
+    def start_refill(self) -> None:
+        """Refill the pool in the background, unless a refill is running."""
+        if self._refilling or len(self._entries) >= self._config.guest_pool_size:
+            return
+
+        self._api.run_as_background_process(
+            "guest_module_pool_refill", self.refill, bg_start_span=False
+        )
+
+    async def refill(self) -> None:
+        """Create guest users until the pool is full."""
+        if self._refilling:
+            return
+
+        self._refilling = True
+        try:
+            while len(self._entries) < self._config.guest_pool_size:
+                entry = await self._create_entry()
+                if entry is None:
+                    break
+                self._entries.append(entry)
+        except Exception as e:
+            logger.error("Failed to refill the guest pool: %s", e)
+        finally:
+            self._refilling = False
+
+    async def _create_entry(self) -> Optional[PooledGuest]:
+        user_id = await self._register_guest(
+            None, GuestState.POOLED, self._config.guest_pool_entry_ttl_seconds
+        )
+        if user_id is None:
+            return None
+
+        # the registry calculated its expiration time a bit earlier
+        expires_ts = (
+            int(time.time() * 1000) + self._config.guest_pool_entry_ttl_seconds * 1000
+        )
+
+        # the session must last until the user expires after it was claimed
+        session = await self._tokens.register_device(
+            user_id, expires_ts + self._config.user_expiration_seconds * 1000
+        )
+
+        logger.debug("Added user %s to the guest pool", user_id)
+
+        return PooledGuest(
+            user_id,
+            session.device_id,
+            session.access_token,
+            expires_ts,
+            session.access_token_expires_ts,
+            session.refresh_token,
+        )
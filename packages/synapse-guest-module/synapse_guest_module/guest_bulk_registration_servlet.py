@@ -0,0 +1,153 @@
+# Copyright 2023 Nordeck IT + Consulting GmbH
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import json
+import logging
+from typing import Any, Dict, Optional, Tuple
+
+from synapse.module_api import (
+    DirectServeJsonResource,
+    ModuleApi,
+    parse_json_object_from_request,
+)
+from synapse.module_api.errors import Codes, SynapseError
+from synapse.util.async_helpers import concurrently_execute
+from twisted.web.server import Request
+
+from synapse_guest_module.config import GuestModuleConfig
+from synapse_guest_module.guest_registration_servlet import GuestRegistrationServlet
+from synapse_guest_module.metrics import registrations
+from synapse_guest_module.tracing import CallTracer
+
+logger = logging.getLogger("synapse.contrib." + __name__)
+
+
+class GuestBulkRegistrationServlet(DirectServeJsonResource):
+    """The `POST /_synapse/client/register_guests` endpoint registers many guest
+    users at once, e.g. ahead of a scheduled event. It can only be used by
+    server admins. It requires the `displaynames` property as a list of
+    strings and returns a JSON array with an entry per display name.
+
+    The entries are streamed as soon as the users are created, so they are not
+    in the order of the request. Each entry contains the `index` of its display
+    name and either the session data of the user or an `error`.
+    """
+
+    def __init__(
+        self,
+        config: GuestModuleConfig,
+        api: ModuleApi,
+        registration_servlet: GuestRegistrationServlet,
+    ):
+        super().__init__()
+        self._api = api
+        self._config = config
+        self._registration_servlet = registration_servlet
+        self.tracer = CallTracer(config.slow_call_threshold_ms)
+
+    async def _async_render_POST(
+        self, request: Request
+    ) -> Optional[Tuple[int, Dict[str, Any]]]:
+        """On POST requests, check that the requester is a server admin and
+        create the guest users with up to `bulk_registration_max_concurrency`
+        registrations at the same time.
+        """
+
+        requester = await self._api.get_user_by_req(request)  # type: ignore[arg-type]
+        if not await self._api.is_user_admin(requester.user.to_string()):
+            raise SynapseError(403, "You are not a server admin", Codes.FORBIDDEN)
+
+        json_dict = parse_json_object_from_request(request)
+
+        displaynames = json_dict.get("displaynames")
+        if not isinstance(displaynames, list) or len(displaynames) == 0:
+            return 400, {"msg": "You must provide 'displaynames' as a list of strings"}
+
+        if len(displaynames) > self._config.bulk_registration_max_size:
+            return 400, {
+                "msg": "You can't register more than %d guests at once"
+                % (self._config.bulk_registration_max_size,)
+            }
+
+        request.setResponseCode(200)
+        request.responseHeaders.setRawHeaders(b"Content-Type", [b"application/json"])
+        request.write(b"[")  # type: ignore[no-untyped-call]
+
+        written = 0
+
+        async def create_entry(item: Tuple[int, Any]) -> None:
+            nonlocal written
+
+            # the credentials of further users would be lost
+            if is_disconnected(request):
+                return
+
+            index, displayname = item
+            with self.tracer.span("bulk_registration.entry", index=index):
+                entry = {"index": index, **await self._create_entry(displayname)}
+
+            data = (b"," if written > 0 else b"") + json.dumps(entry).encode()
+            request.write(data)  # type: ignore[no-untyped-call]
+            written += 1
+
+        try:
+            with self.tracer.span(
+                "bulk_registration", log_slow=False, size=len(displaynames)
+            ):
+                await concurrently_execute(
+                    create_entry,
+                    enumerate(displaynames),
+                    self._config.bulk_registration_max_concurrency,
+                )
+        finally:
+            request.write(b"]")  # type: ignore[no-untyped-call]
+            if not is_disconnected(request):
+                request.finish()  # type: ignore[no-untyped-call]
+
+        logger.info(
+            "Created %d of %d requested guest users",
+            written,
+            len(displaynames),
+        )
+
+        # the response was already written
+        return None
+
+    async def _create_entry(self, displayname: Any) -> Dict[str, Any]:
+        """Register a single guest user and return its session data, or an
+        error that is reported to the caller.
+        """
+
+        if not isinstance(displayname, str) or len(displayname.strip()) == 0:
+            registrations.labels("invalid_request").inc()
+            return {"error": "The display name must be a non-empty string"}
+
+        guest_display_name = displayname.strip() + self._config.display_name_suffix
+
+        try:
+            res = await self._registration_servlet.create_guest(guest_display_name)
+        except Exception as e:
+            logger.error("Failed to register a guest user: %s", e)
+            registrations.labels("error").inc()
+            return {"error": "Internal error: Could not register the user"}
+
+        if res is None:
+            return {"error": "Internal error: Could not find a free username"}
+
+        return res
+
+
+def is_disconnected(request: Request) -> bool:
+    """Return whether the client closed the connection."""
+    return bool(getattr(request, "_disconnected", False))
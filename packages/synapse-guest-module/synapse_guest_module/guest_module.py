@@ -13,10 +13,12 @@
 # limitations under the License.
 
 import logging
-from typing import Any, Dict, Literal, Tuple, Union
+from typing import Any, Awaitable, Callable, Dict, FrozenSet, Literal, Tuple, Union
 
+from synapse.api.constants import ProfileFields
 from synapse.module_api import (
     NOT_SPAM,
+    EventBase,
     ModuleApi,
     ProfileInfo,
     UserProfile,
@@ -24,26 +26,69 @@ from synapse.module_api import (
     run_as_background_process,
 )
 from synapse.module_api.errors import ConfigError
-from synapse.types import UserID
+from synapse.types import StateMap, UserID, create_requester
 
 from synapse_guest_module.config import GuestModuleConfig
+from synapse_guest_module.guest_bulk_registration_servlet import (
+    GuestBulkRegistrationServlet,
+)
 from synapse_guest_module.guest_registration_servlet import GuestRegistrationServlet
+from synapse_guest_module.guest_registry import GuestRegistry
 from synapse_guest_module.guest_user_reaper import GuestUserReaper
+from synapse_guest_module.join_rule_cache import JoinRuleCache
+from synapse_guest_module.joined_room_counter import JoinedRoomCounter
+from synapse_guest_module.tracing import CallTracer, set_tag, trace_callback
 
 logger = logging.getLogger("synapse.contrib." + __name__)
 
+# The maximum number of guest users whose joined rooms are kept in memory
+JOINED_ROOM_COUNTER_MAX_USERS = 100000
+
 
 class GuestModule:
     def __init__(self, config: GuestModuleConfig, api: ModuleApi):
         self._api = api
         self._config = config
+        self.tracer = CallTracer(config.slow_call_threshold_ms)
+        self._join_rules = JoinRuleCache(
+            config.join_rule_cache_size, config.join_rule_cache_ttl_seconds
+        )
+        self._joined_rooms = JoinedRoomCounter(
+            config.guest_max_joined_rooms, JOINED_ROOM_COUNTER_MAX_USERS
+        )
+        # mypy doesn't understand the @cached descriptor of the store method
+        self._get_rooms_for_user: Callable[[str], Awaitable[FrozenSet[str]]]
+        if self._joined_rooms.enabled:
+            store = api._hs.get_datastores().main
+            self._get_rooms_for_user = store.get_rooms_for_user  # type: ignore[assignment]
+
+        self.registry = GuestRegistry(api, config)
 
-        self.registration_servlet = GuestRegistrationServlet(config, api)
+        # guest users whose display name is being corrected right now, with
+        # the corrected name that the homeserver passes to the callback again
+        self._correcting_display_names: Dict[str, str] = {}
+
+        self.registration_servlet = GuestRegistrationServlet(config, api, self.registry)
         self._api.register_web_resource(
             "/_synapse/client/register_guest", self.registration_servlet
         )
+        self.bulk_registration_servlet = GuestBulkRegistrationServlet(
+            config, api, self.registration_servlet
+        )
+        self._api.register_web_resource(
+            "/_synapse/client/register_guests", self.bulk_registration_servlet
+        )
+
+        # The homeserver loads the current state of the room for each event
+        # that is passed to on_new_event, so it is only registered if the
+        # module keeps something in memory that has to be updated.
+        on_new_event = None
+        if self._join_rules.enabled or self._joined_rooms.enabled:
+            on_new_event = self.on_new_event
+
         self._api.register_third_party_rules_callbacks(
-            on_profile_update=self.profile_update
+            on_profile_update=self.profile_update,
+            on_new_event=on_new_event,
         )
         self._api.register_spam_checker_callbacks(
             user_may_create_room=self.callback_user_may_create_room,
@@ -52,9 +97,18 @@ class GuestModule:
             check_username_for_spam=self.callback_check_username_for_spam,
         )
 
-        # Start the user reaper
-        self.reaper = GuestUserReaper(api, config)
-        if config.enable_user_reaper:
+        # Fill the pool of guest users and keep it filled
+        if self.registration_servlet.pool is not None:
+            self.registration_servlet.pool.start()
+
+        # Start the user reaper. If it is pinned to a worker, it only runs on
+        # that worker. Otherwise it runs on every worker, but only the worker
+        # that holds the reaper lease deactivates users.
+        self.reaper = GuestUserReaper(api, config, self.registry)
+        if config.enable_user_reaper and (
+            config.reaper_worker_name is None
+            or config.reaper_worker_name == self.reaper.lease.holder
+        ):
             run_as_background_process(
                 "guest_module_reaper_bg_task",
                 self.reaper.run,
@@ -86,13 +140,340 @@ class GuestModule:
                 "Config option 'user_expiration_seconds' must be a number"
             )
 
+        reaper_max_concurrency = config.get("reaper_max_concurrency", 5)
+        if not isinstance(reaper_max_concurrency, int) or reaper_max_concurrency < 1:
+            raise ConfigError(
+                "Config option 'reaper_max_concurrency' must be a positive number"
+            )
+
+        reaper_deactivation_mode = config.get("reaper_deactivation_mode", "in_process")
+        if reaper_deactivation_mode not in ("in_process", "admin_api"):
+            raise ConfigError(
+                "Config option 'reaper_deactivation_mode' must be 'in_process' or 'admin_api'"
+            )
+
+        reaper_admin_api_url = config.get(
+            "reaper_admin_api_url", "http://localhost:8008"
+        )
+        if not isinstance(reaper_admin_api_url, str):
+            raise ConfigError("Config option 'reaper_admin_api_url' must be a string")
+
+        reaper_batch_size = config.get("reaper_batch_size", 100)
+        if not isinstance(reaper_batch_size, int) or reaper_batch_size < 1:
+            raise ConfigError(
+                "Config option 'reaper_batch_size' must be a positive number"
+            )
+
+        join_rule_cache_size = config.get("join_rule_cache_size", 0)
+        if not isinstance(join_rule_cache_size, int) or join_rule_cache_size < 0:
+            raise ConfigError(
+                "Config option 'join_rule_cache_size' must be a non-negative number"
+            )
+
+        join_rule_cache_ttl_seconds = config.get("join_rule_cache_ttl_seconds", 300)
+        if not isinstance(join_rule_cache_ttl_seconds, int):
+            raise ConfigError(
+                "Config option 'join_rule_cache_ttl_seconds' must be a number"
+            )
+
+        guest_pool_size = config.get("guest_pool_size", 0)
+        if not isinstance(guest_pool_size, int) or guest_pool_size < 0:
+            raise ConfigError(
+                "Config option 'guest_pool_size' must be a non-negative number"
+            )
+
+        guest_pool_entry_ttl_seconds = config.get("guest_pool_entry_ttl_seconds", 3600)
+        if (
+            not isinstance(guest_pool_entry_ttl_seconds, int)
+            or guest_pool_entry_ttl_seconds < 120
+        ):
+            raise ConfigError(
+                "Config option 'guest_pool_entry_ttl_seconds' must be a number of at least 120"
+            )
+
+        guest_pool_worker_name = config.get("guest_pool_worker_name", "master")
+        if not isinstance(guest_pool_worker_name, str):
+            raise ConfigError("Config option 'guest_pool_worker_name' must be a string")
+
+        registration_mode = config.get("registration_mode", "check_first")
+        if registration_mode not in ("check_first", "optimistic"):
+            raise ConfigError(
+                "Config option 'registration_mode' must be 'check_first' or 'optimistic'"
+            )
+
+        registration_max_in_flight = config.get("registration_max_in_flight", 0)
+        if (
+            not isinstance(registration_max_in_flight, int)
+            or registration_max_in_flight < 0
+        ):
+            raise ConfigError(
+                "Config option 'registration_max_in_flight' must be a non-negative number"
+            )
+
+        registration_max_queue = config.get("registration_max_queue", 100)
+        if not isinstance(registration_max_queue, int) or registration_max_queue < 0:
+            raise ConfigError(
+                "Config option 'registration_max_queue' must be a non-negative number"
+            )
+
+        registration_rate_limit_per_second = config.get(
+            "registration_rate_limit_per_second", 0
+        )
+        if (
+            not isinstance(registration_rate_limit_per_second, (int, float))
+            or isinstance(registration_rate_limit_per_second, bool)
+            or registration_rate_limit_per_second < 0
+        ):
+            raise ConfigError(
+                "Config option 'registration_rate_limit_per_second' must be a non-negative number"
+            )
+
+        registration_rate_limit_burst = config.get("registration_rate_limit_burst", 10)
+        if (
+            not isinstance(registration_rate_limit_burst, int)
+            or registration_rate_limit_burst < 1
+        ):
+            raise ConfigError(
+                "Config option 'registration_rate_limit_burst' must be a positive number"
+            )
+
+        registration_rate_limit_max_clients = config.get(
+            "registration_rate_limit_max_clients", 10000
+        )
+        if (
+            not isinstance(registration_rate_limit_max_clients, int)
+            or registration_rate_limit_max_clients < 1
+        ):
+            raise ConfigError(
+                "Config option 'registration_rate_limit_max_clients' must be a positive number"
+            )
+
+        reaper_lease_ttl_seconds = config.get("reaper_lease_ttl_seconds", 60)
+        if (
+            not isinstance(reaper_lease_ttl_seconds, int)
+            or reaper_lease_ttl_seconds < 3
+        ):
+            raise ConfigError(
+                "Config option 'reaper_lease_ttl_seconds' must be a number of at least 3"
+            )
+
+        reaper_worker_name = config.get("reaper_worker_name")
+        if reaper_worker_name is not None and not isinstance(reaper_worker_name, str):
+            raise ConfigError("Config option 'reaper_worker_name' must be a string")
+
+        reaper_max_attempts = config.get("reaper_max_attempts", 10)
+        if not isinstance(reaper_max_attempts, int) or reaper_max_attempts < 1:
+            raise ConfigError(
+                "Config option 'reaper_max_attempts' must be a positive number"
+            )
+
+        reaper_retry_interval_seconds = config.get("reaper_retry_interval_seconds", 60)
+        if (
+            not isinstance(reaper_retry_interval_seconds, int)
+            or reaper_retry_interval_seconds < 1
+        ):
+            raise ConfigError(
+                "Config option 'reaper_retry_interval_seconds' must be a positive number"
+            )
+
+        reaper_lock_expired_users = config.get("reaper_lock_expired_users", True)
+        if not isinstance(reaper_lock_expired_users, bool):
+            raise ConfigError(
+                "Config option 'reaper_lock_expired_users' must be a bool"
+            )
+
+        reaper_deactivations_per_second = config.get(
+            "reaper_deactivations_per_second", 0
+        )
+        if (
+            not isinstance(reaper_deactivations_per_second, (int, float))
+            or isinstance(reaper_deactivations_per_second, bool)
+            or reaper_deactivations_per_second < 0
+        ):
+            raise ConfigError(
+                "Config option 'reaper_deactivations_per_second' must be a non-negative number"
+            )
+
+        reaper_room_leave_limit = config.get("reaper_room_leave_limit", 0)
+        if not isinstance(reaper_room_leave_limit, int) or reaper_room_leave_limit < 0:
+            raise ConfigError(
+                "Config option 'reaper_room_leave_limit' must be a non-negative number"
+            )
+
+        reaper_room_leave_window_seconds = config.get(
+            "reaper_room_leave_window_seconds", 60
+        )
+        if (
+            not isinstance(reaper_room_leave_window_seconds, int)
+            or reaper_room_leave_window_seconds < 1
+        ):
+            raise ConfigError(
+                "Config option 'reaper_room_leave_window_seconds' must be a positive number"
+            )
+
+        bulk_registration_max_size = config.get("bulk_registration_max_size", 1000)
+        if (
+            not isinstance(bulk_registration_max_size, int)
+            or bulk_registration_max_size < 1
+        ):
+            raise ConfigError(
+                "Config option 'bulk_registration_max_size' must be a positive number"
+            )
+
+        bulk_registration_max_concurrency = config.get(
+            "bulk_registration_max_concurrency", 10
+        )
+        if (
+            not isinstance(bulk_registration_max_concurrency, int)
+            or bulk_registration_max_concurrency < 1
+        ):
+            raise ConfigError(
+                "Config option 'bulk_registration_max_concurrency' must be a positive number"
+            )
+
+        slow_call_threshold_ms = config.get("slow_call_threshold_ms", 0)
+        if not isinstance(slow_call_threshold_ms, int) or slow_call_threshold_ms < 0:
+            raise ConfigError(
+                "Config option 'slow_call_threshold_ms' must be a non-negative number"
+            )
+
+        guest_access_token_lifetime_seconds = config.get(
+            "guest_access_token_lifetime_seconds", 0
+        )
+        if (
+            not isinstance(guest_access_token_lifetime_seconds, int)
+            or guest_access_token_lifetime_seconds < 0
+        ):
+            raise ConfigError(
+                "Config option 'guest_access_token_lifetime_seconds' must be a non-negative number"
+            )
+
+        display_name_enforcement = config.get(
+            "display_name_enforcement", "set_displayname"
+        )
+        if display_name_enforcement not in ("set_displayname", "in_place"):
+            raise ConfigError(
+                "Config option 'display_name_enforcement' must be 'set_displayname' or 'in_place'"
+            )
+
+        reaper_media_cleanup = config.get("reaper_media_cleanup", "off")
+        if reaper_media_cleanup not in ("off", "delete", "quarantine"):
+            raise ConfigError(
+                "Config option 'reaper_media_cleanup' must be 'off', 'delete' or 'quarantine'"
+            )
+
+        reaper_media_per_second = config.get("reaper_media_per_second", 0)
+        if (
+            not isinstance(reaper_media_per_second, (int, float))
+            or isinstance(reaper_media_per_second, bool)
+            or reaper_media_per_second < 0
+        ):
+            raise ConfigError(
+                "Config option 'reaper_media_per_second' must be a non-negative number"
+            )
+
+        reaper_purge_after_seconds = config.get("reaper_purge_after_seconds", 0)
+        if (
+            not isinstance(reaper_purge_after_seconds, int)
+            or reaper_purge_after_seconds < 0
+        ):
+            raise ConfigError(
+                "Config option 'reaper_purge_after_seconds' must be a non-negative number"
+            )
+
+        reaper_purge_batch_size = config.get("reaper_purge_batch_size", 100)
+        if not isinstance(reaper_purge_batch_size, int) or reaper_purge_batch_size < 1:
+            raise ConfigError(
+                "Config option 'reaper_purge_batch_size' must be a positive number"
+            )
+
+        reaper_purges_per_second = config.get("reaper_purges_per_second", 0)
+        if (
+            not isinstance(reaper_purges_per_second, (int, float))
+            or isinstance(reaper_purges_per_second, bool)
+            or reaper_purges_per_second < 0
+        ):
+            raise ConfigError(
+                "Config option 'reaper_purges_per_second' must be a non-negative number"
+            )
+
+        reaper_purge_dry_run = config.get("reaper_purge_dry_run", False)
+        if not isinstance(reaper_purge_dry_run, bool):
+            raise ConfigError("Config option 'reaper_purge_dry_run' must be a bool")
+
+        registration_idempotency_cache_size = config.get(
+            "registration_idempotency_cache_size", 10000
+        )
+        if (
+            not isinstance(registration_idempotency_cache_size, int)
+            or registration_idempotency_cache_size < 0
+        ):
+            raise ConfigError(
+                "Config option 'registration_idempotency_cache_size' must be a non-negative number"
+            )
+
+        registration_idempotency_ttl_seconds = config.get(
+            "registration_idempotency_ttl_seconds", 300
+        )
+        if (
+            not isinstance(registration_idempotency_ttl_seconds, int)
+            or registration_idempotency_ttl_seconds < 1
+        ):
+            raise ConfigError(
+                "Config option 'registration_idempotency_ttl_seconds' must be a positive number"
+            )
+
+        guest_max_joined_rooms = config.get("guest_max_joined_rooms", 0)
+        if not isinstance(guest_max_joined_rooms, int) or guest_max_joined_rooms < 0:
+            raise ConfigError(
+                "Config option 'guest_max_joined_rooms' must be a non-negative number"
+            )
+
         return GuestModuleConfig(
             user_id_prefix,
             display_name_suffix,
             enable_user_reaper,
             user_expiration_seconds,
+            reaper_max_concurrency,
+            reaper_deactivation_mode,
+            reaper_admin_api_url.rstrip("/"),
+            reaper_batch_size,
+            join_rule_cache_size,
+            join_rule_cache_ttl_seconds,
+            guest_pool_size,
+            guest_pool_entry_ttl_seconds,
+            registration_mode,
+            registration_max_in_flight,
+            registration_max_queue,
+            float(registration_rate_limit_per_second),
+            registration_rate_limit_burst,
+            registration_rate_limit_max_clients,
+            reaper_lease_ttl_seconds,
+            reaper_worker_name,
+            reaper_max_attempts,
+            reaper_retry_interval_seconds,
+            reaper_lock_expired_users,
+            float(reaper_deactivations_per_second),
+            reaper_room_leave_limit,
+            reaper_room_leave_window_seconds,
+            bulk_registration_max_size,
+            bulk_registration_max_concurrency,
+            slow_call_threshold_ms,
+            guest_access_token_lifetime_seconds,
+            display_name_enforcement,
+            reaper_media_cleanup,
+            float(reaper_media_per_second),
+            reaper_purge_after_seconds,
+            reaper_purge_batch_size,
+            float(reaper_purges_per_second),
+            reaper_purge_dry_run,
+            registration_idempotency_cache_size,
+            registration_idempotency_ttl_seconds,
+            guest_max_joined_rooms,
+            guest_pool_worker_name,
         )
 
+    @trace_callback("on_profile_update")
     async def profile_update(
         self,
         user_id: str,
@@ -103,22 +484,73 @@ class GuestModule:
         """Is called whenever a profile is updated. We check that a guest user
         always contains the configured suffix (default ` (Guest)`) and add it if
         it is missing.
+
+        In the `set_displayname` mode, the corrected name is set like any other
+        display name, which updates the membership events in all rooms of the
+        user a second time. In the `in_place` mode, the corrected name is
+        written to the profile before the homeserver updates the membership
+        events, so they are only updated once.
         """
         user_is_guest = user_id.startswith("@" + self._config.user_id_prefix)
-        if user_is_guest:
-            new_profile_display_name = (
-                "" if new_profile.display_name is None else new_profile.display_name
-            )
-            guest_display_name_not_valid = not new_profile_display_name.endswith(
-                self._config.display_name_suffix
-            )
-            if guest_display_name_not_valid:
-                user_id_1 = UserID.from_string(user_id)
-                guest_display_name = (
-                    new_profile_display_name.strip() + self._config.display_name_suffix
+        set_tag("guest", user_is_guest)
+
+        # The profile of a deactivated user must not be changed. Updates that
+        # are caused by our own correction are not corrected again, even if
+        # the homeserver changed the name, e.g. by stripping whitespace.
+        if not user_is_guest or deactivation:
+            return
+
+        new_profile_display_name = (
+            "" if new_profile.display_name is None else new_profile.display_name
+        )
+        if new_profile_display_name.endswith(self._config.display_name_suffix):
+            return
+
+        # Only skip the update that the module's own correction causes. The
+        # homeserver strips the name, so it may no longer end with the suffix.
+        correcting = self._correcting_display_names.get(user_id)
+        if (
+            correcting is not None
+            and new_profile_display_name.strip() == correcting.strip()
+        ):
+            return
+
+        guest_display_name = (
+            new_profile_display_name.strip() + self._config.display_name_suffix
+        )
+        set_tag("display_name_enforcement", self._config.display_name_enforcement)
+
+        self._correcting_display_names[user_id] = guest_display_name
+        try:
+            if self._config.display_name_enforcement == "in_place":
+                await self._set_display_name_in_place(user_id, guest_display_name)
+            else:
+                await self._api.set_displayname(
+                    UserID.from_string(user_id), guest_display_name
                 )
-                await self._api.set_displayname(user_id_1, guest_display_name)
+        finally:
+            # a newer correction of the same user may still be in flight
+            if self._correcting_display_names.get(user_id) == guest_display_name:
+                del self._correcting_display_names[user_id]
+
+    async def _set_display_name_in_place(self, user_id: str, display_name: str) -> None:
+        """Set the display name through the profile handler without updating
+        the membership events. The handler writes the profile on the right
+        worker, updates the user directory and notifies the profile updates
+        stream. The membership events are updated by the homeserver after the
+        callbacks returned, and read the corrected name from the profile.
+        """
+        # The module API always updates the membership events
+        await self._api._hs.get_profile_handler().dispatch_set_profile_field(
+            target_user=UserID.from_string(user_id),
+            requester=create_requester(user_id),
+            field_name=ProfileFields.DISPLAYNAME,
+            new_value=display_name,
+            by_admin=True,
+            propagate=False,
+        )
 
+    @trace_callback("user_may_create_room")
     async def callback_user_may_create_room(
         self,
         user_id: str,
@@ -127,8 +559,10 @@ class GuestModule:
         should not be able to do that.
         """
         user_is_guest = user_id.startswith("@" + self._config.user_id_prefix)
+        set_tag("guest", user_is_guest)
         return not user_is_guest
 
+    @trace_callback("user_may_invite")
     async def callback_user_may_invite(
         self,
         inviter: str,
@@ -139,34 +573,109 @@ class GuestModule:
         Guest users should not be able to to that.
         """
         user_is_guest = inviter.startswith("@" + self._config.user_id_prefix)
+        set_tag("guest", user_is_guest)
+        set_tag("room_id", room_id)
         return not user_is_guest
 
+    @trace_callback("user_may_join_room")
     async def callback_user_may_join_room(
         self, user_id: str, room_id: str, is_invited: bool
     ) -> Union[
         Literal["NOT_SPAM"], errors.Codes, Tuple[errors.Codes, Dict[str, Any]], bool
     ]:
         """Returns whether this user is allowed to join a room. Guest users
-        should only be able to do that if the room is Ask to Join (knock).
+        should only be able to do that if the room is Ask to Join (knock), and
+        only up to `guest_max_joined_rooms` rooms. The join rules and the
+        joined rooms are kept in memory, so most checks don't need the
+        storage.
         """
         user_is_guest = user_id.startswith("@" + self._config.user_id_prefix)
-        if not user_is_guest or is_invited:
+        set_tag("guest", user_is_guest)
+        set_tag("room_id", room_id)
+        if not user_is_guest:
             return NOT_SPAM
 
-        join_rules_events = await self._api.get_state_events_in_room(
-            room_id, [("m.room.join_rules", None)]
-        )
-        if join_rules_events is None or len(list(join_rules_events)) == 0:
-            return errors.Codes.BAD_STATE
+        if self._joined_rooms.enabled and not await self._may_join_another_room(
+            user_id, room_id
+        ):
+            set_tag("joined_rooms_limit", "exceeded")
+            return errors.Codes.FORBIDDEN
+
+        if is_invited:
+            self._joined_rooms.join(user_id, room_id)
+            return NOT_SPAM
 
-        for event in join_rules_events:
-            join_rule = event.get("content", {})
-            is_knock = join_rule.get("join_rule").startswith("knock")
-            if user_is_guest and is_knock:
-                return NOT_SPAM
+        is_knock = self._join_rules.get(room_id)
+        set_tag("join_rule_cache", "miss" if is_knock is None else "hit")
+
+        if is_knock is None:
+            with self.tracer.span("get_join_rules", room_id=room_id):
+                join_rules_events = list(
+                    await self._api.get_state_events_in_room(
+                        room_id, [("m.room.join_rules", None)]
+                    )
+                )
+            if len(join_rules_events) == 0:
+                return errors.Codes.BAD_STATE
+
+            join_rule = join_rules_events[0].get("content", {}).get("join_rule", "")
+            self._join_rules.set(room_id, join_rule)
+            is_knock = join_rule.startswith("knock")
+
+        if is_knock:
+            self._joined_rooms.join(user_id, room_id)
+            return NOT_SPAM
 
         return errors.Codes.FORBIDDEN
 
+    async def _may_join_another_room(self, user_id: str, room_id: str) -> bool:
+        """Returns whether the guest user may join the room without exceeding
+        `guest_max_joined_rooms`. The rooms of the user are only read from the
+        storage when the user is seen for the first time, or before a join is
+        rejected, because the leave events that other workers persist only
+        reach this process through replication, after a delay.
+
+        An allowed join is counted right away, before its membership event
+        arrives. A join that fails afterwards is corrected when the rooms are
+        read again.
+        """
+        if self._joined_rooms.is_known(user_id) and self._joined_rooms.may_join(
+            user_id, room_id
+        ):
+            return True
+
+        self._joined_rooms.load(user_id, await self._get_rooms_for_user(user_id))
+
+        return self._joined_rooms.may_join(user_id, room_id)
+
+    async def on_new_event(
+        self, event: EventBase, state_events: StateMap[EventBase]
+    ) -> None:
+        """Is called after an event was sent into a room. Keeps the cached join
+        rules of the rooms and the joined rooms of the guest users up to date.
+        """
+        # The event may have lost the state resolution, so the join rule is
+        # read from the current state of the room.
+        if event.type == "m.room.join_rules" and event.get_state_key() == "":
+            join_rules_event = state_events.get(("m.room.join_rules", ""))
+            if join_rules_event is not None:
+                join_rule = join_rules_event.content.get("join_rule")
+                if isinstance(join_rule, str):
+                    self._join_rules.set(event.room_id, join_rule)
+
+        state_key = event.get_state_key()
+        if (
+            self._joined_rooms.enabled
+            and event.type == "m.room.member"
+            and state_key is not None
+            and state_key.startswith("@" + self._config.user_id_prefix)
+        ):
+            if event.content.get("membership") == "join":
+                self._joined_rooms.join(state_key, event.room_id)
+            else:
+                self._joined_rooms.leave(state_key, event.room_id)
+
+    @trace_callback("check_username_for_spam")
     async def callback_check_username_for_spam(self, user_profile: UserProfile) -> bool:
         """Returns whether this user should appear in the user directory. Since
         we prefer to not invite guests into normal rooms, we hide them here.
@@ -174,4 +683,5 @@ class GuestModule:
         user_is_guest = user_profile["user_id"].startswith(
             "@" + self._config.user_id_prefix
         )
+        set_tag("guest", user_is_guest)
         return user_is_guest
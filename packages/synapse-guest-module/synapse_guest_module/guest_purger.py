@@ -0,0 +1,241 @@
+# Copyright 2023 Nordeck IT + Consulting GmbH
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import json
+import logging
+from typing import Any, List, Tuple, Union
+
+from synapse.module_api import LoggingTransaction, ModuleApi
+from synapse.types import UserID
+
+from synapse_guest_module.config import GuestModuleConfig
+from synapse_guest_module.deactivation_queue import JobState
+from synapse_guest_module.guest_registry import GuestRegistry, GuestState
+from synapse_guest_module.throughput import RatePacer
+
+logger = logging.getLogger("synapse.contrib." + __name__)
+
+# The tables of the homeserver that still hold rows of a deactivated user, with
+# the columns that contain the user id. The `users` table and the room history
+# are kept, so the user id of a guest user is never handed out again.
+PURGED_TABLES: List[Tuple[str, str]] = [
+    ("profiles", "full_user_id"),
+    ("user_filters", "full_user_id"),
+    ("user_directory", "user_id"),
+    ("user_directory_search", "user_id"),
+    ("users_in_public_rooms", "user_id"),
+    ("users_who_share_private_rooms", "user_id"),
+    ("users_who_share_private_rooms", "other_user_id"),
+    ("user_ips", "user_id"),
+    ("user_daily_visits", "user_id"),
+    ("monthly_active_users", "user_id"),
+    ("user_stats_current", "user_id"),
+    ("e2e_cross_signing_keys", "user_id"),
+    ("e2e_cross_signing_signatures", "user_id"),
+]
+
+
+class GuestPurger:
+    """Removes the remaining data of guest users that were deactivated more
+    than `reaper_purge_after_seconds` ago from the tables of the homeserver
+    and from the registry. Each batch of `reaper_purge_batch_size` users is
+    purged in a single transaction, at most `reaper_purges_per_second` users
+    per second. While `reaper_media_cleanup` is enabled, users whose media
+    still has to be reclaimed are purged later.
+    """
+
+    def __init__(
+        self,
+        api: ModuleApi,
+        config: GuestModuleConfig,
+        registry: GuestRegistry,
+    ):
+        self._api = api
+        self._config = config
+        self._registry = registry
+        self._pacer = RatePacer(api, config.reaper_purges_per_second)
+
+    @property
+    def enabled(self) -> bool:
+        return self._config.reaper_purge_after_seconds > 0
+
+    def get_purge_before_ts(self, now_ts: int) -> int:
+        """Return the expiration time before which deactivated guest users are
+        purged at `now_ts`.
+        """
+        return now_ts - self._config.reaper_purge_after_seconds * 1000
+
+    async def count_purgeable(self, before_ts: int) -> int:
+        """Return the number of deactivated guest users that expired before
+        `before_ts` and can be purged.
+        """
+        await self._registry.setup()
+
+        def count_purgeable_txn(txn: LoggingTransaction) -> int:
+            clause, args = self._purgeable_clause(before_ts)
+            txn.execute(
+                f"""
+                SELECT COUNT(*)
+                FROM guest_module_guests AS g
+                WHERE {clause}
+                """,
+                args,
+            )
+            row = txn.fetchone()
+
+            return 0 if row is None else int(row[0])
+
+        return await self._api.run_db_interaction(
+            "guest_module_count_purgeable_guests",
+            count_purgeable_txn,
+        )
+
+    async def purge(self, before_ts: int) -> List[str]:
+        """Purge up to `reaper_purge_batch_size` deactivated guest users that
+        expired before `before_ts`, in the order of their expiration, and
+        return their user ids.
+        """
+        await self._registry.setup()
+        await self._pacer.wait(self._config.reaper_purge_batch_size)
+
+        # The module API doesn't provide a way to invalidate the caches of the
+        # homeserver, so the store is accessed directly.
+        store = self._api._hs.get_datastores().main
+
+        def purge_txn(txn: LoggingTransaction) -> List[str]:
+            clause, args = self._purgeable_clause(before_ts)
+            txn.execute(
+                f"""
+                SELECT g.user_id
+                FROM guest_module_guests AS g
+                WHERE {clause}
+                ORDER BY g.expires_ts, g.user_id
+                LIMIT ?
+                """,
+                [*args, self._config.reaper_purge_batch_size],
+            )
+            user_ids = [row[0] for row in txn.fetchall()]
+            if len(user_ids) == 0:
+                return user_ids
+
+            placeholders = ", ".join("?" for _ in user_ids)
+
+            # the cache keys of the filters and signatures are not the user ids
+            txn.execute(
+                f"SELECT full_user_id, filter_id FROM user_filters WHERE full_user_id IN ({placeholders})",
+                user_ids,
+            )
+            filters = [(row[0], row[1]) for row in txn.fetchall()]
+            txn.execute(
+                f"SELECT user_id, target_device_id FROM e2e_cross_signing_signatures WHERE user_id IN ({placeholders})",
+                user_ids,
+            )
+            signatures = sorted({(row[0], row[1]) for row in txn.fetchall()})
+
+            for table, column in PURGED_TABLES:
+                txn.execute(
+                    f"DELETE FROM {table} WHERE {column} IN ({placeholders})",
+                    user_ids,
+                )
+            txn.execute(
+                f"DELETE FROM guest_module_guests WHERE user_id IN ({placeholders})",
+                user_ids,
+            )
+
+            # Users that were enqueued before the media cleanup was disabled.
+            # Parked users are kept, so their media can be checked manually.
+            txn.execute(
+                f"DELETE FROM guest_module_media_cleanup WHERE state = ? AND user_id IN ({placeholders})",
+                [JobState.PENDING, *user_ids],
+            )
+
+            self._invalidate_caches_txn(txn, store, user_ids, filters, signatures)
+
+            return user_ids
+
+        return await self._api.run_db_interaction(
+            "guest_module_purge_guests",
+            purge_txn,
+        )
+
+    def _invalidate_caches_txn(
+        self,
+        txn: LoggingTransaction,
+        store: Any,
+        user_ids: List[str],
+        filters: List[Tuple[str, int]],
+        signatures: List[Tuple[str, str]],
+    ) -> None:
+        """Invalidate the caches of the homeserver that hold the purged rows,
+        on this and on all other workers, like the store does when it changes
+        these tables.
+        """
+        keys = [(user_id,) for user_id in user_ids]
+        store._invalidate_cache_and_stream_bulk(
+            txn, store.user_last_seen_monthly_active, keys
+        )
+        store._invalidate_cache_and_stream(txn, store.get_monthly_active_count, ())
+        store._invalidate_cache_and_stream(
+            txn, store.get_monthly_active_count_by_service, ()
+        )
+        store._invalidate_cache_and_stream_bulk(
+            txn, store._get_bare_e2e_cross_signing_keys, keys
+        )
+
+        # The cache takes a single tuple argument, which is sent as a JSON
+        # string over replication, like in `store_e2e_cross_signing_signatures`.
+        if len(signatures) > 0:
+            for user_id, device_id in signatures:
+                txn.call_after(
+                    store._get_e2e_cross_signing_signatures_for_device.invalidate,
+                    ((user_id, device_id),),
+                )
+            store._send_invalidation_to_replication_bulk(
+                txn,
+                cache_name=store._get_e2e_cross_signing_signatures_for_device.__name__,
+                key_tuples=[
+                    (json.dumps([user_id, device_id]),)
+                    for user_id, device_id in signatures
+                ],
+            )
+
+        # The cache is keyed by a `UserID`, which can't be sent over
+        # replication, and the homeserver never invalidates it. Only the local
+        # cache is invalidated; a purged user can't log in again, so the other
+        # workers never read their filters.
+        for user_id, filter_id in filters:
+            txn.call_after(
+                store.get_user_filter.invalidate,
+                (UserID.from_string(user_id), filter_id),
+            )
+
+    def _purgeable_clause(self, before_ts: int) -> Tuple[str, List[Union[int, str]]]:
+        clause = "g.state = ? AND g.expires_ts < ?"
+        args: List[Union[int, str]] = [GuestState.DEACTIVATED, before_ts]
+
+        # The media of a user can't be reclaimed after the user is purged. The
+        # pending media cleanup is ignored while the cleanup is disabled, so
+        # it doesn't block the purge forever.
+        if self._config.reaper_media_cleanup != "off":
+            clause += """
+            AND NOT EXISTS (
+                SELECT 1
+                FROM guest_module_media_cleanup AS c
+                WHERE c.user_id = g.user_id
+                AND c.state = ?
+            )
+            """
+            args.append(JobState.PENDING)
+
+        return clause, args
@@ -13,81 +13,372 @@
 # limitations under the License.
 
 import logging
+import math
 import secrets
 import string
-from typing import Any, Dict, Tuple
+import time
+from contextlib import contextmanager
+from typing import Any, Dict, Iterator, Optional, Tuple
 
 from synapse.module_api import (
     DirectServeJsonResource,
     ModuleApi,
     parse_json_object_from_request,
 )
+from synapse.module_api.errors import Codes, SynapseError
+from synapse.types import UserID
 from twisted.web.server import Request
 
+from synapse_guest_module.admission_control import (
+    AdmissionController,
+    ClientRateLimiter,
+)
 from synapse_guest_module.config import GuestModuleConfig
+from synapse_guest_module.guest_account_pool import CLAIM_MARGIN_MS, GuestAccountPool
+from synapse_guest_module.guest_registry import GuestRegistry, GuestState
+from synapse_guest_module.guest_tokens import GuestSession, GuestTokenIssuer
+from synapse_guest_module.idempotency_cache import IdempotencyCache
+from synapse_guest_module.metrics import (
+    registration_step_time,
+    registration_time,
+    registrations,
+)
+from synapse_guest_module.tracing import CallTracer, set_tag
 
 logger = logging.getLogger("synapse.contrib." + __name__)
 
+USERNAME_ALPHABET = string.ascii_lowercase + string.digits
+
+MAX_IDEMPOTENCY_KEY_LENGTH = 255
+
 
 class GuestRegistrationServlet(DirectServeJsonResource):
     """The `POST /_synapse/client/register_guest` endpoints provides an endpoint
     to register a new guest user. It requires the `displayname` property and
     returns an object that matches the `AccountAuthInfo` of the
-    `@matrix-org/react-sdk-module-api`.
+    `@matrix-org/react-sdk-module-api`. If guest access tokens expire, the
+    object also contains a `refreshToken` and `expiresInMs`.
     """
 
     def __init__(
         self,
         config: GuestModuleConfig,
         api: ModuleApi,
+        registry: GuestRegistry,
     ):
         super().__init__()
         self._api = api
         self._config = config
+        self._registry = registry
+        self.tracer = CallTracer(config.slow_call_threshold_ms)
+        self.tokens = GuestTokenIssuer(api, config)
+
+        self._admission_controller = AdmissionController(
+            config.registration_max_in_flight, config.registration_max_queue
+        )
+        self._rate_limiter = ClientRateLimiter(
+            config.registration_rate_limit_per_second,
+            config.registration_rate_limit_burst,
+            config.registration_rate_limit_max_clients,
+        )
+        self._idempotency_cache = IdempotencyCache(
+            config.registration_idempotency_cache_size,
+            config.registration_idempotency_ttl_seconds,
+        )
+
+        # The pool is only filled on the process that serves the
+        # registrations, the accounts of other processes would never be
+        # claimed.
+        self.pool: Optional[GuestAccountPool] = None
+        if config.guest_pool_size > 0 and config.guest_pool_worker_name == (
+            api.worker_name or "master"
+        ):
+            self.pool = GuestAccountPool(config, api, self.register_guest, self.tokens)
 
     async def _async_render_POST(self, request: Request) -> Tuple[int, Dict[str, Any]]:
-        """On POST requests, generate a new username for a guest, check that it
-        doesn't exist yet, append the suffix to the displayname, create the user,
-        create a device, and return the session data to the caller.
+        """On POST requests, return the original response if the request is a
+        retry of a request with the same `Idempotency-Key` header. Otherwise,
+        check the rate limit of the client and wait for a free slot before the
+        guest user is registered. Requests that can't be handled are rejected
+        with `Retry-After`.
+        """
+
+        with self.tracer.span("registration"):
+            idempotency_keys = request.requestHeaders.getRawHeaders(b"Idempotency-Key")
+            if idempotency_keys is None or not self._idempotency_cache.enabled:
+                code, res, headers = await self._handle_registration(request)
+                return self._respond(request, code, res, headers)
+
+            idempotency_key = idempotency_keys[0]
+            if (
+                len(idempotency_key) == 0
+                or len(idempotency_key) > MAX_IDEMPOTENCY_KEY_LENGTH
+            ):
+                record_outcome("invalid_request")
+                return 400, {
+                    "msg": f"The 'Idempotency-Key' must have 1 to {MAX_IDEMPOTENCY_KEY_LENGTH} characters"
+                }
+
+            # Keys are only valid for the client that sent them, so other
+            # clients can't read the credentials by guessing a key.
+            (code, res, headers), replayed = await self._idempotency_cache.run(
+                f"{get_client_ip(request)} {idempotency_key.decode('utf-8', 'replace')}",
+                lambda: self._handle_registration(request),
+            )
+            if replayed:
+                record_outcome("replayed")
+
+            return self._respond(request, code, res, headers)
+
+    def _respond(
+        self,
+        request: Request,
+        code: int,
+        res: Dict[str, Any],
+        headers: Dict[str, str],
+    ) -> Tuple[int, Dict[str, Any]]:
+        """Set the `headers` of a response on the `request`, which may not be
+        the request that created the response.
+        """
+        for name, value in headers.items():
+            request.responseHeaders.setRawHeaders(name, [value])
+
+        return code, res
+
+    async def _handle_registration(
+        self, request: Request
+    ) -> Tuple[int, Dict[str, Any], Dict[str, str]]:
+        """Check the rate limit of the client and wait for a free slot before
+        the guest user is registered. Returns the status, the body and the
+        headers of the response.
+        """
+        retry_after = self._rate_limiter.check(get_client_ip(request))
+        if retry_after > 0:
+            record_outcome("rate_limited")
+            return (
+                429,
+                {"msg": "Too many requests, please try again later"},
+                {"Retry-After": str(math.ceil(retry_after))},
+            )
+
+        with registration_time.time():
+            with self.tracer.span(
+                "registration.wait_for_slot",
+                in_flight=self._admission_controller.in_flight,
+                queued=self._admission_controller.queued,
+            ):
+                acquired = await self._admission_controller.acquire()
+
+            if not acquired:
+                record_outcome("overloaded")
+                return (
+                    503,
+                    {"msg": "Too many registrations, please try again later"},
+                    {"Retry-After": "1"},
+                )
+
+            try:
+                code, res = await self._register_guest_from_request(request)
+                return code, res, {}
+            except Exception:
+                record_outcome("error")
+                raise
+            finally:
+                self._admission_controller.release()
+
+    async def _register_guest_from_request(
+        self, request: Request
+    ) -> Tuple[int, Dict[str, Any]]:
+        """Claim a guest from the pool or generate a new
+        username for a guest and create the user with the suffix appended to
+        the displayname. Register it in the guest registry, create a device,
+        and return the session data to the caller.
         """
 
         json_dict = parse_json_object_from_request(request)
 
         displayname = json_dict.get("displayname")
         if not isinstance(displayname, str) or len(displayname.strip()) == 0:
+            record_outcome("invalid_request")
             return 400, {"msg": "You must provide a 'displayname' as a string"}
 
+        guest_display_name = displayname.strip() + self._config.display_name_suffix
+
+        if self.pool is not None:
+            pooled_guest = self.pool.claim()
+
+            if pooled_guest is not None and await self._registry.claim_pooled_guest(
+                pooled_guest.user_id
+            ):
+                with self.measure_step("set_displayname"):
+                    await self._api.set_displayname(
+                        UserID.from_string(pooled_guest.user_id), guest_display_name
+                    )
+
+                session = GuestSession(
+                    pooled_guest.device_id,
+                    pooled_guest.access_token,
+                    pooled_guest.access_token_expires_ts,
+                    pooled_guest.refresh_token,
+                )
+
+                # Replace an access token that was waiting in the pool for
+                # most of its lifetime.
+                now_ts = int(time.time() * 1000)
+                if (
+                    session.access_token_expires_ts is not None
+                    and session.access_token_expires_ts < now_ts + CLAIM_MARGIN_MS
+                ):
+                    with self.measure_step("issue_tokens"):
+                        session = await self.tokens.issue_tokens(
+                            pooled_guest.user_id,
+                            pooled_guest.device_id,
+                            now_ts + self._config.user_expiration_seconds * 1000,
+                        )
+
+                logger.debug("Claimed user %s from the pool", pooled_guest.user_id)
+                set_tag("user_id", pooled_guest.user_id)
+                record_outcome("claimed")
+
+                return 201, self._session_response(pooled_guest.user_id, session)
+
+        res = await self.create_guest(guest_display_name)
+        if res is None:
+            return 500, {"msg": "Internal error: Could not find a free username"}
+
+        return 201, res
+
+    async def create_guest(self, guest_display_name: str) -> Optional[Dict[str, Any]]:
+        """Register a new guest user with the given display name, add it to the
+        guest registry and create a device. Returns the session data of the
+        user, or `None` if no free username was found.
+        """
+
+        user_id = await self.register_guest(guest_display_name)
+        if user_id is None:
+            record_outcome("no_free_username")
+            return None
+
+        set_tag("user_id", user_id)
+
+        # the registry calculated its expiration time a bit earlier
+        expires_ts = (
+            int(time.time() * 1000) + self._config.user_expiration_seconds * 1000
+        )
+
+        with self.measure_step("register_device"):
+            session = await self.tokens.register_device(user_id, expires_ts)
+
+        logger.debug("Registered user %s", user_id)
+        record_outcome("registered")
+
+        return self._session_response(user_id, session)
+
+    def _session_response(self, user_id: str, session: GuestSession) -> Dict[str, Any]:
+        """Return the session data of a guest user. Expiring access tokens come
+        with a `refreshToken` and their lifetime in `expiresInMs`.
+        """
+        res: Dict[str, Any] = {
+            "userId": user_id,
+            "deviceId": session.device_id,
+            "accessToken": session.access_token,
+            "homeserverUrl": self._api.public_baseurl,
+        }
+
+        if session.access_token_expires_ts is not None:
+            res["refreshToken"] = session.refresh_token
+            res["expiresInMs"] = max(
+                0, session.access_token_expires_ts - int(time.time() * 1000)
+            )
+
+        return res
+
+    async def register_guest(
+        self,
+        displayname: Optional[str],
+        state: str = GuestState.ACTIVE,
+        expiration_seconds: Optional[int] = None,
+    ) -> Optional[str]:
+        """Generate a new username for a guest, add it to the guest registry
+        and create the user. Returns `None` if no free username was found.
+
+        In the `check_first` registration mode, we check that the username
+        doesn't exist yet before creating the user. In the `optimistic` mode,
+        we create the user right away and only try again if the username is
+        already taken.
+
+        The user is added to the registry before it is created, so the reaper
+        finds every guest user. If the user can't be created, it is removed
+        from the registry again, so the reaper doesn't try to deactivate a
+        user that doesn't exist.
+        """
+
         # make sure the regex is unique
         for _ in range(10):
-            random_string = "".join(
-                secrets.choice(string.ascii_lowercase + string.digits)
-                for _ in range(32)
-            )
+            localpart = self._config.user_id_prefix + generate_random_string()
+            user_id = self._api.get_qualified_user_id(localpart)
 
-            localpart = self._config.user_id_prefix + random_string
+            if self._config.registration_mode == "check_first":
+                # make sure the user-id does not exist yet
+                with self.measure_step("check_user_exists"):
+                    user_exists = await self._api.check_user_exists(user_id)
+                if user_exists:
+                    continue
 
-            # make sure the user-id does not exist yet
-            if await self._api.check_user_exists(
-                self._api.get_qualified_user_id(localpart)
-            ):
+            with self.tracer.span("registration.record_guest"):
+                recorded = await self._registry.record_guest(
+                    user_id, state, expiration_seconds
+                )
+            if not recorded:
                 continue
 
             logger.info("Register guest with user %s", localpart)
-            user_id = await self._api.register_user(
-                localpart, displayname.strip() + self._config.display_name_suffix
-            )
 
-            device_id, access_token, _, _ = await self._api.register_device(user_id)
+            try:
+                with self.measure_step("register_user"):
+                    return await self._api.register_user(localpart, displayname)
+            except Exception as e:
+                await self._registry.remove_guest(user_id)
+
+                # only retry with another username if the user belongs to someone else
+                if not isinstance(e, SynapseError) or e.errcode != Codes.USER_IN_USE:
+                    raise
+
+                logger.debug("User %s already exists", localpart)
 
-            logger.debug("Registered user %s", user_id)
+        return None
 
-            res = {
-                "userId": user_id,
-                "deviceId": device_id,
-                "accessToken": access_token,
-                "homeserverUrl": self._api.public_baseurl,
-            }
+    @contextmanager
+    def measure_step(self, step: str) -> Iterator[None]:
+        """Record the time of a homeserver call of the registration in
+        `registration_step_time` and run it in a span.
+        """
+        with self.tracer.span(f"registration.{step}"):
+            with registration_step_time.labels(step).time():
+                yield
+
+
+def record_outcome(outcome: str) -> None:
+    """Count a registration in `registrations` and tag its span."""
+    registrations.labels(outcome).inc()
+    set_tag("outcome", outcome)
+
+
+def get_client_ip(request: Request) -> str:
+    """Return the IP address of the client that sent the request."""
+    address = request.getClientAddress()  # type: ignore[no-untyped-call]
+    return str(getattr(address, "host", "unknown"))
+
+
+def generate_random_string(length: int = 32) -> str:
+    """Generate a random string of lowercase letters and digits from a single
+    call to the random source.
+    """
+    value = secrets.randbelow(len(USERNAME_ALPHABET) ** length)
 
-            return 201, res
+    chars = []
+    for _ in range(length):
+        value, index = divmod(value, len(USERNAME_ALPHABET))
+        chars.append(USERNAME_ALPHABET[index])
 
-        return 500, {"msg": "Internal error: Could not find a free username"}
+    return "".join(chars)
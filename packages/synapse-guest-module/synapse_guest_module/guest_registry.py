@@ -0,0 +1,380 @@
+# Copyright 2023 Nordeck IT + Consulting GmbH
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import logging
+import time
+from typing import Callable, List, Optional, Tuple, Union
+
+from synapse.module_api import LoggingTransaction, ModuleApi
+
+from synapse_guest_module.config import GuestModuleConfig
+
+logger = logging.getLogger("synapse.contrib." + __name__)
+
+
+class GuestState:
+    """The states of a guest user in the registry."""
+
+    ACTIVE = "active"
+    POOLED = "pooled"
+    EXPIRED = "expired"
+    PARKED = "parked"
+    DEACTIVATED = "deactivated"
+
+
+class GuestRegistry:
+    """Stores all guest users in a table that is owned by the module. The table
+    is indexed by the state and the expiration time, so the reaper doesn't
+    have to scan the `users` table of the homeserver.
+    """
+
+    def __init__(self, api: ModuleApi, config: GuestModuleConfig):
+        self._api = api
+        self._config = config
+        self._schema_ready = False
+        self._expiry_listeners: List[Callable[[int], None]] = []
+
+    def add_expiry_listener(self, listener: Callable[[int], None]) -> None:
+        """Register a function that is called with the expiration time of each
+        guest user that is recorded by this process.
+        """
+        self._expiry_listeners.append(listener)
+
+    async def setup(self) -> None:
+        """Create the tables of the module if they don't exist yet. Guest users
+        that were registered before the registry existed are copied from the
+        `users` table once.
+        """
+        if self._schema_ready:
+            return
+
+        await self._api.run_db_interaction(
+            "guest_module_setup_registry",
+            self._setup_txn,
+        )
+
+        self._schema_ready = True
+
+    def _setup_txn(self, txn: LoggingTransaction) -> None:
+        txn.execute(
+            """
+            CREATE TABLE IF NOT EXISTS guest_module_guests (
+                user_id TEXT NOT NULL PRIMARY KEY,
+                created_ts BIGINT NOT NULL,
+                expires_ts BIGINT NOT NULL,
+                state TEXT NOT NULL
+            )
+            """,
+            (),
+        )
+        # Deactivated guest users are kept in the table, so the index starts
+        # with the state. Otherwise, every query for the active guest users
+        # would also walk through the whole history of deactivated ones.
+        txn.execute("DROP INDEX IF EXISTS guest_module_guests_expires_ts", ())
+        txn.execute(
+            """
+            CREATE INDEX IF NOT EXISTS guest_module_guests_state_expires_ts
+            ON guest_module_guests (state, expires_ts, user_id)
+            """,
+            (),
+        )
+        txn.execute(
+            """
+            CREATE TABLE IF NOT EXISTS guest_module_deactivation_jobs (
+                user_id TEXT NOT NULL PRIMARY KEY,
+                attempts INTEGER NOT NULL,
+                next_attempt_ts BIGINT NOT NULL,
+                last_error TEXT,
+                state TEXT NOT NULL
+            )
+            """,
+            (),
+        )
+        txn.execute(
+            """
+            CREATE INDEX IF NOT EXISTS guest_module_deactivation_jobs_next_attempt_ts
+            ON guest_module_deactivation_jobs (state, next_attempt_ts, user_id)
+            """,
+            (),
+        )
+        txn.execute(
+            """
+            CREATE TABLE IF NOT EXISTS guest_module_reaper_lease (
+                name TEXT NOT NULL PRIMARY KEY,
+                holder TEXT NOT NULL,
+                expires_ts BIGINT NOT NULL
+            )
+            """,
+            (),
+        )
+        txn.execute(
+            """
+            CREATE TABLE IF NOT EXISTS guest_module_media_cleanup (
+                user_id TEXT NOT NULL PRIMARY KEY,
+                attempts INTEGER NOT NULL DEFAULT 0,
+                state TEXT NOT NULL DEFAULT 'pending'
+            )
+            """,
+            (),
+        )
+        txn.execute(
+            """
+            CREATE TABLE IF NOT EXISTS guest_module_migrations (
+                name TEXT NOT NULL PRIMARY KEY
+            )
+            """,
+            (),
+        )
+
+        txn.execute(
+            "SELECT name FROM guest_module_migrations WHERE name = ?",
+            ("backfill_guests",),
+        )
+        if txn.fetchone() is not None:
+            return
+
+        logger.info("Copy existing guest users into the registry")
+
+        # creation_ts of the users table is stored in seconds
+        txn.execute(
+            """
+            INSERT INTO guest_module_guests (user_id, created_ts, expires_ts, state)
+            SELECT
+                name,
+                creation_ts * 1000,
+                (creation_ts + ?) * 1000,
+                CASE WHEN deactivated = 0 THEN ? ELSE ? END
+            FROM users
+            WHERE name != ?
+            AND name LIKE ?
+            ON CONFLICT (user_id) DO NOTHING
+            """,
+            (
+                self._config.user_expiration_seconds,
+                GuestState.ACTIVE,
+                GuestState.DEACTIVATED,
+                self._api.get_qualified_user_id(f"{self._config.user_id_prefix}reaper"),
+                f"@{self._config.user_id_prefix}%:{self._api.server_name}",
+            ),
+        )
+
+        # another worker may run the backfill at the same time
+        txn.execute(
+            """
+            INSERT INTO guest_module_migrations (name)
+            VALUES (?)
+            ON CONFLICT (name) DO NOTHING
+            """,
+            ("backfill_guests",),
+        )
+
+    async def record_guest(
+        self,
+        user_id: str,
+        state: str = GuestState.ACTIVE,
+        expiration_seconds: Optional[int] = None,
+    ) -> bool:
+        """Add a guest user to the registry before it is registered. The user
+        expires after `expiration_seconds`, which defaults to
+        `user_expiration_seconds`. Returns `False` if the user id is already
+        in the registry.
+        """
+        await self.setup()
+
+        if expiration_seconds is None:
+            expiration_seconds = self._config.user_expiration_seconds
+
+        created_ts = int(time.time() * 1000)
+        expires_ts = created_ts + expiration_seconds * 1000
+
+        def record_guest_txn(txn: LoggingTransaction) -> bool:
+            txn.execute(
+                """
+                INSERT INTO guest_module_guests (user_id, created_ts, expires_ts, state)
+                VALUES (?, ?, ?, ?)
+                ON CONFLICT (user_id) DO NOTHING
+                """,
+                (user_id, created_ts, expires_ts, state),
+            )
+            return bool(txn.rowcount == 1)
+
+        recorded = await self._api.run_db_interaction(
+            "guest_module_record_guest",
+            record_guest_txn,
+        )
+
+        if recorded:
+            for listener in self._expiry_listeners:
+                listener(expires_ts)
+
+        return recorded
+
+    async def remove_guest(self, user_id: str) -> None:
+        """Remove a guest user that could not be registered from the
+        registry.
+        """
+        await self.setup()
+
+        def remove_guest_txn(txn: LoggingTransaction) -> None:
+            txn.execute(
+                "DELETE FROM guest_module_guests WHERE user_id = ?",
+                (user_id,),
+            )
+
+        await self._api.run_db_interaction(
+            "guest_module_remove_guest",
+            remove_guest_txn,
+        )
+
+    async def claim_pooled_guest(self, user_id: str) -> bool:
+        """Turn a pooled guest user into an active one. The expiration time
+        starts again from now. Returns `False` if the user is no longer pooled,
+        e.g. because it expired in the meantime.
+        """
+        await self.setup()
+
+        created_ts = int(time.time() * 1000)
+        expires_ts = created_ts + self._config.user_expiration_seconds * 1000
+
+        def claim_pooled_guest_txn(txn: LoggingTransaction) -> bool:
+            txn.execute(
+                """
+                UPDATE guest_module_guests
+                SET created_ts = ?, expires_ts = ?, state = ?
+                WHERE user_id = ?
+                AND state = ?
+                AND expires_ts > ?
+                """,
+                (
+                    created_ts,
+                    expires_ts,
+                    GuestState.ACTIVE,
+                    user_id,
+                    GuestState.POOLED,
+                    created_ts,
+                ),
+            )
+            return bool(txn.rowcount == 1)
+
+        claimed = await self._api.run_db_interaction(
+            "guest_module_claim_pooled_guest",
+            claim_pooled_guest_txn,
+        )
+
+        if claimed:
+            for listener in self._expiry_listeners:
+                listener(expires_ts)
+
+        return claimed
+
+    async def get_expired_guests(
+        self,
+        now_ts: int,
+        after: Optional[Tuple[int, str]],
+        limit: int,
+    ) -> List[Tuple[int, str]]:
+        """Return up to `limit` active or pooled guest users that expired before
+        `now_ts` as `(expires_ts, user_id)` tuples, ordered by the expiration
+        time. Pass the last tuple of the previous page as `after` to read the
+        next page.
+        """
+        await self.setup()
+
+        def get_expired_guests_txn(txn: LoggingTransaction) -> List[Tuple[int, str]]:
+            sql = """
+            SELECT expires_ts, user_id
+            FROM guest_module_guests
+            WHERE state IN (?, ?)
+            AND expires_ts < ?
+            """
+            args: List[Union[int, str]] = [
+                GuestState.ACTIVE,
+                GuestState.POOLED,
+                now_ts,
+            ]
+
+            # continue after the last user of the previous page
+            if after is not None:
+                sql += " AND (expires_ts > ? OR (expires_ts = ? AND user_id > ?))"
+                args.extend([after[0], after[0], after[1]])
+
+            sql += " ORDER BY expires_ts, user_id LIMIT ?"
+            args.append(limit)
+
+            txn.execute(sql, args)
+
+            return [(row[0], row[1]) for row in txn.fetchall()]
+
+        return await self._api.run_db_interaction(
+            "guest_module_get_expired_guests",
+            get_expired_guests_txn,
+        )
+
+    async def get_expired_backlog(self, now_ts: int) -> Tuple[int, Optional[int]]:
+        """Return the number of guest users that expired before `now_ts` but
+        are not deactivated yet, and the expiration time of the oldest of them.
+        Guest users whose deactivation is parked are not counted. Only the
+        index entries of these users are read, so the deactivated guest users
+        don't slow down the query.
+        """
+        await self.setup()
+
+        def get_expired_backlog_txn(
+            txn: LoggingTransaction,
+        ) -> Tuple[int, Optional[int]]:
+            txn.execute(
+                """
+                SELECT COUNT(*), MIN(expires_ts)
+                FROM guest_module_guests
+                WHERE state IN (?, ?, ?)
+                AND expires_ts < ?
+                """,
+                (GuestState.ACTIVE, GuestState.POOLED, GuestState.EXPIRED, now_ts),
+            )
+            row = txn.fetchone()
+            if row is None or row[1] is None:
+                return 0, None
+
+            return int(row[0]), int(row[1])
+
+        return await self._api.run_db_interaction(
+            "guest_module_get_expired_backlog",
+            get_expired_backlog_txn,
+        )
+
+    async def get_next_expiry(self, after_ts: int) -> Optional[int]:
+        """Return the earliest expiration time of an active or pooled guest user
+        that doesn't expire before `after_ts`, or `None` if there is no such
+        user.
+        """
+        await self.setup()
+
+        def get_next_expiry_txn(txn: LoggingTransaction) -> Optional[int]:
+            txn.execute(
+                """
+                SELECT MIN(expires_ts)
+                FROM guest_module_guests
+                WHERE state IN (?, ?)
+                AND expires_ts >= ?
+                """,
+                (GuestState.ACTIVE, GuestState.POOLED, after_ts),
+            )
+            row = txn.fetchone()
+
+            return None if row is None or row[0] is None else int(row[0])
+
+        return await self._api.run_db_interaction(
+            "guest_module_get_next_expiry",
+            get_next_expiry_txn,
+        )
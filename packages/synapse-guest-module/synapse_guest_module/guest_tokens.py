@@ -0,0 +1,107 @@
+# Copyright 2023 Nordeck IT + Consulting GmbH
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import logging
+import time
+from typing import Optional
+
+import attr
+from synapse.module_api import ModuleApi
+
+from synapse_guest_module.config import GuestModuleConfig
+
+logger = logging.getLogger("synapse.contrib." + __name__)
+
+
+@attr.s(frozen=True, auto_attribs=True)
+class GuestSession:
+    device_id: str
+    access_token: str
+    access_token_expires_ts: Optional[int] = None
+    refresh_token: Optional[str] = None
+
+
+class GuestTokenIssuer:
+    """Creates the devices and access tokens of guest users. If
+    `guest_access_token_lifetime_seconds` is set, the access tokens expire
+    after that time and come with a refresh token. A refreshed session can't
+    outlive the guest user, so guests lose access when they expire, even if the
+    reaper didn't deactivate them yet.
+    """
+
+    def __init__(self, api: ModuleApi, config: GuestModuleConfig):
+        self._api = api
+        self._config = config
+
+        # The module API doesn't support refresh tokens or custom lifetimes
+        if self.enabled:
+            self._device_handler = api._hs.get_device_handler()
+            self._auth_handler = api._hs.get_auth_handler()
+
+            if api._hs.config.registration.refreshable_access_token_lifetime is None:
+                logger.warning(
+                    "Guest access tokens expire, but the refresh endpoint is "
+                    "disabled because 'refreshable_access_token_lifetime' is not "
+                    "set in the homeserver configuration"
+                )
+
+    @property
+    def enabled(self) -> bool:
+        return self._config.guest_access_token_lifetime_seconds > 0
+
+    async def register_device(
+        self, user_id: str, session_expires_ts: int
+    ) -> GuestSession:
+        """Create a new device for the guest user with an access token. The
+        session ends at `session_expires_ts` at the latest.
+        """
+        if not self.enabled:
+            device_id, access_token, _, _ = await self._api.register_device(user_id)
+            return GuestSession(device_id, access_token)
+
+        device_id = await self._device_handler.check_device_registered(user_id, None)
+
+        return await self.issue_tokens(user_id, device_id, session_expires_ts)
+
+    async def issue_tokens(
+        self, user_id: str, device_id: str, session_expires_ts: int
+    ) -> GuestSession:
+        """Create an expiring access token and a refresh token for an existing
+        device of the guest user.
+        """
+        access_token_expires_ts = min(
+            int(time.time() * 1000)
+            + self._config.guest_access_token_lifetime_seconds * 1000,
+            session_expires_ts,
+        )
+
+        (
+            refresh_token,
+            refresh_token_id,
+        ) = await self._auth_handler.create_refresh_token_for_user_id(
+            user_id,
+            device_id=device_id,
+            expiry_ts=None,
+            ultimate_session_expiry_ts=session_expires_ts,
+        )
+        access_token = await self._auth_handler.create_access_token_for_user_id(
+            user_id,
+            device_id=device_id,
+            valid_until_ms=access_token_expires_ts,
+            refresh_token_id=refresh_token_id,
+        )
+
+        return GuestSession(
+            device_id, access_token, access_token_expires_ts, refresh_token
+        )
@@ -13,94 +13,547 @@
 # limitations under the License.
 
 import logging
+import math
 import time
-from typing import List
+from typing import Awaitable, Callable, FrozenSet, List, Optional, Set, Tuple
 
+import attr
+from synapse.api.errors import HttpResponseException
+from synapse.logging.context import make_deferred_yieldable, run_in_background
 from synapse.module_api import DatabasePool, LoggingTransaction, ModuleApi
+from synapse.types import create_requester
+from synapse.util.async_helpers import ObservableDeferred, concurrently_execute
+from twisted.internet import defer
 
 from synapse_guest_module.config import GuestModuleConfig
+from synapse_guest_module.deactivation_queue import DeactivationQueue
+from synapse_guest_module.guest_purger import GuestPurger
+from synapse_guest_module.guest_registry import GuestRegistry
+from synapse_guest_module.media_reclaimer import GuestMedia, GuestMediaReclaimer
+from synapse_guest_module.metrics import (
+    reaper_backlog,
+    reaper_cycle_time,
+    reaper_deactivation_rate,
+    reaper_deactivations,
+    reaper_media,
+    reaper_media_reclaimed_bytes,
+    reaper_oldest_expired_age,
+    reaper_parked,
+    reaper_purgeable,
+    reaper_purged,
+    reaper_queue_size,
+)
+from synapse_guest_module.reaper_lease import ReaperLease
+from synapse_guest_module.throughput import RatePacer, RoomLeaveLimiter
+from synapse_guest_module.tracing import CallTracer, set_tag
 
 logger = logging.getLogger("synapse.contrib." + __name__)
 
+# The time after which the reaper runs again after an error
+RETRY_INTERVAL_MS = 60 * 1000
+
+
+@attr.s(auto_attribs=True)
+class DeactivationSummary:
+    """The outcome of a single reaper cycle."""
+
+    succeeded: int = 0
+    failed: int = 0
+    postponed: int = 0
+
+
+@attr.s(auto_attribs=True)
+class MediaSummary:
+    """The outcome of the media cleanup of a single reaper cycle."""
+
+    reclaimed: int = 0
+    reclaimed_bytes: int = 0
+    failed: int = 0
+
 
 class GuestUserReaper:
-    def __init__(self, api: ModuleApi, config: GuestModuleConfig):
+    def __init__(
+        self,
+        api: ModuleApi,
+        config: GuestModuleConfig,
+        registry: GuestRegistry,
+    ):
         self._api = api
         self._config = config
+        self._registry = registry
         self.reaper_user = f"{config.user_id_prefix}reaper"
+        self.tracer = CallTracer(config.slow_call_threshold_ms)
+        self.lease = ReaperLease(api, config, registry)
+        self.queue = DeactivationQueue(api, config, registry)
+        self.media = GuestMediaReclaimer(api, config, registry)
+        self.purger = GuestPurger(api, config, registry)
+        self._pacer = RatePacer(api, config.reaper_deactivations_per_second)
+        self._room_leave_limiter = RoomLeaveLimiter(
+            config.reaper_room_leave_limit, config.reaper_room_leave_window_seconds
+        )
+        # mypy doesn't understand the @cached descriptor of the store method
+        self._get_rooms_for_user: Callable[[str], Awaitable[FrozenSet[str]]]
+        if self._room_leave_limiter.enabled:
+            store = api._hs.get_datastores().main
+            self._get_rooms_for_user = store.get_rooms_for_user  # type: ignore[assignment]
+
+        self._next_cycle_ts = 0
+        self._admin_token: Optional[str] = None
+        self._admin_token_refresh: Optional["ObservableDeferred[str]"] = None
+        self._deadline_ts: Optional[int] = None
+        self._wakeup: Optional["defer.Deferred[None]"] = None
+        registry.add_expiry_listener(self.notify_guest_expiry)
+
+        if config.reaper_deactivation_mode == "in_process":
+            self._deactivate_account_handler = api._hs.get_deactivate_account_handler()
 
     async def run(self) -> None:
         logger.info("User cleanup job started")
 
-        await self._api.sleep(5.0)  # Wait for Synapse to start properly
+        if self._config.reaper_deactivation_mode == "admin_api":
+            await self._api.sleep(5.0)  # Wait for Synapse to start properly
 
         while True:
-            logger.debug("Run deactivation loop")
-
             try:
-                await self.deactivate_expired_guest_users()
+                wake_up_ts = await self.run_step()
             except Exception as e:
                 logger.error("Error in the user deactivation: %s", e)
+                self._next_cycle_ts = int(time.time() * 1000) + RETRY_INTERVAL_MS
+                wake_up_ts = int(time.time() * 1000) + min(
+                    RETRY_INTERVAL_MS, self.lease.renew_interval_ms
+                )
 
-            await self._api.sleep(60.0)
+            await self._sleep_until(wake_up_ts)
 
-    async def deactivate_expired_guest_users(self) -> None:
-        """Deactivate all users that are older than the specified expiration
-        interval. This uses the admin API to disable the user.
+    async def run_step(self) -> int:
+        """Acquire or renew the reaper lease and run a cycle if one is due.
+        Returns the time (in ms) when the next step should run, which is
+        early enough to renew the lease in time.
         """
+        if not await self.lease.acquire():
+            # Another worker runs the reaper. Run a cycle right away if the
+            # lease is taken over.
+            self._next_cycle_ts = 0
+            return int(time.time() * 1000) + self.lease.renew_interval_ms
 
-        def get_expired_users(txn: LoggingTransaction) -> List[str]:
-            sql = """
-            SELECT name
-            FROM users
-            WHERE name != ?
-            AND name LIKE ?
-            AND deactivated = 0
-            AND creation_ts < ?;
-            """
-
-            # date operations are database-specific (postgres, sqlite, ...)
-            expire_ts_seconds = int(time.time() - self._config.user_expiration_seconds)
-            txn.execute(
-                sql,
-                (
-                    self._api.get_qualified_user_id(self.reaper_user),
-                    f"@{self._config.user_id_prefix}%:{self._api.server_name}",
-                    expire_ts_seconds,
-                ),
-            )
-            expired_users_rows = txn.fetchall()
+        if self._next_cycle_ts <= int(time.time() * 1000):
+            logger.debug("Run deactivation loop")
+            self._next_cycle_ts = await self.run_cycle()
 
-            return [row[0] for row in expired_users_rows]
+        return min(
+            self._next_cycle_ts,
+            int(time.time() * 1000) + self.lease.renew_interval_ms,
+        )
 
-        expired_users: List[str] = await self._api.run_db_interaction(
-            "guest_module_get_expired_users",
-            get_expired_users,
+    async def run_cycle(self) -> int:
+        """Deactivate all expired users and return the time (in ms) when the
+        next cycle should run. This is the expiration time of the next guest
+        user or the next retry of a failed deactivation, or now if more guest
+        users expired while the cycle was running.
+        """
+        with reaper_cycle_time.time(), self.tracer.span("reaper.cycle", log_slow=False):
+            return await self._run_cycle()
+
+    async def _run_cycle(self) -> int:
+        cycle_start_ts = int(time.time() * 1000)
+
+        backlog, oldest_expires_ts = await self._registry.get_expired_backlog(
+            cycle_start_ts
+        )
+        reaper_backlog.set(backlog)
+        set_tag("backlog", backlog)
+        reaper_oldest_expired_age.set(
+            0
+            if oldest_expires_ts is None
+            else (cycle_start_ts - oldest_expires_ts) / 1000
+        )
+        reaper_parked.set(await self.queue.count_parked())
+
+        await self.deactivate_expired_guest_users()
+
+        if self.media.enabled:
+            if self.media.can_reclaim:
+                await self.reclaim_guest_media()
+            else:
+                logger.warning(
+                    "Skipping the media cleanup, because this process has no media store. Set 'reaper_worker_name' to the media repository worker."
+                )
+
+        if self.purger.enabled:
+            await self.purge_deactivated_guest_users()
+
+        next_expiry_ts = await self._registry.get_next_expiry(cycle_start_ts)
+
+        # Every guest user that is registered from now on expires after the
+        # configured expiration time, so there is no need to wake up earlier.
+        deadline_ts = (
+            int(time.time() * 1000) + self._config.user_expiration_seconds * 1000
         )
+        if next_expiry_ts is not None:
+            deadline_ts = min(deadline_ts, next_expiry_ts)
+
+        # Retry failed deactivations
+        next_attempt_ts = await self.queue.get_next_attempt()
+        if next_attempt_ts is not None:
+            deadline_ts = min(deadline_ts, next_attempt_ts)
+
+        return deadline_ts
+
+    def notify_guest_expiry(self, expires_ts: int) -> None:
+        """Is called when a guest user is registered. Wakes the reaper up if
+        the user expires before the next planned cycle.
+        """
+        self._next_cycle_ts = min(self._next_cycle_ts, expires_ts)
+
+        if self._deadline_ts is not None and expires_ts < self._deadline_ts:
+            self._deadline_ts = expires_ts
+            self._api.delayed_background_call(
+                0, self._wake_up, desc="guest_module_reaper_wake_up"
+            )
 
-        if len(expired_users) > 0:
-            logger.info("Deactivate %d users", len(expired_users))
+    async def _sleep_until(self, deadline_ts: int) -> None:
+        """Sleep until `deadline_ts` (in ms), or until an earlier deadline is
+        set by `notify_guest_expiry`.
+        """
+        self._deadline_ts = deadline_ts
 
-            token = await self.get_admin_token()
+        try:
+            while True:
+                delay_ms = self._deadline_ts - int(time.time() * 1000)
+                if delay_ms <= 0:
+                    return
 
-            for user_id in expired_users:
-                logger.debug("Deactivate user %s", user_id)
+                logger.debug("Next deactivation loop in %d ms", delay_ms)
 
-                url = f"http://localhost:8008/_synapse/admin/v1/deactivate/{user_id}"
+                self._wakeup = defer.Deferred()
+                delayed_call = self._api.delayed_background_call(
+                    delay_ms, self._wake_up, desc="guest_module_reaper_wake_up"
+                )
 
                 try:
-                    await self._api.http_client.post_json_get_json(
-                        uri=url,
-                        post_json={},
-                        headers={"Authorization": ["Bearer {}".format(token)]},
+                    await make_deferred_yieldable(self._wakeup)
+                finally:
+                    if delayed_call.active():  # type: ignore[misc]
+                        delayed_call.cancel()  # type: ignore[misc]
+        finally:
+            self._deadline_ts = None
+            self._wakeup = None
+
+    def _wake_up(self) -> None:
+        if self._wakeup is not None and not self._wakeup.called:
+            self._wakeup.callback(None)
+
+    async def deactivate_expired_guest_users(self) -> DeactivationSummary:
+        """Deactivate all users that are older than the specified expiration
+        interval. The expired users are read from the guest registry in pages
+        of `reaper_batch_size` users, locked and added to the deactivation
+        queue. Then the due jobs of the queue are processed in batches of the
+        same size.
+        Up to `reaper_max_concurrency` users are deactivated at the same time,
+        a failure only affects the user it belongs to and is retried later.
+        """
+        now_ts = int(time.time() * 1000)
+
+        summary = DeactivationSummary()
+        token: Optional[str] = None
+        deactivated_users: List[str] = []
+        failed_users: List[Tuple[str, str]] = []
+        postponed_users: List[Tuple[str, int]] = []
+
+        async def deactivate_user(user_id: str) -> None:
+            nonlocal token
+
+            # Stop if another worker took over the lease during a slow cycle,
+            # the job stays in the queue.
+            if not await self.lease.renew_if_due():
+                return
+
+            # Postpone the deactivation if one of the rooms of the user had
+            # too many leave events recently.
+            if self._room_leave_limiter.enabled:
+                room_ids = await self._get_rooms_for_user(user_id)
+                retry_after = self._room_leave_limiter.acquire(room_ids)
+                if retry_after > 0:
+                    postponed_users.append(
+                        (
+                            user_id,
+                            int(time.time() * 1000) + math.ceil(retry_after * 1000),
+                        )
                     )
+                    summary.postponed += 1
+                    return
+
+            await self._pacer.wait()
+
+            logger.debug("Deactivate user %s", user_id)
+
+            with self.tracer.span("reaper.deactivate_user", user_id=user_id):
+                try:
+                    try:
+                        await self.deactivate_user(user_id, token)
+                    except HttpResponseException as e:
+                        if e.code != 401:
+                            raise
+
+                        # The admin token was rejected, e.g. because it was
+                        # invalidated. Create a new one and try again once.
+                        token = await self.refresh_admin_token(token)
+                        await self.deactivate_user(user_id, token)
+
+                    deactivated_users.append(user_id)
+                    summary.succeeded += 1
+                    reaper_deactivations.labels("succeeded").inc()
+                    set_tag("outcome", "succeeded")
                 except Exception as e:
+                    failed_users.append((user_id, str(e)))
+                    summary.failed += 1
+                    reaper_deactivations.labels("failed").inc()
+                    set_tag("outcome", "failed")
                     logger.error('Failed to delete user "%s": %s', user_id, e)
 
+        await self.enqueue_expired_guest_users(now_ts)
+
+        is_first_batch = True
+        while True:
+            # Stop if another worker took over the lease during a long cycle
+            if not is_first_batch:
+                if not await self.lease.acquire():
+                    break
+
+                # Lock out guest users that expired during a long cycle
+                await self.enqueue_expired_guest_users(int(time.time() * 1000))
+
+            is_first_batch = False
+
+            # Failed jobs are scheduled after now, so they are not read again
+            user_ids = await self.queue.get_due_jobs(
+                now_ts, self._config.reaper_batch_size
+            )
+
+            if len(user_ids) == 0:
+                break
+
+            logger.info("Deactivate %d users", len(user_ids))
+
+            if token is None and self._config.reaper_deactivation_mode == "admin_api":
+                token = await self.get_admin_token()
+
+            with self.tracer.span(
+                "reaper.batch", log_slow=False, batch_size=len(user_ids)
+            ):
+                await concurrently_execute(
+                    deactivate_user,
+                    user_ids,
+                    self._config.reaper_max_concurrency,
+                )
+
+                await self.queue.complete(deactivated_users)
+                if self.media.enabled:
+                    await self.media.enqueue(deactivated_users)
+                await self.queue.fail(failed_users, int(time.time() * 1000))
+                await self.queue.postpone(postponed_users)
+            deactivated_users.clear()
+            failed_users.clear()
+            postponed_users.clear()
+
+            if len(user_ids) < self._config.reaper_batch_size:
+                break
+
+        self._room_leave_limiter.prune()
+
+        if summary.succeeded > 0 or summary.failed > 0 or summary.postponed > 0:
+            duration_seconds = max(time.time() - now_ts / 1000, 0.001)
+            rate = summary.succeeded / duration_seconds
+            remaining = await self.queue.count_pending()
+
+            reaper_deactivation_rate.set(rate)
+            reaper_queue_size.set(remaining)
+
+            logger.info(
+                "Deactivated %d users (%.1f/s), %d failed, %d postponed, %d remaining",
+                summary.succeeded,
+                rate,
+                summary.failed,
+                summary.postponed,
+                remaining,
+            )
+
+        return summary
+
+    async def reclaim_guest_media(self) -> MediaSummary:
+        """Delete or quarantine the media of the deactivated guest users. The
+        media is read in pages of `reaper_batch_size` media, and up to
+        `reaper_max_concurrency` media are reclaimed at the same time, at most
+        `reaper_media_per_second` per second. Media that failed is retried in
+        the next cycle, until its user is parked after `reaper_max_attempts`
+        cycles.
+        """
+        start_ts = int(time.time() * 1000)
+        summary = MediaSummary()
+        failed_users: Set[str] = set()
+        after: Optional[Tuple[str, str]] = None
+        action = (
+            "deleted"
+            if self._config.reaper_media_cleanup == "delete"
+            else "quarantined"
+        )
+
+        async def reclaim(media: GuestMedia) -> None:
+            # Stop if another worker took over the lease during a slow cycle
+            if not await self.lease.renew_if_due():
+                return
+
+            try:
+                if await self.media.reclaim(media):
+                    summary.reclaimed += 1
+                    summary.reclaimed_bytes += media.media_length
+                    reaper_media.labels(action).inc()
+            except Exception as e:
+                summary.failed += 1
+                failed_users.add(media.user_id)
+                reaper_media.labels("failed").inc()
+                logger.error(
+                    'Failed to reclaim media "%s" of user "%s": %s',
+                    media.media_id,
+                    media.user_id,
+                    e,
+                )
+
+        while True:
+            if not await self.lease.renew_if_due():
+                break
+
+            with self.tracer.span("reaper.media_batch", log_slow=False):
+                media = await self.media.get_media(
+                    after, self._config.reaper_batch_size
+                )
+                set_tag("batch_size", len(media))
+
+                await concurrently_execute(
+                    reclaim, media, self._config.reaper_max_concurrency
+                )
+
+            if len(media) < self._config.reaper_batch_size:
+                break
+
+            after = (media[-1].user_id, media[-1].media_id)
+
+        await self.media.fail(sorted(failed_users))
+        await self.media.prune()
+
+        reaper_media_reclaimed_bytes.set(summary.reclaimed_bytes)
+
+        if summary.reclaimed > 0 or summary.failed > 0:
+            logger.info(
+                "Reclaimed %d bytes of %d media (%s) in %.1f s, %d failed",
+                summary.reclaimed_bytes,
+                summary.reclaimed,
+                action,
+                (int(time.time() * 1000) - start_ts) / 1000,
+                summary.failed,
+            )
+
+        return summary
+
+    async def purge_deactivated_guest_users(self) -> int:
+        """Purge the remaining data of the guest users that were deactivated
+        more than `reaper_purge_after_seconds` ago, in batches of
+        `reaper_purge_batch_size` users, and return their number. With
+        `reaper_purge_dry_run`, the users are only counted.
+        """
+        start_ts = int(time.time() * 1000)
+        before_ts = self.purger.get_purge_before_ts(start_ts)
+
+        purgeable = await self.purger.count_purgeable(before_ts)
+        reaper_purgeable.set(purgeable)
+
+        if self._config.reaper_purge_dry_run:
+            if purgeable > 0:
+                logger.info(
+                    "Dry run: %d deactivated guest users can be purged", purgeable
+                )
+            return 0
+
+        purged = 0
+        while purged < purgeable:
+            # Stop if another worker took over the lease during a long purge
+            if not await self.lease.renew_if_due():
+                break
+
+            with self.tracer.span("reaper.purge_batch", log_slow=False):
+                user_ids = await self.purger.purge(before_ts)
+                set_tag("batch_size", len(user_ids))
+
+            purged += len(user_ids)
+            reaper_purged.inc(len(user_ids))
+
+            if len(user_ids) < self._config.reaper_purge_batch_size:
+                break
+
+        if purged > 0:
+            logger.info(
+                "Purged %d deactivated guest users in %.1f s",
+                purged,
+                (int(time.time() * 1000) - start_ts) / 1000,
+            )
+
+        return purged
+
+    async def enqueue_expired_guest_users(self, now_ts: int) -> None:
+        """Move all guest users that expired before `now_ts` from the registry
+        into the deactivation queue, in pages of `reaper_batch_size` users.
+        This locks the users, so they can't use the homeserver anymore.
+        """
+        after: Optional[Tuple[int, str]] = None
+
+        while True:
+            with self.tracer.span("reaper.enqueue"):
+                expired_users = await self._registry.get_expired_guests(
+                    now_ts, after, self._config.reaper_batch_size
+                )
+                set_tag("batch_size", len(expired_users))
+
+                await self.queue.enqueue(
+                    [user_id for _, user_id in expired_users],
+                    now_ts,
+                )
+
+            if len(expired_users) < self._config.reaper_batch_size:
+                break
+
+            after = expired_users[-1]
+
+    async def deactivate_user(self, user_id: str, token: Optional[str]) -> None:
+        """Deactivate a single user. In the `in_process` mode, the deactivation
+        handler of the homeserver is called directly. In the `admin_api` mode,
+        the admin API is called with the given access `token`.
+        """
+        if self._config.reaper_deactivation_mode == "in_process":
+            await self._deactivate_account_handler.deactivate_account(
+                user_id,
+                erase_data=False,
+                requester=create_requester(
+                    self._api.get_qualified_user_id(self.reaper_user)
+                ),
+                by_admin=True,
+            )
+            return
+
+        url = f"{self._config.reaper_admin_api_url}/_synapse/admin/v1/deactivate/{user_id}"
+
+        await self._api.http_client.post_json_get_json(
+            uri=url,
+            post_json={},
+            headers={"Authorization": ["Bearer {}".format(token)]},
+        )
+
     async def get_admin_token(self) -> str:
-        """Create a new admin user in synapse so the module can call the admin
-        api. If no user or login session exists, we create new ones.
+        """Return the access token of the admin user that is used to call the
+        admin API. The token is kept in memory, it is only read from the
+        database or created if it is not known yet.
         """
+        if self._admin_token is not None:
+            return self._admin_token
 
         def get_access_token_txn(txn: LoggingTransaction) -> str | None:
             tokens = DatabasePool.simple_select_onecol_txn(
@@ -123,8 +576,49 @@ class GuestUserReaper:
         )
 
         if token is not None:
+            self._admin_token = token
             return token
 
+        return await self.refresh_admin_token(None)
+
+    async def refresh_admin_token(self, rejected_token: Optional[str]) -> str:
+        """Replace the `rejected_token` with a new access token. Concurrent
+        callers share a single refresh, and a token that was already replaced
+        is not replaced again.
+        """
+        if self._admin_token is not None and self._admin_token != rejected_token:
+            return self._admin_token
+
+        if self._admin_token_refresh is None:
+            self._admin_token = None
+
+            async def refresh() -> str:
+                try:
+                    with self.tracer.span("reaper.refresh_admin_token"):
+                        self._admin_token = await self._create_admin_token()
+                    return self._admin_token
+                finally:
+                    self._admin_token_refresh = None
+
+            # The refresh runs in its own logcontext, so it doesn't end in the
+            # logcontext of the first caller. A refresh that completed right
+            # away is not kept.
+            admin_token_refresh = ObservableDeferred(
+                run_in_background(refresh), consumeErrors=True
+            )
+            if not admin_token_refresh.has_called():
+                self._admin_token_refresh = admin_token_refresh
+
+            return await make_deferred_yieldable(admin_token_refresh.observe())
+
+        return await make_deferred_yieldable(self._admin_token_refresh.observe())
+
+    async def _create_admin_token(self) -> str:
+        """Create a new admin user in synapse so the module can call the admin
+        api. If no user exists, we create a new one. The new login session
+        replaces all other sessions of the user, so only a single access token
+        of the admin user exists.
+        """
         if not await self._api.check_user_exists(self.reaper_user):
             logger.info(
                 'Register new administrator user "%s"',
@@ -135,8 +629,18 @@ class GuestUserReaper:
 
         logger.info('Register new device for administrator user "%s"', self.reaper_user)
 
-        _, access_token, _, _ = await self._api.register_device(
-            self._api.get_qualified_user_id(self.reaper_user)
-        )
+        reaper_user_id = self._api.get_qualified_user_id(self.reaper_user)
+        device_id, access_token, _, _ = await self._api.register_device(reaper_user_id)
+
+        try:
+            await self._api._hs.get_device_handler().delete_all_devices_for_user(
+                reaper_user_id, except_device_id=device_id
+            )
+        except Exception as e:
+            logger.warning(
+                'Failed to delete old devices of administrator user "%s": %s',
+                self.reaper_user,
+                e,
+            )
 
         return access_token
@@ -0,0 +1,106 @@
+# Copyright 2023 Nordeck IT + Consulting GmbH
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import time
+from collections import OrderedDict
+from typing import Any, Awaitable, Callable, Dict, Optional, Tuple
+
+from synapse.logging.context import make_deferred_yieldable, run_in_background
+from synapse.util.async_helpers import ObservableDeferred
+
+# The status, the body and the headers of a response
+Response = Tuple[int, Dict[str, Any], Dict[str, str]]
+
+
+class IdempotencyCache:
+    """Remembers the successful responses of requests by their idempotency
+    key, so a retried request gets the original response. A request whose key
+    is still in flight waits for the first request instead of being handled
+    again. The cache holds up to `max_size` responses and evicts the least
+    recently used one when it is full. Responses expire after `ttl_seconds`.
+    The headers are part of the response, so every request that gets it
+    also gets headers like `Retry-After`. A `max_size` of `0` disables the
+    cache.
+    """
+
+    def __init__(self, max_size: int, ttl_seconds: int):
+        self._max_size = max_size
+        self._ttl_seconds = ttl_seconds
+
+        # key -> (response, time when the entry was added)
+        self._responses: "OrderedDict[str, Tuple[Response, float]]" = OrderedDict()
+        self._in_flight: Dict[str, "ObservableDeferred[Response]"] = {}
+
+    def __len__(self) -> int:
+        return len(self._responses)
+
+    @property
+    def enabled(self) -> bool:
+        return self._max_size > 0
+
+    async def run(
+        self, key: str, handler: Callable[[], Awaitable[Response]]
+    ) -> Tuple[Response, bool]:
+        """Return the response of the request with the `key` and whether it
+        was replayed. The `handler` is only called if the key is neither
+        cached nor in flight. Responses with an error status are not cached,
+        so the request can be retried.
+        """
+        response = self._get(key)
+        if response is not None:
+            return response, True
+
+        in_flight = self._in_flight.get(key)
+        if in_flight is not None:
+            return await make_deferred_yieldable(in_flight.observe()), True
+
+        async def handle() -> Response:
+            try:
+                response = await handler()
+                if response[0] < 400:
+                    self._set(key, response)
+                return response
+            finally:
+                self._in_flight.pop(key, None)
+
+        # The handler runs in the logcontext of the first request, and every
+        # request waits for it without losing its own logcontext.
+        in_flight = ObservableDeferred(run_in_background(handle), consumeErrors=True)
+        if not in_flight.has_called():
+            self._in_flight[key] = in_flight
+
+        return await make_deferred_yieldable(in_flight.observe()), False
+
+    def _get(self, key: str) -> Optional[Response]:
+        entry = self._responses.get(key)
+        if entry is None:
+            return None
+
+        response, added_at = entry
+        if time.monotonic() - added_at > self._ttl_seconds:
+            del self._responses[key]
+            return None
+
+        self._responses.move_to_end(key)
+        return response
+
+    def _set(self, key: str, response: Response) -> None:
+        if self._max_size <= 0:
+            return
+
+        self._responses[key] = (response, time.monotonic())
+        self._responses.move_to_end(key)
+
+        while len(self._responses) > self._max_size:
+            self._responses.popitem(last=False)
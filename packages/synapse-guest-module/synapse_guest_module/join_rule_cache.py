@@ -0,0 +1,66 @@
+# Copyright 2023 Nordeck IT + Consulting GmbH
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import time
+from collections import OrderedDict
+from typing import Optional, Tuple
+
+
+class JoinRuleCache:
+    """Remembers whether a room is an Ask to Join (knock) room. The cache holds
+    up to `max_size` rooms and evicts the least recently used room when it is
+    full. Entries expire after `ttl_seconds`, so rooms are read again from the
+    storage even if a change of the join rule was missed.
+    """
+
+    def __init__(self, max_size: int, ttl_seconds: int):
+        self._max_size = max_size
+        self._ttl_seconds = ttl_seconds
+
+        # room_id -> (is_knock, time when the entry was added)
+        self._rooms: "OrderedDict[str, Tuple[bool, float]]" = OrderedDict()
+
+    def __len__(self) -> int:
+        return len(self._rooms)
+
+    @property
+    def enabled(self) -> bool:
+        return self._max_size > 0
+
+    def get(self, room_id: str) -> Optional[bool]:
+        """Return whether the room is a knock room, or `None` if the room is
+        not known.
+        """
+        entry = self._rooms.get(room_id)
+        if entry is None:
+            return None
+
+        is_knock, added_at = entry
+        if time.monotonic() - added_at > self._ttl_seconds:
+            del self._rooms[room_id]
+            return None
+
+        self._rooms.move_to_end(room_id)
+        return is_knock
+
+    def set(self, room_id: str, join_rule: str) -> None:
+        """Store the join rule of the room."""
+        if self._max_size <= 0:
+            return
+
+        self._rooms[room_id] = (join_rule.startswith("knock"), time.monotonic())
+        self._rooms.move_to_end(room_id)
+
+        while len(self._rooms) > self._max_size:
+            self._rooms.popitem(last=False)
@@ -0,0 +1,73 @@
+# Copyright 2023 Nordeck IT + Consulting GmbH
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from collections import OrderedDict
+from typing import Iterable, Set
+
+
+class JoinedRoomCounter:
+    """Remembers the rooms that each guest user joined, so the number of rooms
+    of a user can be checked against `max_rooms` without the storage. The
+    rooms of a user are loaded once and then kept up to date with the
+    membership events. The rooms of up to `max_users` users are kept, the
+    least recently seen user is forgotten first. A `max_rooms` of `0`
+    disables the limit.
+    """
+
+    def __init__(self, max_rooms: int, max_users: int):
+        self._max_rooms = max_rooms
+        self._max_users = max_users
+
+        # user_id -> joined room ids
+        self._rooms: "OrderedDict[str, Set[str]]" = OrderedDict()
+
+    def __len__(self) -> int:
+        return len(self._rooms)
+
+    @property
+    def enabled(self) -> bool:
+        return self._max_rooms > 0
+
+    def is_known(self, user_id: str) -> bool:
+        return user_id in self._rooms
+
+    def load(self, user_id: str, room_ids: Iterable[str]) -> None:
+        """Store the rooms that the user joined, e.g. as read from the
+        storage.
+        """
+        self._rooms[user_id] = set(room_ids)
+        self._rooms.move_to_end(user_id)
+
+        while len(self._rooms) > self._max_users:
+            self._rooms.popitem(last=False)
+
+    def may_join(self, user_id: str, room_id: str) -> bool:
+        """Return whether the user may join the room without exceeding the
+        limit. Rejoining a room of the user is always allowed.
+        """
+        rooms = self._rooms.get(user_id, set())
+        return room_id in rooms or len(rooms) < self._max_rooms
+
+    def join(self, user_id: str, room_id: str) -> None:
+        """Add the room to the rooms of a known user."""
+        rooms = self._rooms.get(user_id)
+        if rooms is not None:
+            rooms.add(room_id)
+            self._rooms.move_to_end(user_id)
+
+    def leave(self, user_id: str, room_id: str) -> None:
+        """Remove the room from the rooms of a known user."""
+        rooms = self._rooms.get(user_id)
+        if rooms is not None:
+            rooms.discard(room_id)
@@ -0,0 +1,289 @@
+# Copyright 2023 Nordeck IT + Consulting GmbH
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import logging
+from typing import List, Optional, Tuple, Union
+
+import attr
+from synapse.module_api import LoggingTransaction, ModuleApi
+
+from synapse_guest_module.config import GuestModuleConfig
+from synapse_guest_module.deactivation_queue import JobState
+from synapse_guest_module.guest_registry import GuestRegistry, GuestState
+from synapse_guest_module.throughput import RatePacer
+
+logger = logging.getLogger("synapse.contrib." + __name__)
+
+
+@attr.s(frozen=True, auto_attribs=True)
+class GuestMedia:
+    user_id: str
+    media_id: str
+    media_length: int
+
+
+class GuestMediaReclaimer:
+    """Deletes or quarantines the media that was uploaded by deactivated guest
+    users, depending on `reaper_media_cleanup`. The users whose media still
+    has to be reclaimed are stored in a table that is owned by the module, so
+    the media repository is only searched for the media of these users. Media
+    that an admin protected from quarantine is never touched. Users whose
+    media failed in `reaper_max_attempts` cycles are parked and no longer
+    retried.
+    """
+
+    def __init__(
+        self,
+        api: ModuleApi,
+        config: GuestModuleConfig,
+        registry: GuestRegistry,
+    ):
+        self._api = api
+        self._config = config
+        self._registry = registry
+        self._pacer = RatePacer(api, config.reaper_media_per_second)
+        self._schema_ready = False
+
+    @property
+    def enabled(self) -> bool:
+        return self._config.reaper_media_cleanup != "off"
+
+    @property
+    def can_reclaim(self) -> bool:
+        """Whether this process can reclaim the media. The homeserver only
+        removes a deleted file from the disk on a process that has the media
+        store, other processes would only delete its database rows.
+        """
+        return self._config.reaper_media_cleanup != "delete" or bool(
+            self._api._hs.config.media.can_load_media_repo
+        )
+
+    async def setup(self) -> None:
+        """Add the guest users that were deactivated before the media cleanup
+        was enabled once.
+        """
+        if self._schema_ready:
+            return
+
+        await self._registry.setup()
+
+        def setup_txn(txn: LoggingTransaction) -> None:
+            txn.execute(
+                "SELECT name FROM guest_module_migrations WHERE name = ?",
+                ("backfill_media_cleanup",),
+            )
+            if txn.fetchone() is not None:
+                return
+
+            logger.info("Add deactivated guest users to the media cleanup")
+
+            txn.execute(
+                """
+                INSERT INTO guest_module_media_cleanup (user_id, attempts, state)
+                SELECT user_id, 0, ?
+                FROM guest_module_guests
+                WHERE state = ?
+                ON CONFLICT (user_id) DO NOTHING
+                """,
+                (JobState.PENDING, GuestState.DEACTIVATED),
+            )
+
+            # another worker may run the backfill at the same time
+            txn.execute(
+                """
+                INSERT INTO guest_module_migrations (name)
+                VALUES (?)
+                ON CONFLICT (name) DO NOTHING
+                """,
+                ("backfill_media_cleanup",),
+            )
+
+        await self._api.run_db_interaction(
+            "guest_module_setup_media_cleanup",
+            setup_txn,
+        )
+
+        self._schema_ready = True
+
+    async def enqueue(self, user_ids: List[str]) -> None:
+        """Add the deactivated guest users, so their media is reclaimed."""
+        if len(user_ids) == 0:
+            return
+
+        await self.setup()
+
+        def enqueue_txn(txn: LoggingTransaction) -> None:
+            for user_id in user_ids:
+                txn.execute(
+                    """
+                    INSERT INTO guest_module_media_cleanup (user_id, attempts, state)
+                    VALUES (?, 0, ?)
+                    ON CONFLICT (user_id) DO NOTHING
+                    """,
+                    (user_id, JobState.PENDING),
+                )
+
+        await self._api.run_db_interaction(
+            "guest_module_enqueue_media_cleanup",
+            enqueue_txn,
+        )
+
+    async def get_media(
+        self,
+        after: Optional[Tuple[str, str]],
+        limit: int,
+    ) -> List[GuestMedia]:
+        """Return up to `limit` media of the pending users that still has to
+        be reclaimed, ordered by the user and the media id. Pass the
+        `(user_id, media_id)` of the last media of the previous page as
+        `after` to read the next page.
+        """
+        await self.setup()
+
+        def get_media_txn(txn: LoggingTransaction) -> List[GuestMedia]:
+            sql = f"""
+            SELECT m.user_id, m.media_id, m.media_length
+            FROM guest_module_media_cleanup AS c
+            JOIN local_media_repository AS m ON m.user_id = c.user_id
+            WHERE c.state = ?
+            AND {self._pending_media_clause()}
+            """
+            args: List[Union[bool, int, str]] = [JobState.PENDING, False]
+
+            # continue after the last media of the previous page
+            if after is not None:
+                sql += " AND (m.user_id > ? OR (m.user_id = ? AND m.media_id > ?))"
+                args.extend([after[0], after[0], after[1]])
+
+            sql += " ORDER BY m.user_id, m.media_id LIMIT ?"
+            args.append(limit)
+
+            txn.execute(sql, args)
+
+            return [GuestMedia(row[0], row[1], row[2] or 0) for row in txn.fetchall()]
+
+        return await self._api.run_db_interaction(
+            "guest_module_get_guest_media",
+            get_media_txn,
+        )
+
+    async def reclaim(self, media: GuestMedia) -> bool:
+        """Delete or quarantine a single media, at most
+        `reaper_media_per_second` per second. Returns `False` if the media
+        was already gone.
+        """
+        await self._pacer.wait()
+
+        # The module API doesn't provide functions to delete or quarantine
+        # media, so the media repository and the store are used directly.
+        if self._config.reaper_media_cleanup == "delete":
+            if not self.can_reclaim:
+                raise RuntimeError("This process can't delete media")
+
+            media_repository = self._api._hs.get_media_repository()
+            _, deleted = await media_repository.delete_local_media_ids([media.media_id])
+            return bool(deleted > 0)
+
+        store = self._api._hs.get_datastores().main
+        quarantined = await store.quarantine_media_by_id(
+            self._api.server_name,
+            media.media_id,
+            self._api.get_qualified_user_id(f"{self._config.user_id_prefix}reaper"),
+        )
+        return bool(quarantined > 0)
+
+    async def fail(self, user_ids: List[str]) -> None:
+        """Record a failed cycle for each of the users whose media could not
+        be reclaimed. Users that reached `reaper_max_attempts` are parked.
+        """
+        if len(user_ids) == 0:
+            return
+
+        await self.setup()
+
+        def fail_txn(txn: LoggingTransaction) -> List[str]:
+            parked = []
+
+            for user_id in user_ids:
+                txn.execute(
+                    "SELECT attempts FROM guest_module_media_cleanup WHERE user_id = ?",
+                    (user_id,),
+                )
+                row = txn.fetchone()
+                if row is None:
+                    continue
+
+                attempts = int(row[0]) + 1
+                state = JobState.PENDING
+                if attempts >= self._config.reaper_max_attempts:
+                    state = JobState.PARKED
+                    parked.append(user_id)
+
+                txn.execute(
+                    """
+                    UPDATE guest_module_media_cleanup
+                    SET attempts = ?, state = ?
+                    WHERE user_id = ?
+                    """,
+                    (attempts, state, user_id),
+                )
+
+            return parked
+
+        parked = await self._api.run_db_interaction(
+            "guest_module_fail_media_cleanup",
+            fail_txn,
+        )
+
+        for user_id in parked:
+            logger.warning(
+                'Giving up to reclaim the media of user "%s" after %d attempts',
+                user_id,
+                self._config.reaper_max_attempts,
+            )
+
+    async def prune(self) -> int:
+        """Remove the users without media that still has to be reclaimed and
+        return their number.
+        """
+        await self.setup()
+
+        def prune_txn(txn: LoggingTransaction) -> int:
+            txn.execute(
+                f"""
+                DELETE FROM guest_module_media_cleanup
+                WHERE NOT EXISTS (
+                    SELECT 1
+                    FROM local_media_repository AS m
+                    WHERE m.user_id = guest_module_media_cleanup.user_id
+                    AND {self._pending_media_clause()}
+                )
+                """,
+                (False,),
+            )
+            return int(txn.rowcount)
+
+        return await self._api.run_db_interaction(
+            "guest_module_prune_media_cleanup",
+            prune_txn,
+        )
+
+    def _pending_media_clause(self) -> str:
+        clause = "m.safe_from_quarantine = ?"
+
+        # quarantined media is kept in the media repository
+        if self._config.reaper_media_cleanup == "quarantine":
+            clause += " AND m.quarantined_by IS NULL"
+
+        return clause
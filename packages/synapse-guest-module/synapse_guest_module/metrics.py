@@ -0,0 +1,100 @@
+# Copyright 2023 Nordeck IT + Consulting GmbH
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from prometheus_client import Counter, Gauge, Histogram
+
+# The metrics are registered in the default registry of prometheus_client,
+# which is the registry that Synapse exports at `/_synapse/metrics`.
+
+registration_time = Histogram(
+    "synapse_guest_module_registration_seconds",
+    "Time to handle a guest registration, including the wait for a free slot",
+)
+
+registration_step_time = Histogram(
+    "synapse_guest_module_registration_step_seconds",
+    "Time of the homeserver calls during a guest registration",
+    ["step"],
+)
+
+registrations = Counter(
+    "synapse_guest_module_registrations",
+    "Guest registration requests by outcome",
+    ["outcome"],
+)
+
+reaper_cycle_time = Histogram(
+    "synapse_guest_module_reaper_cycle_seconds",
+    "Time of a single reaper cycle",
+    buckets=(0.1, 0.5, 1.0, 5.0, 10.0, 30.0, 60.0, 300.0, 600.0, 1800.0),
+)
+
+reaper_backlog = Gauge(
+    "synapse_guest_module_reaper_backlog",
+    "Number of expired guest users that are not deactivated yet, at the start of the last reaper cycle",
+)
+
+reaper_oldest_expired_age = Gauge(
+    "synapse_guest_module_reaper_oldest_expired_age_seconds",
+    "Time since the oldest guest user that is not deactivated yet expired, at the start of the last reaper cycle",
+)
+
+reaper_parked = Gauge(
+    "synapse_guest_module_reaper_parked",
+    "Number of guest users whose deactivation was given up after reaper_max_attempts, at the start of the last reaper cycle",
+)
+
+reaper_deactivations = Counter(
+    "synapse_guest_module_reaper_deactivations",
+    "Guest user deactivations by outcome",
+    ["outcome"],
+)
+
+reaper_deactivation_rate = Gauge(
+    "synapse_guest_module_reaper_deactivation_rate",
+    "Deactivations per second that were achieved in the last reaper cycle",
+)
+
+reaper_queue_size = Gauge(
+    "synapse_guest_module_reaper_queue_size",
+    "Number of pending deactivations at the end of the last reaper cycle",
+)
+
+reaper_media = Counter(
+    "synapse_guest_module_reaper_media",
+    "Media of deactivated guest users that was deleted or quarantined, by outcome",
+    ["outcome"],
+)
+
+reaper_media_reclaimed_bytes = Gauge(
+    "synapse_guest_module_reaper_media_reclaimed_bytes",
+    "Size of the media of deactivated guest users that was deleted or quarantined in the last reaper cycle",
+)
+
+reaper_purged = Counter(
+    "synapse_guest_module_reaper_purged",
+    "Deactivated guest users whose remaining data was purged",
+)
+
+reaper_purgeable = Gauge(
+    "synapse_guest_module_reaper_purgeable",
+    "Number of deactivated guest users that can be purged, at the start of the purge of the last reaper cycle",
+)
+
+callback_time = Histogram(
+    "synapse_guest_module_callback_seconds",
+    "Time of the module callbacks that are called by the homeserver",
+    ["callback"],
+    buckets=(0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0),
+)
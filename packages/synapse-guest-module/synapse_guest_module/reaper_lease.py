@@ -0,0 +1,109 @@
+# Copyright 2023 Nordeck IT + Consulting GmbH
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+import logging
+import time
+
+from synapse.module_api import LoggingTransaction, ModuleApi
+
+from synapse_guest_module.config import GuestModuleConfig
+from synapse_guest_module.guest_registry import GuestRegistry
+
+logger = logging.getLogger("synapse.contrib." + __name__)
+
+LEASE_NAME = "reaper"
+
+
+class ReaperLease:
+    """A lease in the database that makes sure that only a single worker runs
+    the reaper. The worker that holds the lease has to renew it before it
+    expires after `reaper_lease_ttl_seconds`, otherwise another worker takes
+    it over. The lease is held by the name of the worker, so a restarted
+    worker continues to hold its lease.
+    """
+
+    def __init__(
+        self,
+        api: ModuleApi,
+        config: GuestModuleConfig,
+        registry: GuestRegistry,
+    ):
+        self._api = api
+        self._config = config
+        self._registry = registry
+        self._is_held = False
+        self._renewed_at = 0.0
+
+        # The main process has no worker name
+        self.holder = api.worker_name or "master"
+
+    @property
+    def renew_interval_ms(self) -> int:
+        """The interval in which the lease must be renewed, so it doesn't
+        expire even if a renewal is delayed.
+        """
+        return self._config.reaper_lease_ttl_seconds * 1000 // 3
+
+    async def acquire(self) -> bool:
+        """Take the lease if it is free or expired, or renew it if this worker
+        already holds it. Returns whether this worker holds the lease.
+        """
+        await self._registry.setup()
+
+        now_ts = int(time.time() * 1000)
+        expires_ts = now_ts + self._config.reaper_lease_ttl_seconds * 1000
+
+        def acquire_lease_txn(txn: LoggingTransaction) -> bool:
+            txn.execute(
+                """
+                INSERT INTO guest_module_reaper_lease (name, holder, expires_ts)
+                VALUES (?, ?, ?)
+                ON CONFLICT (name) DO UPDATE
+                SET holder = excluded.holder, expires_ts = excluded.expires_ts
+                WHERE guest_module_reaper_lease.holder = excluded.holder
+                OR guest_module_reaper_lease.expires_ts < ?
+                """,
+                (LEASE_NAME, self.holder, expires_ts, now_ts),
+            )
+            return bool(txn.rowcount == 1)
+
+        is_held = await self._api.run_db_interaction(
+            "guest_module_acquire_reaper_lease",
+            acquire_lease_txn,
+        )
+
+        if is_held != self._is_held:
+            if is_held:
+                logger.info("Worker %s is now running the reaper", self.holder)
+            else:
+                logger.info("Worker %s lost the reaper lease", self.holder)
+
+        self._is_held = is_held
+        if is_held:
+            self._renewed_at = time.monotonic()
+
+        return is_held
+
+    async def renew_if_due(self) -> bool:
+        """Renew the lease if the last renewal is older than the renewal
+        interval. Returns whether this worker holds the lease.
+        """
+        if (
+            self._is_held
+            and (time.monotonic() - self._renewed_at) * 1000 < self.renew_interval_ms
+        ):
+            return True
+
+        return await self.acquire()
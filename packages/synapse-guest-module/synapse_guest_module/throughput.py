@@ -0,0 +1,107 @@
+# Copyright 2023 Nordeck IT + Consulting GmbH
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+import time
+from collections import deque
+from typing import Collection, Deque, Dict
+
+from synapse.module_api import ModuleApi
+
+
+class RatePacer:
+    """Spreads calls evenly, so no more than `rate_per_second` calls start per
+    second, even if they are made concurrently. A `rate_per_second` of `0`
+    disables the limit.
+    """
+
+    def __init__(self, api: ModuleApi, rate_per_second: float):
+        self._api = api
+        self._rate_per_second = rate_per_second
+        self._next_slot = 0.0
+
+    async def wait(self, count: int = 1) -> None:
+        """Wait for the next free slot. A call for `count` items takes up
+        `count` slots, so the following call waits accordingly longer.
+        """
+        if self._rate_per_second <= 0:
+            return
+
+        now = time.monotonic()
+        slot = max(now, self._next_slot)
+        self._next_slot = slot + count / self._rate_per_second
+
+        if slot > now:
+            await self._api.sleep(slot - now)
+
+
+class RoomLeaveLimiter:
+    """Limits the number of leave events per room to `limit` in a sliding
+    window of `window_seconds`. A `limit` of `0` disables the limit.
+    """
+
+    def __init__(self, limit: int, window_seconds: int):
+        self._limit = limit
+        self._window_seconds = window_seconds
+
+        # room_id -> times of the leave events in the window
+        self._leaves: Dict[str, Deque[float]] = {}
+
+    @property
+    def enabled(self) -> bool:
+        return self._limit > 0
+
+    def acquire(self, room_ids: Collection[str]) -> float:
+        """Record a leave event in each of the rooms. Returns `0` if this is
+        possible in all rooms, or the number of seconds until it is possible.
+        Nothing is recorded if the limit of any of the rooms is reached.
+        """
+        if self._limit <= 0:
+            return 0
+
+        now = time.monotonic()
+        retry_after = 0.0
+
+        for room_id in room_ids:
+            leaves = self._leaves.get(room_id)
+            if leaves is None:
+                continue
+
+            while len(leaves) > 0 and leaves[0] <= now - self._window_seconds:
+                leaves.popleft()
+
+            if len(leaves) >= self._limit:
+                retry_after = max(retry_after, leaves[0] + self._window_seconds - now)
+
+        if retry_after > 0:
+            return retry_after
+
+        for room_id in room_ids:
+            self._leaves.setdefault(room_id, deque()).append(now)
+
+        return 0
+
+    def prune(self) -> None:
+        """Forget rooms without leave events in the window."""
+        now = time.monotonic()
+
+        for room_id in list(self._leaves):
+            leaves = self._leaves[room_id]
+            while len(leaves) > 0 and leaves[0] <= now - self._window_seconds:
+                leaves.popleft()
+            if len(leaves) == 0:
+                del self._leaves[room_id]
+
+    def __len__(self) -> int:
+        return len(self._leaves)
@@ -0,0 +1,122 @@
+# Copyright 2023 Nordeck IT + Consulting GmbH
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import functools
+import logging
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import (
+    Any,
+    Awaitable,
+    Callable,
+    Dict,
+    Iterator,
+    Optional,
+    TypeVar,
+    Union,
+    cast,
+)
+
+from synapse.logging import opentracing
+
+from synapse_guest_module.metrics import callback_time
+
+logger = logging.getLogger("synapse.contrib." + __name__)
+
+SPAN_PREFIX = "guest_module."
+
+TagValue = Union[str, bool, int, float]
+
+# the tags of the innermost span of the current call, which are also written
+# to the slow-call log
+_current_tags: ContextVar[Optional[Dict[str, TagValue]]] = ContextVar(
+    "guest_module_current_tags", default=None
+)
+
+
+def set_tag(key: str, value: TagValue) -> None:
+    """Add a tag to the innermost span of the current call."""
+    tags = _current_tags.get()
+    if tags is not None:
+        tags[key] = value
+
+    opentracing.set_tag(key, value)
+
+
+class CallTracer:
+    """Wraps calls in OpenTracing spans of the homeserver, which are only
+    recorded if tracing is enabled in Synapse. Calls that take at least
+    `slow_call_threshold_ms` are logged with their tags. A threshold of `0`
+    disables the slow-call log.
+    """
+
+    def __init__(self, slow_call_threshold_ms: int):
+        self._slow_call_threshold_ms = slow_call_threshold_ms
+
+    @contextmanager
+    def span(
+        self, name: str, log_slow: bool = True, **tags: TagValue
+    ) -> Iterator[None]:
+        """Run the block in a span called `guest_module.<name>` with the given
+        tags. More tags can be added with `set_tag`. Pass `log_slow=False` for
+        spans that only group other spans, e.g. a whole reaper cycle.
+        """
+        call_tags: Dict[str, TagValue] = dict(tags)
+        parent_tags = _current_tags.get()
+        _current_tags.set(call_tags)
+
+        start = time.perf_counter()
+        try:
+            with opentracing.start_active_span(SPAN_PREFIX + name):
+                for key, value in tags.items():
+                    opentracing.set_tag(key, value)
+
+                yield
+        finally:
+            _current_tags.set(parent_tags)
+
+            duration_ms = (time.perf_counter() - start) * 1000
+            if (
+                log_slow
+                and self._slow_call_threshold_ms > 0
+                and duration_ms >= self._slow_call_threshold_ms
+            ):
+                logger.warning(
+                    "Slow call %s took %.1f ms%s",
+                    name,
+                    duration_ms,
+                    "".join(f" {key}={value}" for key, value in call_tags.items()),
+                )
+
+
+F = TypeVar("F", bound=Callable[..., Awaitable[Any]])
+
+
+def trace_callback(name: str) -> Callable[[F], F]:
+    """Record the number of calls and the time of an async callback in
+    `callback_time`, and run it in a span of the `tracer` of the object that
+    the callback belongs to.
+    """
+
+    def decorator(f: F) -> F:
+        @functools.wraps(f)
+        async def wrapper(self: Any, *args: Any, **kwargs: Any) -> Any:
+            tracer: CallTracer = self.tracer
+            with callback_time.labels(name).time(), tracer.span(name):
+                return await f(self, *args, **kwargs)
+
+        return cast(F, wrapper)
+
+    return decorator
@@ -14,11 +14,12 @@
 
 import sqlite3
 from asyncio import Future
-from typing import Any, Awaitable, Callable, Tuple, TypeVar
+from typing import Any, Awaitable, Callable, Dict, List, Optional, Tuple, TypeVar, cast
 from unittest.mock import Mock
 
+from prometheus_client import REGISTRY
 from synapse.http.client import SimpleHttpClient
-from synapse.module_api import ModuleApi
+from synapse.module_api import EventBase, ModuleApi
 
 from synapse_guest_module import GuestModule
 
@@ -42,6 +43,8 @@ class SQLiteStore:
         try:
             res = f(cur, *args, **kwargs)
             self.conn.commit()
+            for callback, callback_args in cur.after_callbacks:
+                callback(*callback_args)
             return res
         except Exception:
             self.conn.rollback()
@@ -53,6 +56,10 @@ class CursorWrapper:
 
     def __init__(self, cursor: sqlite3.Cursor) -> None:
         self.cur = cursor
+        self.after_callbacks: List[Tuple[Callable[..., Any], Tuple[Any, ...]]] = []
+
+    def call_after(self, callback: Callable[..., Any], *args: Any) -> None:
+        self.after_callbacks.append((callback, args))
 
     def execute(self, sql: str, args: Any) -> None:
         self.cur.execute(sql, args)
@@ -86,6 +93,25 @@ def make_awaitable(result: TV) -> Awaitable[TV]:
     return future
 
 
+def make_state_event(
+    event_type: str, state_key: str, room_id: str, content: Dict[str, Any]
+) -> Mock:
+    """Create a mocked state event."""
+    event = Mock(spec=EventBase)
+    event.type = event_type
+    event.room_id = room_id
+    event.content = content
+    event.get_state_key.return_value = state_key
+    event.get.side_effect = {"content": content}.get
+    return event
+
+
+def get_sample_value(name: str, labels: Optional[Dict[str, str]] = None) -> float:
+    """Read the current value of a metric, or `0` if it was not recorded yet."""
+    value = REGISTRY.get_sample_value(name, labels)
+    return 0 if value is None else value
+
+
 def get_qualified_user_id(username: str) -> str:
     return f"@{username}:matrix.local"
 
@@ -94,7 +120,9 @@ async def register_user(localpart: str, admin: bool = False) -> str:
     return f"@{localpart}:matrix.local"
 
 
-def create_module() -> Tuple[GuestModule, Mock, SQLiteStore]:
+def create_module(
+    config: Optional[Dict[str, Any]] = None,
+) -> Tuple[GuestModule, Mock, SQLiteStore]:
     store = SQLiteStore()
     _setup_db(store.conn)
 
@@ -106,6 +134,7 @@ def create_module() -> Tuple[GuestModule, Mock, SQLiteStore]:
     module_api = Mock(spec=ModuleApi)
     module_api.http_client = client
     module_api.server_name = "matrix.local"
+    module_api.worker_name = None
     module_api.public_baseurl = "https://matrix.local:1234/"
     module_api.run_db_interaction.side_effect = store.run_db_interaction
     module_api.get_qualified_user_id.side_effect = get_qualified_user_id
@@ -115,20 +144,65 @@ def create_module() -> Tuple[GuestModule, Mock, SQLiteStore]:
         ("DEVICEID", "syn_registered_token", None, None)
     )
 
+    # Some features access the homeserver directly, because the module API
+    # doesn't provide the required capabilities.
+    module_api._hs = Mock()
+    deactivate_account_handler = module_api._hs.get_deactivate_account_handler()
+    deactivate_account_handler.deactivate_account.return_value = make_awaitable(True)
+    device_handler = module_api._hs.get_device_handler()
+    device_handler.delete_all_devices_for_user.return_value = make_awaitable(None)
+
     # If necessary, give parse_config some configuration to parse.
-    config = GuestModule.parse_config(
+    parsed_config = GuestModule.parse_config(
         {
             "enable_user_reaper": False,
+            **(config or {}),
         }
     )
 
-    module = GuestModule(config, module_api)
+    module = GuestModule(parsed_config, module_api)
 
     return module, module_api, store
 
 
+def mock_token_handlers(module_api: Mock) -> Mock:
+    """Mock the handlers of the homeserver that create expiring access tokens
+    and return the auth handler.
+    """
+    device_handler = module_api._hs.get_device_handler()
+    device_handler.check_device_registered.return_value = make_awaitable("GUESTDEVICE")
+
+    auth_handler = module_api._hs.get_auth_handler()
+    auth_handler.create_refresh_token_for_user_id.return_value = make_awaitable(
+        ("syr_refresh_token", 5)
+    )
+    auth_handler.create_access_token_for_user_id.return_value = make_awaitable(
+        "syt_access_token"
+    )
+
+    return cast(Mock, auth_handler)
+
+
 def _setup_db(conn: sqlite3.Connection) -> None:
     conn.execute("CREATE TABLE access_tokens(user_id text, token text)")
     conn.execute(
-        "CREATE TABLE users(name text, deactivated smallint, creation_ts bigint)"
+        "CREATE TABLE users(name text, deactivated smallint, creation_ts bigint, locked boolean DEFAULT FALSE)"
+    )
+    conn.execute("CREATE TABLE profiles(full_user_id text, displayname text)")
+    for table in [
+        "user_filters(full_user_id text, filter_id bigint)",
+        "user_directory(user_id text)",
+        "user_directory_search(user_id text)",
+        "users_in_public_rooms(user_id text)",
+        "users_who_share_private_rooms(user_id text, other_user_id text)",
+        "user_ips(user_id text)",
+        "user_daily_visits(user_id text)",
+        "monthly_active_users(user_id text)",
+        "user_stats_current(user_id text)",
+        "e2e_cross_signing_keys(user_id text)",
+        "e2e_cross_signing_signatures(user_id text, target_device_id text)",
+    ]:
+        conn.execute(f"CREATE TABLE {table}")
+    conn.execute(
+        "CREATE TABLE local_media_repository(media_id text, media_length integer, user_id text, quarantined_by text, safe_from_quarantine boolean)"
     )
@@ -0,0 +1,104 @@
+# Copyright 2023 Nordeck IT + Consulting GmbH
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from unittest.mock import patch
+
+import aiounittest
+from twisted.internet import defer
+
+from synapse_guest_module.admission_control import (
+    AdmissionController,
+    ClientRateLimiter,
+)
+
+
+class AdmissionControllerTest(aiounittest.AsyncTestCase):
+    async def test_unlimited(self) -> None:
+        controller = AdmissionController(0, 0)
+
+        for _ in range(100):
+            self.assertTrue(await controller.acquire())
+
+        self.assertEqual(controller.in_flight, 100)
+
+    async def test_queue_and_reject(self) -> None:
+        controller = AdmissionController(1, 1)
+
+        self.assertTrue(await controller.acquire())
+
+        waiting = defer.ensureDeferred(controller.acquire())
+        self.assertFalse(waiting.called)
+        self.assertEqual(controller.queued, 1)
+
+        # the queue is full
+        self.assertFalse(await controller.acquire())
+
+        # the slot is handed over to the waiting request
+        controller.release()
+        self.assertTrue(waiting.called)
+        self.assertEqual(controller.in_flight, 1)
+        self.assertEqual(controller.queued, 0)
+
+        controller.release()
+        self.assertEqual(controller.in_flight, 0)
+
+    async def test_cancel_waiting(self) -> None:
+        controller = AdmissionController(1, 1)
+
+        self.assertTrue(await controller.acquire())
+
+        waiting = defer.ensureDeferred(controller.acquire())
+        waiting.cancel()
+        waiting.addErrback(lambda _: None)
+
+        self.assertEqual(controller.queued, 0)
+
+        controller.release()
+        self.assertEqual(controller.in_flight, 0)
+
+
+class ClientRateLimiterTest(aiounittest.AsyncTestCase):
+    def test_disabled(self) -> None:
+        limiter = ClientRateLimiter(0, 1, 10)
+
+        for _ in range(100):
+            self.assertEqual(limiter.check("10.0.0.1"), 0)
+
+    def test_burst_and_refill(self) -> None:
+        limiter = ClientRateLimiter(2, 3, 10)
+
+        with patch("time.monotonic", return_value=1000.0):
+            self.assertEqual(limiter.check("10.0.0.1"), 0)
+            self.assertEqual(limiter.check("10.0.0.1"), 0)
+            self.assertEqual(limiter.check("10.0.0.1"), 0)
+            self.assertAlmostEqual(limiter.check("10.0.0.1"), 0.5)
+
+            # other clients have their own bucket
+            self.assertEqual(limiter.check("10.0.0.2"), 0)
+
+        with patch("time.monotonic", return_value=1000.5):
+            self.assertEqual(limiter.check("10.0.0.1"), 0)
+            self.assertAlmostEqual(limiter.check("10.0.0.1"), 0.5)
+
+    def test_bounded_clients(self) -> None:
+        limiter = ClientRateLimiter(1, 1, 2)
+
+        limiter.check("10.0.0.1")
+        limiter.check("10.0.0.2")
+        limiter.check("10.0.0.3")
+
+        self.assertEqual(len(limiter), 2)
+
+        # the first client was forgotten and has a full bucket again
+        self.assertEqual(limiter.check("10.0.0.1"), 0)
@@ -0,0 +1,147 @@
+# Copyright 2023 Nordeck IT + Consulting GmbH
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+from typing import Any
+
+import aiounittest
+
+from tests import create_module
+
+
+class DeactivationQueueTest(aiounittest.AsyncTestCase):
+    async def test_enqueue(self) -> None:
+        module, _, store = create_module()
+
+        await module.registry.setup()
+        store.conn.executemany(
+            "INSERT INTO guest_module_guests VALUES (?, ?, ?, ?)",
+            [
+                ["@guest-1:matrix.local", 0, 100, "active"],
+                ["@guest-2:matrix.local", 0, 200, "pooled"],
+            ],
+        )
+
+        await module.reaper.queue.enqueue(
+            ["@guest-1:matrix.local", "@guest-2:matrix.local"], 1000
+        )
+        # enqueuing a user twice keeps the existing job
+        await module.reaper.queue.enqueue(["@guest-1:matrix.local"], 2000)
+
+        self.assertEqual(
+            store.conn.execute(
+                "SELECT * FROM guest_module_deactivation_jobs ORDER BY user_id"
+            ).fetchall(),
+            [
+                ("@guest-1:matrix.local", 0, 1000, None, "pending"),
+                ("@guest-2:matrix.local", 0, 1000, None, "pending"),
+            ],
+        )
+        self.assertEqual(
+            store.conn.execute(
+                "SELECT DISTINCT state FROM guest_module_guests"
+            ).fetchall(),
+            [("expired",)],
+        )
+
+    async def test_get_due_jobs(self) -> None:
+        module, _, store = create_module()
+
+        await module.registry.setup()
+        store.conn.executemany(
+            "INSERT INTO guest_module_deactivation_jobs VALUES (?, ?, ?, ?, ?)",
+            [
+                ["@guest-1:matrix.local", 0, 300, None, "pending"],
+                ["@guest-2:matrix.local", 0, 100, None, "pending"],
+                ["@guest-3:matrix.local", 9, 100, "error", "parked"],
+                ["@guest-4:matrix.local", 0, 2000, None, "pending"],
+                ["@guest-5:matrix.local", 0, 200, None, "pending"],
+            ],
+        )
+
+        self.assertEqual(
+            await module.reaper.queue.get_due_jobs(1000, 2),
+            ["@guest-2:matrix.local", "@guest-5:matrix.local"],
+        )
+        self.assertEqual(await module.reaper.queue.get_next_attempt(), 100)
+
+    async def test_fail_backoff_and_park(self) -> None:
+        module, _, store = create_module(
+            {"reaper_max_attempts": 3, "reaper_retry_interval_seconds": 10}
+        )
+
+        await module.registry.setup()
+        store.conn.execute(
+            "INSERT INTO guest_module_guests VALUES ('@guest-1:matrix.local', 0, 100, 'active')"
+        )
+        await module.reaper.queue.enqueue(["@guest-1:matrix.local"], 0)
+
+        def get_job() -> Any:
+            return store.conn.execute(
+                "SELECT * FROM guest_module_deactivation_jobs"
+            ).fetchone()
+
+        await module.reaper.queue.fail([("@guest-1:matrix.local", "boom")], 1000)
+        self.assertEqual(
+            get_job(), ("@guest-1:matrix.local", 1, 11000, "boom", "pending")
+        )
+
+        await module.reaper.queue.fail([("@guest-1:matrix.local", "boom")], 2000)
+        self.assertEqual(
+            get_job(), ("@guest-1:matrix.local", 2, 22000, "boom", "pending")
+        )
+
+        await module.reaper.queue.fail([("@guest-1:matrix.local", "boom")], 3000)
+        self.assertEqual(
+            get_job(), ("@guest-1:matrix.local", 3, 43000, "boom", "parked")
+        )
+        self.assertIsNone(await module.reaper.queue.get_next_attempt())
+        self.assertEqual(await module.reaper.queue.count_parked(), 1)
+
+        # the parked user no longer counts towards the backlog
+        self.assertEqual(
+            store.conn.execute("SELECT state FROM guest_module_guests").fetchall(),
+            [("parked",)],
+        )
+        self.assertEqual(await module.registry.get_expired_backlog(5000), (0, None))
+
+    async def test_retry_interval_is_capped(self) -> None:
+        module, _, _ = create_module()
+
+        self.assertEqual(module.reaper.queue.get_retry_interval_ms(1), 60 * 1000)
+        self.assertEqual(
+            module.reaper.queue.get_retry_interval_ms(30), 24 * 60 * 60 * 1000
+        )
+
+    async def test_complete(self) -> None:
+        module, _, store = create_module()
+
+        await module.registry.setup()
+        store.conn.execute(
+            "INSERT INTO guest_module_guests VALUES ('@guest-1:matrix.local', 0, 100, 'active')"
+        )
+        await module.reaper.queue.enqueue(["@guest-1:matrix.local"], 1000)
+
+        await module.reaper.queue.complete(["@guest-1:matrix.local"])
+
+        self.assertEqual(
+            store.conn.execute(
+                "SELECT * FROM guest_module_deactivation_jobs"
+            ).fetchall(),
+            [],
+        )
+        self.assertEqual(
+            store.conn.execute("SELECT state FROM guest_module_guests").fetchall(),
+            [("deactivated",)],
+        )
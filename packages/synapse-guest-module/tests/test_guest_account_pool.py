@@ -0,0 +1,200 @@
+# Copyright 2023 Nordeck IT + Consulting GmbH
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import io
+import time
+from typing import cast
+from unittest.mock import ANY
+
+import aiounittest
+import attr
+from synapse.types import UserID
+from twisted.web.server import Request
+from twisted.web.test.requesthelper import DummyRequest
+
+from synapse_guest_module.guest_account_pool import GuestAccountPool, PooledGuest
+from tests import create_module, make_awaitable, mock_token_handlers
+
+
+class GuestAccountPoolTest(aiounittest.AsyncTestCase):
+    async def test_refill(self) -> None:
+        module, module_api, store = create_module({"guest_pool_size": 3})
+        pool = cast(GuestAccountPool, module.registration_servlet.pool)
+
+        await pool.refill()
+
+        self.assertEqual(len(pool), 3)
+        self.assertEqual(module_api.register_user.call_count, 3)
+        self.assertEqual(module_api.register_device.call_count, 3)
+        self.assertEqual(
+            store.conn.execute(
+                "SELECT state, expires_ts - created_ts FROM guest_module_guests"
+            ).fetchall(),
+            [("pooled", 3600 * 1000)] * 3,
+        )
+
+    async def test_claim_empty(self) -> None:
+        module, module_api, _ = create_module({"guest_pool_size": 3})
+        pool = cast(GuestAccountPool, module.registration_servlet.pool)
+
+        self.assertIsNone(pool.claim())
+
+        module_api.run_as_background_process.assert_called_with(
+            "guest_module_pool_refill", pool.refill, bg_start_span=False
+        )
+
+    async def test_claim_skips_expiring_entries(self) -> None:
+        module, _, _ = create_module({"guest_pool_size": 3})
+        pool = cast(GuestAccountPool, module.registration_servlet.pool)
+
+        await pool.refill()
+
+        now = int(time.time() * 1000)
+        pool._entries[0] = PooledGuest("@guest-old:matrix.local", "D", "T", now)
+
+        entry = pool.claim()
+
+        self.assertIsNotNone(entry)
+        self.assertNotEqual(cast(PooledGuest, entry).user_id, "@guest-old:matrix.local")
+        self.assertEqual(len(pool), 1)
+
+    async def test_start(self) -> None:
+        module, module_api, _ = create_module({"guest_pool_size": 3})
+        pool = cast(GuestAccountPool, module.registration_servlet.pool)
+
+        module_api.run_as_background_process.assert_called_with(
+            "guest_module_pool_refill", pool.refill, bg_start_span=False
+        )
+        module_api.looping_background_call.assert_called_once_with(
+            pool.maintain,
+            30 * 1000,
+            desc="guest_module_pool_maintenance",
+            run_on_all_instances=True,
+        )
+
+    async def test_maintain_replaces_expiring_entries(self) -> None:
+        module, module_api, _ = create_module({"guest_pool_size": 3})
+        pool = cast(GuestAccountPool, module.registration_servlet.pool)
+
+        await pool.refill()
+        module_api.run_as_background_process.reset_mock()
+
+        # the pool was idle until its oldest accounts are about to expire
+        now = int(time.time() * 1000)
+        pool._entries[0] = PooledGuest("@guest-old-1:matrix.local", "D", "T", now)
+        pool._entries[1] = PooledGuest("@guest-old-2:matrix.local", "D", "T", now)
+
+        pool.maintain()
+
+        self.assertEqual(len(pool), 1)
+        module_api.run_as_background_process.assert_called_once_with(
+            "guest_module_pool_refill", pool.refill, bg_start_span=False
+        )
+
+        await pool.refill()
+
+        self.assertEqual(len(pool), 3)
+        self.assertNotIn(
+            "@guest-old-1:matrix.local", [entry.user_id for entry in pool._entries]
+        )
+
+    async def test_maintain_full_pool(self) -> None:
+        module, module_api, _ = create_module({"guest_pool_size": 3})
+        pool = cast(GuestAccountPool, module.registration_servlet.pool)
+
+        await pool.refill()
+        module_api.run_as_background_process.reset_mock()
+
+        pool.maintain()
+
+        self.assertEqual(len(pool), 3)
+        module_api.run_as_background_process.assert_not_called()
+
+    async def test_pool_only_on_pool_worker(self) -> None:
+        module, module_api, _ = create_module(
+            {"guest_pool_size": 3, "guest_pool_worker_name": "registration_worker"}
+        )
+
+        self.assertIsNone(module.registration_servlet.pool)
+        module_api.run_as_background_process.assert_not_called()
+        module_api.looping_background_call.assert_not_called()
+
+    async def test_async_render_POST_from_pool(self) -> None:
+        module, module_api, store = create_module({"guest_pool_size": 1})
+        pool = cast(GuestAccountPool, module.registration_servlet.pool)
+
+        await pool.refill()
+        module_api.register_user.reset_mock()
+        module_api.register_device.reset_mock()
+
+        request = cast(Request, DummyRequest([]))
+        request.content = io.BytesIO(b'{"displayname":"My Name "}')
+
+        status, response = await module.registration_servlet._async_render_POST(request)
+
+        self.assertEqual(status, 201)
+        module_api.register_user.assert_not_called()
+        module_api.register_device.assert_not_called()
+        module_api.set_displayname.assert_awaited_once_with(
+            UserID.from_string(response["userId"]), "My Name (Guest)"
+        )
+
+        self.assertEqual(
+            store.conn.execute(
+                "SELECT state, expires_ts - created_ts FROM guest_module_guests"
+            ).fetchall(),
+            [("active", 24 * 60 * 60 * 1000)],
+        )
+
+    async def test_async_render_POST_from_pool_renews_expiring_token(self) -> None:
+        module, module_api, _ = create_module(
+            {"guest_pool_size": 1, "guest_access_token_lifetime_seconds": 300}
+        )
+        auth_handler = mock_token_handlers(module_api)
+        pool = cast(GuestAccountPool, module.registration_servlet.pool)
+
+        await pool.refill()
+        pool._entries[0] = attr.evolve(
+            pool._entries[0], access_token_expires_ts=int(time.time() * 1000)
+        )
+        auth_handler.create_access_token_for_user_id.return_value = make_awaitable(
+            "syt_renewed_token"
+        )
+
+        request = cast(Request, DummyRequest([]))
+        request.content = io.BytesIO(b'{"displayname":"My Name "}')
+
+        status, response = await module.registration_servlet._async_render_POST(request)
+
+        self.assertEqual(status, 201)
+        self.assertEqual(response["deviceId"], "GUESTDEVICE")
+        self.assertEqual(response["accessToken"], "syt_renewed_token")
+        self.assertGreater(response["expiresInMs"], 290 * 1000)
+        self.assertEqual(auth_handler.create_access_token_for_user_id.call_count, 2)
+
+    async def test_async_render_POST_pooled_user_already_expired(self) -> None:
+        module, module_api, store = create_module({"guest_pool_size": 1})
+        pool = cast(GuestAccountPool, module.registration_servlet.pool)
+
+        await pool.refill()
+        store.conn.execute("UPDATE guest_module_guests SET state = 'deactivated'")
+
+        request = cast(Request, DummyRequest([]))
+        request.content = io.BytesIO(b'{"displayname":"My Name"}')
+
+        status, _ = await module.registration_servlet._async_render_POST(request)
+
+        self.assertEqual(status, 201)
+        module_api.set_displayname.assert_not_called()
+        module_api.register_user.assert_called_with(ANY, "My Name (Guest)")
@@ -0,0 +1,162 @@
+# Copyright 2023 Nordeck IT + Consulting GmbH
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import io
+import json
+from typing import cast
+
+import aiounittest
+from synapse.module_api.errors import SynapseError
+from synapse.types import create_requester
+from twisted.web.server import Request
+from twisted.web.test.requesthelper import DummyRequest
+
+from tests import create_module, make_awaitable
+
+
+def create_request(body: bytes) -> DummyRequest:
+    request = DummyRequest([])
+    cast(Request, request).content = io.BytesIO(body)
+    return request
+
+
+class GuestBulkRegistrationServletTest(aiounittest.AsyncTestCase):
+    async def test_async_render_POST_not_admin(self) -> None:
+        module, module_api, _ = create_module()
+        module_api.get_user_by_req.return_value = create_requester("@user:matrix.local")
+        module_api.is_user_admin.return_value = False
+
+        request = create_request(b'{"displaynames":["My Name"]}')
+
+        with self.assertRaisesRegex(SynapseError, "You are not a server admin"):
+            await module.bulk_registration_servlet._async_render_POST(
+                cast(Request, request)
+            )
+
+        module_api.register_user.assert_not_called()
+
+    async def test_async_render_POST_missing_displaynames(self) -> None:
+        module, module_api, _ = create_module()
+        module_api.get_user_by_req.return_value = create_requester(
+            "@admin:matrix.local"
+        )
+        module_api.is_user_admin.return_value = True
+
+        request = create_request(b'{"displaynames":"My Name"}')
+
+        result = await module.bulk_registration_servlet._async_render_POST(
+            cast(Request, request)
+        )
+
+        self.assertEqual(
+            result,
+            (400, {"msg": "You must provide 'displaynames' as a list of strings"}),
+        )
+
+    async def test_async_render_POST_too_many_displaynames(self) -> None:
+        module, module_api, _ = create_module({"bulk_registration_max_size": 2})
+        module_api.get_user_by_req.return_value = create_requester(
+            "@admin:matrix.local"
+        )
+        module_api.is_user_admin.return_value = True
+
+        request = create_request(b'{"displaynames":["A","B","C"]}')
+
+        result = await module.bulk_registration_servlet._async_render_POST(
+            cast(Request, request)
+        )
+
+        self.assertEqual(
+            result, (400, {"msg": "You can't register more than 2 guests at once"})
+        )
+        module_api.register_user.assert_not_called()
+
+    async def test_async_render_POST_success(self) -> None:
+        module, module_api, store = create_module(
+            {"bulk_registration_max_concurrency": 2}
+        )
+        module_api.get_user_by_req.return_value = create_requester(
+            "@admin:matrix.local"
+        )
+        module_api.is_user_admin.return_value = True
+
+        request = create_request(b'{"displaynames":["Alice ", "  ", "Bob", 5]}')
+
+        result = await module.bulk_registration_servlet._async_render_POST(
+            cast(Request, request)
+        )
+
+        self.assertIsNone(result)
+        self.assertEqual(request.responseCode, 200)
+        self.assertEqual(request.finished, 1)
+
+        entries = sorted(
+            json.loads(b"".join(request.written)), key=lambda entry: entry["index"]
+        )
+        user_ids = [entries[0].pop("userId"), entries[2].pop("userId")]
+        self.assertEqual(
+            entries,
+            [
+                {
+                    "index": 0,
+                    "accessToken": "syn_registered_token",
+                    "deviceId": "DEVICEID",
+                    "homeserverUrl": "https://matrix.local:1234/",
+                },
+                {"index": 1, "error": "The display name must be a non-empty string"},
+                {
+                    "index": 2,
+                    "accessToken": "syn_registered_token",
+                    "deviceId": "DEVICEID",
+                    "homeserverUrl": "https://matrix.local:1234/",
+                },
+                {"index": 3, "error": "The display name must be a non-empty string"},
+            ],
+        )
+
+        self.assertEqual(
+            [call.args[1] for call in module_api.register_user.call_args_list],
+            ["Alice (Guest)", "Bob (Guest)"],
+        )
+        self.assertCountEqual(
+            store.conn.execute("SELECT user_id FROM guest_module_guests").fetchall(),
+            [(user_id,) for user_id in user_ids],
+        )
+
+    async def test_async_render_POST_registration_error(self) -> None:
+        module, module_api, _ = create_module()
+        module_api.get_user_by_req.return_value = create_requester(
+            "@admin:matrix.local"
+        )
+        module_api.is_user_admin.return_value = True
+        module_api.check_user_exists.side_effect = [
+            make_awaitable(False),
+            Exception("Database unavailable"),
+        ]
+
+        request = create_request(b'{"displaynames":["Alice", "Bob"]}')
+
+        await module.bulk_registration_servlet._async_render_POST(
+            cast(Request, request)
+        )
+
+        entries = sorted(
+            json.loads(b"".join(request.written)), key=lambda entry: entry["index"]
+        )
+        self.assertIn("userId", entries[0])
+        self.assertEqual(
+            entries[1],
+            {"index": 1, "error": "Internal error: Could not register the user"},
+        )
+        self.assertEqual(request.finished, 1)
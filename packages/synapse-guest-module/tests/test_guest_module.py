@@ -12,14 +12,20 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import time
+from typing import Any, List
+from unittest.mock import ANY, patch
+
 import aiounittest
-from synapse.module_api import ProfileInfo, UserProfile
+from synapse.logging.context import make_deferred_yieldable
+from synapse.module_api import NOT_SPAM, EventBase, ProfileInfo, UserProfile, errors
 from synapse.module_api.errors import ConfigError
 from synapse.types import UserID
+from twisted.internet import defer
 
 from synapse_guest_module.config import GuestModuleConfig
 from synapse_guest_module.guest_module import GuestModule
-from tests import create_module
+from tests import create_module, get_sample_value, make_awaitable, make_state_event
 
 
 class GuestModuleTest(aiounittest.AsyncTestCase):
@@ -43,6 +49,43 @@ class GuestModuleTest(aiounittest.AsyncTestCase):
                 "display_name_suffix": " (Temporary)",
                 "enable_user_reaper": False,
                 "user_expiration_seconds": 100,
+                "reaper_max_concurrency": 20,
+                "reaper_deactivation_mode": "admin_api",
+                "reaper_admin_api_url": "http://synapse-main:9008",
+                "reaper_batch_size": 500,
+                "join_rule_cache_size": 10,
+                "join_rule_cache_ttl_seconds": 60,
+                "guest_pool_size": 50,
+                "guest_pool_entry_ttl_seconds": 600,
+                "registration_mode": "optimistic",
+                "registration_max_in_flight": 20,
+                "registration_max_queue": 200,
+                "registration_rate_limit_per_second": 0.5,
+                "registration_rate_limit_burst": 5,
+                "registration_rate_limit_max_clients": 100,
+                "reaper_lease_ttl_seconds": 30,
+                "reaper_worker_name": "background_worker",
+                "reaper_max_attempts": 5,
+                "reaper_retry_interval_seconds": 30,
+                "reaper_lock_expired_users": False,
+                "reaper_deactivations_per_second": 2.5,
+                "reaper_room_leave_limit": 20,
+                "reaper_room_leave_window_seconds": 120,
+                "bulk_registration_max_size": 50,
+                "bulk_registration_max_concurrency": 4,
+                "slow_call_threshold_ms": 200,
+                "guest_access_token_lifetime_seconds": 600,
+                "display_name_enforcement": "in_place",
+                "reaper_media_cleanup": "quarantine",
+                "reaper_media_per_second": 10,
+                "reaper_purge_after_seconds": 31536000,
+                "reaper_purge_batch_size": 50,
+                "reaper_purges_per_second": 100,
+                "reaper_purge_dry_run": True,
+                "registration_idempotency_cache_size": 100,
+                "registration_idempotency_ttl_seconds": 60,
+                "guest_max_joined_rooms": 5,
+                "guest_pool_worker_name": "registration_worker",
             }
         )
 
@@ -53,6 +96,43 @@ class GuestModuleTest(aiounittest.AsyncTestCase):
                 display_name_suffix=" (Temporary)",
                 enable_user_reaper=False,
                 user_expiration_seconds=100,
+                reaper_max_concurrency=20,
+                reaper_deactivation_mode="admin_api",
+                reaper_admin_api_url="http://synapse-main:9008",
+                reaper_batch_size=500,
+                join_rule_cache_size=10,
+                join_rule_cache_ttl_seconds=60,
+                guest_pool_size=50,
+                guest_pool_entry_ttl_seconds=600,
+                registration_mode="optimistic",
+                registration_max_in_flight=20,
+                registration_max_queue=200,
+                registration_rate_limit_per_second=0.5,
+                registration_rate_limit_burst=5,
+                registration_rate_limit_max_clients=100,
+                reaper_lease_ttl_seconds=30,
+                reaper_worker_name="background_worker",
+                reaper_max_attempts=5,
+                reaper_retry_interval_seconds=30,
+                reaper_lock_expired_users=False,
+                reaper_deactivations_per_second=2.5,
+                reaper_room_leave_limit=20,
+                reaper_room_leave_window_seconds=120,
+                bulk_registration_max_size=50,
+                bulk_registration_max_concurrency=4,
+                slow_call_threshold_ms=200,
+                guest_access_token_lifetime_seconds=600,
+                display_name_enforcement="in_place",
+                reaper_media_cleanup="quarantine",
+                reaper_media_per_second=10.0,
+                reaper_purge_after_seconds=31536000,
+                reaper_purge_batch_size=50,
+                reaper_purges_per_second=100.0,
+                reaper_purge_dry_run=True,
+                registration_idempotency_cache_size=100,
+                registration_idempotency_ttl_seconds=60,
+                guest_max_joined_rooms=5,
+                guest_pool_worker_name="registration_worker",
             ),
         )
 
@@ -96,6 +176,337 @@ class GuestModuleTest(aiounittest.AsyncTestCase):
                 }
             )
 
+    async def test_parse_config_fail_reaper_max_concurrency(self) -> None:
+        with self.assertRaisesRegex(
+            ConfigError,
+            "Config option 'reaper_max_concurrency' must be a positive number",
+        ):
+            GuestModule.parse_config(
+                {
+                    "reaper_max_concurrency": 0,
+                }
+            )
+
+    async def test_parse_config_fail_reaper_deactivation_mode(self) -> None:
+        with self.assertRaisesRegex(
+            ConfigError,
+            "Config option 'reaper_deactivation_mode' must be 'in_process' or 'admin_api'",
+        ):
+            GuestModule.parse_config(
+                {
+                    "reaper_deactivation_mode": "http",
+                }
+            )
+
+    async def test_parse_config_fail_reaper_batch_size(self) -> None:
+        with self.assertRaisesRegex(
+            ConfigError,
+            "Config option 'reaper_batch_size' must be a positive number",
+        ):
+            GuestModule.parse_config(
+                {
+                    "reaper_batch_size": "100",
+                }
+            )
+
+    async def test_parse_config_fail_join_rule_cache_size(self) -> None:
+        with self.assertRaisesRegex(
+            ConfigError,
+            "Config option 'join_rule_cache_size' must be a non-negative number",
+        ):
+            GuestModule.parse_config(
+                {
+                    "join_rule_cache_size": -1,
+                }
+            )
+
+    async def test_parse_config_fail_guest_pool_worker_name(self) -> None:
+        with self.assertRaisesRegex(
+            ConfigError, "Config option 'guest_pool_worker_name' must be a string"
+        ):
+            GuestModule.parse_config(
+                {
+                    "guest_pool_worker_name": 1,
+                }
+            )
+
+    async def test_parse_config_fail_guest_pool_entry_ttl_seconds(self) -> None:
+        with self.assertRaisesRegex(
+            ConfigError,
+            "Config option 'guest_pool_entry_ttl_seconds' must be a number of at least 120",
+        ):
+            GuestModule.parse_config(
+                {
+                    "guest_pool_entry_ttl_seconds": 60,
+                }
+            )
+
+    async def test_parse_config_fail_registration_mode(self) -> None:
+        with self.assertRaisesRegex(
+            ConfigError,
+            "Config option 'registration_mode' must be 'check_first' or 'optimistic'",
+        ):
+            GuestModule.parse_config(
+                {
+                    "registration_mode": "fast",
+                }
+            )
+
+    async def test_parse_config_fail_registration_rate_limit_per_second(
+        self,
+    ) -> None:
+        with self.assertRaisesRegex(
+            ConfigError,
+            "Config option 'registration_rate_limit_per_second' must be a non-negative number",
+        ):
+            GuestModule.parse_config(
+                {
+                    "registration_rate_limit_per_second": "1",
+                }
+            )
+
+    async def test_parse_config_fail_reaper_lease_ttl_seconds(self) -> None:
+        with self.assertRaisesRegex(
+            ConfigError,
+            "Config option 'reaper_lease_ttl_seconds' must be a number of at least 3",
+        ):
+            GuestModule.parse_config(
+                {
+                    "reaper_lease_ttl_seconds": 1,
+                }
+            )
+
+    async def test_parse_config_fail_reaper_worker_name(self) -> None:
+        with self.assertRaisesRegex(
+            ConfigError, "Config option 'reaper_worker_name' must be a string"
+        ):
+            GuestModule.parse_config(
+                {
+                    "reaper_worker_name": 1,
+                }
+            )
+
+    async def test_parse_config_fail_reaper_max_attempts(self) -> None:
+        with self.assertRaisesRegex(
+            ConfigError, "Config option 'reaper_max_attempts' must be a positive number"
+        ):
+            GuestModule.parse_config(
+                {
+                    "reaper_max_attempts": 0,
+                }
+            )
+
+    async def test_parse_config_fail_reaper_lock_expired_users(self) -> None:
+        with self.assertRaisesRegex(
+            ConfigError, "Config option 'reaper_lock_expired_users' must be a bool"
+        ):
+            GuestModule.parse_config(
+                {
+                    "reaper_lock_expired_users": "yes",
+                }
+            )
+
+    async def test_parse_config_fail_reaper_deactivations_per_second(self) -> None:
+        with self.assertRaisesRegex(
+            ConfigError,
+            "Config option 'reaper_deactivations_per_second' must be a non-negative number",
+        ):
+            GuestModule.parse_config(
+                {
+                    "reaper_deactivations_per_second": -1,
+                }
+            )
+
+    async def test_parse_config_fail_reaper_room_leave_limit(self) -> None:
+        with self.assertRaisesRegex(
+            ConfigError,
+            "Config option 'reaper_room_leave_limit' must be a non-negative number",
+        ):
+            GuestModule.parse_config(
+                {
+                    "reaper_room_leave_limit": "10",
+                }
+            )
+
+    async def test_parse_config_fail_bulk_registration_max_size(self) -> None:
+        with self.assertRaisesRegex(
+            ConfigError,
+            "Config option 'bulk_registration_max_size' must be a positive number",
+        ):
+            GuestModule.parse_config(
+                {
+                    "bulk_registration_max_size": 0,
+                }
+            )
+
+    async def test_parse_config_fail_bulk_registration_max_concurrency(self) -> None:
+        with self.assertRaisesRegex(
+            ConfigError,
+            "Config option 'bulk_registration_max_concurrency' must be a positive number",
+        ):
+            GuestModule.parse_config(
+                {
+                    "bulk_registration_max_concurrency": "4",
+                }
+            )
+
+    async def test_parse_config_fail_slow_call_threshold_ms(self) -> None:
+        with self.assertRaisesRegex(
+            ConfigError,
+            "Config option 'slow_call_threshold_ms' must be a non-negative number",
+        ):
+            GuestModule.parse_config(
+                {
+                    "slow_call_threshold_ms": -1,
+                }
+            )
+
+    async def test_parse_config_fail_guest_access_token_lifetime_seconds(self) -> None:
+        with self.assertRaisesRegex(
+            ConfigError,
+            "Config option 'guest_access_token_lifetime_seconds' must be a non-negative number",
+        ):
+            GuestModule.parse_config(
+                {
+                    "guest_access_token_lifetime_seconds": "300",
+                }
+            )
+
+    async def test_parse_config_fail_display_name_enforcement(self) -> None:
+        with self.assertRaisesRegex(
+            ConfigError,
+            "Config option 'display_name_enforcement' must be 'set_displayname' or 'in_place'",
+        ):
+            GuestModule.parse_config(
+                {
+                    "display_name_enforcement": "before",
+                }
+            )
+
+    async def test_parse_config_fail_reaper_media_cleanup(self) -> None:
+        with self.assertRaisesRegex(
+            ConfigError,
+            "Config option 'reaper_media_cleanup' must be 'off', 'delete' or 'quarantine'",
+        ):
+            GuestModule.parse_config(
+                {
+                    "reaper_media_cleanup": True,
+                }
+            )
+
+    async def test_parse_config_fail_reaper_media_per_second(self) -> None:
+        with self.assertRaisesRegex(
+            ConfigError,
+            "Config option 'reaper_media_per_second' must be a non-negative number",
+        ):
+            GuestModule.parse_config(
+                {
+                    "reaper_media_per_second": -1,
+                }
+            )
+
+    async def test_parse_config_fail_reaper_purge_after_seconds(self) -> None:
+        with self.assertRaisesRegex(
+            ConfigError,
+            "Config option 'reaper_purge_after_seconds' must be a non-negative number",
+        ):
+            GuestModule.parse_config(
+                {
+                    "reaper_purge_after_seconds": "1y",
+                }
+            )
+
+    async def test_parse_config_fail_reaper_purge_batch_size(self) -> None:
+        with self.assertRaisesRegex(
+            ConfigError,
+            "Config option 'reaper_purge_batch_size' must be a positive number",
+        ):
+            GuestModule.parse_config(
+                {
+                    "reaper_purge_batch_size": 0,
+                }
+            )
+
+    async def test_parse_config_fail_reaper_purges_per_second(self) -> None:
+        with self.assertRaisesRegex(
+            ConfigError,
+            "Config option 'reaper_purges_per_second' must be a non-negative number",
+        ):
+            GuestModule.parse_config(
+                {
+                    "reaper_purges_per_second": -1,
+                }
+            )
+
+    async def test_parse_config_fail_reaper_purge_dry_run(self) -> None:
+        with self.assertRaisesRegex(
+            ConfigError, "Config option 'reaper_purge_dry_run' must be a bool"
+        ):
+            GuestModule.parse_config(
+                {
+                    "reaper_purge_dry_run": "yes",
+                }
+            )
+
+    async def test_parse_config_fail_registration_idempotency_cache_size(
+        self,
+    ) -> None:
+        with self.assertRaisesRegex(
+            ConfigError,
+            "Config option 'registration_idempotency_cache_size' must be a non-negative number",
+        ):
+            GuestModule.parse_config(
+                {
+                    "registration_idempotency_cache_size": -1,
+                }
+            )
+
+    async def test_parse_config_fail_registration_idempotency_ttl_seconds(
+        self,
+    ) -> None:
+        with self.assertRaisesRegex(
+            ConfigError,
+            "Config option 'registration_idempotency_ttl_seconds' must be a positive number",
+        ):
+            GuestModule.parse_config(
+                {
+                    "registration_idempotency_ttl_seconds": 0,
+                }
+            )
+
+    async def test_parse_config_fail_guest_max_joined_rooms(self) -> None:
+        with self.assertRaisesRegex(
+            ConfigError,
+            "Config option 'guest_max_joined_rooms' must be a non-negative number",
+        ):
+            GuestModule.parse_config(
+                {
+                    "guest_max_joined_rooms": -1,
+                }
+            )
+
+    async def test_reaper_pinned_to_other_worker(self) -> None:
+        with patch(
+            "synapse_guest_module.guest_module.run_as_background_process"
+        ) as run_as_background_process:
+            create_module(
+                {"enable_user_reaper": True, "reaper_worker_name": "background_worker"}
+            )
+
+        run_as_background_process.assert_not_called()
+
+    async def test_reaper_pinned_to_this_worker(self) -> None:
+        with patch(
+            "synapse_guest_module.guest_module.run_as_background_process"
+        ) as run_as_background_process:
+            module, _, _ = create_module(
+                {"enable_user_reaper": True, "reaper_worker_name": "master"}
+            )
+
+        run_as_background_process.assert_called_once_with(
+            "guest_module_reaper_bg_task", module.reaper.run, bg_start_span=False
+        )
+
     async def test_profile_update_no_guest(self) -> None:
         module, module_api, _ = create_module()
 
@@ -135,6 +546,112 @@ class GuestModuleTest(aiounittest.AsyncTestCase):
             "My User (Guest)",
         )
 
+    async def test_profile_update_guest_deactivation(self) -> None:
+        module, module_api, _ = create_module()
+
+        await module.profile_update(
+            "@guest-asdf:matrix.local",
+            ProfileInfo(display_name=None, avatar_url=None),
+            True,
+            True,
+        )
+
+        module_api.set_displayname.assert_not_called()
+
+    async def test_profile_update_guest_not_reentrant(self) -> None:
+        module, module_api, _ = create_module({"display_name_suffix": " (Guest) "})
+
+        # the homeserver strips the name and calls the callback again
+        async def set_displayname(user_id: UserID, display_name: str) -> None:
+            await module.profile_update(
+                user_id.to_string(),
+                ProfileInfo(display_name=display_name.strip(), avatar_url=None),
+                True,
+                False,
+            )
+
+        module_api.set_displayname.side_effect = set_displayname
+
+        await module.profile_update(
+            "@guest-asdf:matrix.local",
+            ProfileInfo(display_name="My User", avatar_url=None),
+            True,
+            False,
+        )
+
+        module_api.set_displayname.assert_awaited_once_with(
+            UserID.from_string("@guest-asdf:matrix.local"),
+            "My User (Guest) ",
+        )
+
+    async def test_profile_update_guest_interleaved_renames(self) -> None:
+        module, module_api, _ = create_module()
+        first_correction: "defer.Deferred[None]" = defer.Deferred()
+        names: List[str] = []
+
+        async def set_displayname(user_id: UserID, display_name: str) -> None:
+            names.append(display_name)
+            if len(names) == 1:
+                await make_deferred_yieldable(first_correction)
+
+        module_api.set_displayname.side_effect = set_displayname
+
+        # the guest renames itself again while the first name is corrected
+        first = defer.ensureDeferred(
+            module.profile_update(
+                "@guest-asdf:matrix.local",
+                ProfileInfo(display_name="A", avatar_url=None),
+                True,
+                False,
+            )
+        )
+        await module.profile_update(
+            "@guest-asdf:matrix.local",
+            ProfileInfo(display_name="Mallory", avatar_url=None),
+            True,
+            False,
+        )
+        first_correction.callback(None)
+        await first
+
+        self.assertEqual(names, ["A (Guest)", "Mallory (Guest)"])
+        self.assertEqual(module._correcting_display_names, {})
+
+    async def test_profile_update_guest_in_place(self) -> None:
+        module, module_api, _ = create_module({"display_name_enforcement": "in_place"})
+
+        profile_handler = module_api._hs.get_profile_handler()
+
+        # the handler notifies the modules about the corrected name again
+        async def dispatch_set_profile_field(**kwargs: Any) -> None:
+            await module.profile_update(
+                "@guest-asdf:matrix.local",
+                ProfileInfo(display_name="My User (Guest)", avatar_url=None),
+                True,
+                False,
+            )
+
+        profile_handler.dispatch_set_profile_field.side_effect = (
+            dispatch_set_profile_field
+        )
+
+        await module.profile_update(
+            "@guest-asdf:matrix.local",
+            ProfileInfo(display_name="My User ", avatar_url="mxc://matrix.local/a"),
+            False,
+            False,
+        )
+
+        module_api.set_displayname.assert_not_called()
+        profile_handler.dispatch_set_profile_field.assert_called_once_with(
+            target_user=UserID.from_string("@guest-asdf:matrix.local"),
+            requester=ANY,
+            field_name="displayname",
+            new_value="My User (Guest)",
+            by_admin=True,
+            propagate=False,
+        )
+
     async def test_callback_user_may_create_room_no_guest(self) -> None:
         module, _, _ = create_module()
 
@@ -153,6 +670,24 @@ class GuestModuleTest(aiounittest.AsyncTestCase):
 
         self.assertFalse(allow)
 
+    async def test_callback_metrics(self) -> None:
+        module, _, _ = create_module()
+
+        calls = get_sample_value(
+            "synapse_guest_module_callback_seconds_count",
+            {"callback": "user_may_create_room"},
+        )
+
+        await module.callback_user_may_create_room("@guest-asdf:matrix.local")
+
+        self.assertEqual(
+            get_sample_value(
+                "synapse_guest_module_callback_seconds_count",
+                {"callback": "user_may_create_room"},
+            ),
+            calls + 1,
+        )
+
     async def test_callback_user_may_invite_no_guest(self) -> None:
         module, _, _ = create_module()
 
@@ -200,3 +735,261 @@ class GuestModuleTest(aiounittest.AsyncTestCase):
         )
 
         self.assertTrue(allow)
+
+    async def test_callback_user_may_join_room_no_guest(self) -> None:
+        module, module_api, _ = create_module()
+
+        allow = await module.callback_user_may_join_room(
+            "@my-user:matrix.local", "!room:matrix.local", False
+        )
+
+        self.assertEqual(allow, NOT_SPAM)
+        module_api.get_state_events_in_room.assert_not_called()
+
+    async def test_callback_user_may_join_room_guest_invited(self) -> None:
+        module, module_api, _ = create_module()
+
+        allow = await module.callback_user_may_join_room(
+            "@guest-asdf:matrix.local", "!room:matrix.local", True
+        )
+
+        self.assertEqual(allow, NOT_SPAM)
+        module_api.get_state_events_in_room.assert_not_called()
+
+    async def test_callback_user_may_join_room_guest_knock(self) -> None:
+        module, module_api, _ = create_module()
+
+        module_api.get_state_events_in_room.return_value = make_awaitable(
+            [
+                make_state_event(
+                    "m.room.join_rules",
+                    "",
+                    "!room:matrix.local",
+                    {"join_rule": "knock"},
+                )
+            ]
+        )
+
+        allow = await module.callback_user_may_join_room(
+            "@guest-asdf:matrix.local", "!room:matrix.local", False
+        )
+
+        self.assertEqual(allow, NOT_SPAM)
+
+    async def test_callback_user_may_join_room_slow_call_log(self) -> None:
+        module, module_api, _ = create_module({"slow_call_threshold_ms": 1})
+
+        async def get_state_events_in_room(*args: Any) -> List[EventBase]:
+            time.sleep(0.002)
+            return [
+                make_state_event(
+                    "m.room.join_rules",
+                    "",
+                    "!room:matrix.local",
+                    {"join_rule": "knock"},
+                )
+            ]
+
+        module_api.get_state_events_in_room.side_effect = get_state_events_in_room
+
+        with self.assertLogs(
+            "synapse.contrib.synapse_guest_module.tracing", "WARNING"
+        ) as logs:
+            await module.callback_user_may_join_room(
+                "@guest-asdf:matrix.local", "!room:matrix.local", False
+            )
+
+        self.assertEqual(len(logs.output), 2)
+        self.assertRegex(
+            logs.output[0],
+            r"Slow call get_join_rules took [0-9.]+ ms room_id=!room:matrix.local$",
+        )
+        self.assertRegex(
+            logs.output[1],
+            r"Slow call user_may_join_room took [0-9.]+ ms guest=True "
+            r"room_id=!room:matrix.local join_rule_cache=miss$",
+        )
+
+    async def test_callback_user_may_join_room_guest_public(self) -> None:
+        module, module_api, _ = create_module()
+
+        module_api.get_state_events_in_room.return_value = make_awaitable(
+            [
+                make_state_event(
+                    "m.room.join_rules",
+                    "",
+                    "!room:matrix.local",
+                    {"join_rule": "public"},
+                )
+            ]
+        )
+
+        allow = await module.callback_user_may_join_room(
+            "@guest-asdf:matrix.local", "!room:matrix.local", False
+        )
+
+        self.assertEqual(allow, errors.Codes.FORBIDDEN)
+
+    async def test_callback_user_may_join_room_guest_no_join_rules(self) -> None:
+        module, module_api, _ = create_module()
+
+        module_api.get_state_events_in_room.return_value = make_awaitable([])
+
+        allow = await module.callback_user_may_join_room(
+            "@guest-asdf:matrix.local", "!room:matrix.local", False
+        )
+
+        self.assertEqual(allow, errors.Codes.BAD_STATE)
+
+    async def test_callback_user_may_join_room_guest_cached(self) -> None:
+        module, module_api, _ = create_module({"join_rule_cache_size": 10})
+
+        module_api.get_state_events_in_room.return_value = make_awaitable(
+            [
+                make_state_event(
+                    "m.room.join_rules",
+                    "",
+                    "!room:matrix.local",
+                    {"join_rule": "knock"},
+                )
+            ]
+        )
+
+        for _ in range(3):
+            allow = await module.callback_user_may_join_room(
+                "@guest-asdf:matrix.local", "!room:matrix.local", False
+            )
+            self.assertEqual(allow, NOT_SPAM)
+
+        module_api.get_state_events_in_room.assert_called_once()
+
+    async def test_callback_user_may_join_room_guest_joined_rooms_limit(
+        self,
+    ) -> None:
+        module, module_api, _ = create_module({"guest_max_joined_rooms": 2})
+
+        store = module_api._hs.get_datastores().main
+        store.get_rooms_for_user.side_effect = [
+            make_awaitable(frozenset(["!a:matrix.local"])),
+            make_awaitable(frozenset(["!a:matrix.local", "!b:matrix.local"])),
+        ]
+
+        allow = await module.callback_user_may_join_room(
+            "@guest-asdf:matrix.local", "!b:matrix.local", True
+        )
+        self.assertEqual(allow, NOT_SPAM)
+
+        # the counter knows both rooms without reading them again
+        allow = await module.callback_user_may_join_room(
+            "@guest-asdf:matrix.local", "!b:matrix.local", True
+        )
+        self.assertEqual(allow, NOT_SPAM)
+        store.get_rooms_for_user.assert_called_once_with("@guest-asdf:matrix.local")
+
+        # the rooms are read again before the join is rejected
+        allow = await module.callback_user_may_join_room(
+            "@guest-asdf:matrix.local", "!c:matrix.local", True
+        )
+        self.assertEqual(allow, errors.Codes.FORBIDDEN)
+        self.assertEqual(store.get_rooms_for_user.call_count, 2)
+
+    async def test_callback_user_may_join_room_guest_joined_rooms_reload(
+        self,
+    ) -> None:
+        module, module_api, _ = create_module({"guest_max_joined_rooms": 1})
+
+        store = module_api._hs.get_datastores().main
+        store.get_rooms_for_user.side_effect = [
+            make_awaitable(frozenset(["!a:matrix.local"])),
+            make_awaitable(frozenset()),
+        ]
+
+        allow = await module.callback_user_may_join_room(
+            "@guest-asdf:matrix.local", "!a:matrix.local", True
+        )
+        self.assertEqual(allow, NOT_SPAM)
+
+        # the user left the room on another worker
+        allow = await module.callback_user_may_join_room(
+            "@guest-asdf:matrix.local", "!b:matrix.local", True
+        )
+        self.assertEqual(allow, NOT_SPAM)
+        self.assertEqual(store.get_rooms_for_user.call_count, 2)
+
+    async def test_on_new_event_updates_joined_rooms(self) -> None:
+        module, module_api, _ = create_module({"guest_max_joined_rooms": 1})
+
+        store = module_api._hs.get_datastores().main
+        store.get_rooms_for_user.return_value = make_awaitable(frozenset())
+
+        allow = await module.callback_user_may_join_room(
+            "@guest-asdf:matrix.local", "!a:matrix.local", True
+        )
+        self.assertEqual(allow, NOT_SPAM)
+
+        await module.on_new_event(
+            make_state_event(
+                "m.room.member",
+                "@guest-asdf:matrix.local",
+                "!a:matrix.local",
+                {"membership": "leave"},
+            ),
+            {},
+        )
+
+        allow = await module.callback_user_may_join_room(
+            "@guest-asdf:matrix.local", "!b:matrix.local", True
+        )
+        self.assertEqual(allow, NOT_SPAM)
+        store.get_rooms_for_user.assert_called_once()
+
+    def test_on_new_event_registration(self) -> None:
+        _, module_api, _ = create_module({"join_rule_cache_size": 10})
+        callbacks = module_api.register_third_party_rules_callbacks.call_args
+        self.assertIsNotNone(callbacks.kwargs["on_new_event"])
+
+        _, module_api, _ = create_module({"guest_max_joined_rooms": 1})
+        callbacks = module_api.register_third_party_rules_callbacks.call_args
+        self.assertIsNotNone(callbacks.kwargs["on_new_event"])
+
+        # nothing has to be updated, so events are not passed to the module
+        _, module_api, _ = create_module()
+        callbacks = module_api.register_third_party_rules_callbacks.call_args
+        self.assertIsNone(callbacks.kwargs["on_new_event"])
+
+    async def test_on_new_event_updates_join_rule(self) -> None:
+        module, module_api, _ = create_module({"join_rule_cache_size": 10})
+
+        for join_rule, expected in [
+            ("knock", NOT_SPAM),
+            ("invite", errors.Codes.FORBIDDEN),
+        ]:
+            event = make_state_event(
+                "m.room.join_rules", "", "!room:matrix.local", {"join_rule": join_rule}
+            )
+            await module.on_new_event(event, {("m.room.join_rules", ""): event})
+
+            allow = await module.callback_user_may_join_room(
+                "@guest-asdf:matrix.local", "!room:matrix.local", False
+            )
+            self.assertEqual(allow, expected)
+
+        module_api.get_state_events_in_room.assert_not_called()
+
+    async def test_on_new_event_join_rule_lost_state_resolution(self) -> None:
+        module, module_api, _ = create_module({"join_rule_cache_size": 10})
+
+        # the new event didn't become part of the current state of the room
+        event = make_state_event(
+            "m.room.join_rules", "", "!room:matrix.local", {"join_rule": "knock"}
+        )
+        current_event = make_state_event(
+            "m.room.join_rules", "", "!room:matrix.local", {"join_rule": "invite"}
+        )
+        await module.on_new_event(event, {("m.room.join_rules", ""): current_event})
+
+        allow = await module.callback_user_may_join_room(
+            "@guest-asdf:matrix.local", "!room:matrix.local", False
+        )
+        self.assertEqual(allow, errors.Codes.FORBIDDEN)
+        module_api.get_state_events_in_room.assert_not_called()
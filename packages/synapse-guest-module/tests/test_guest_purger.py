@@ -0,0 +1,219 @@
+# Copyright 2023 Nordeck IT + Consulting GmbH
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import sqlite3
+from unittest.mock import ANY, call
+
+import aiounittest
+from synapse.types import UserID
+
+from tests import create_module
+
+
+def insert_guests(conn: sqlite3.Connection) -> None:
+    conn.executemany(
+        "INSERT INTO guest_module_guests VALUES (?, ?, ?, ?)",
+        [
+            ["@guest-1:matrix.local", 0, 1000, "deactivated"],
+            ["@guest-2:matrix.local", 0, 2000, "deactivated"],
+            ["@guest-3:matrix.local", 0, 3000, "deactivated"],
+            ["@guest-recent:matrix.local", 0, 9000, "deactivated"],
+            ["@guest-expired:matrix.local", 0, 1000, "expired"],
+        ],
+    )
+    conn.executemany(
+        "INSERT INTO profiles VALUES (?, ?)",
+        [
+            ["@guest-1:matrix.local", ""],
+            ["@guest-recent:matrix.local", ""],
+            ["@user-1:matrix.local", "User"],
+        ],
+    )
+    conn.executemany(
+        "INSERT INTO users_who_share_private_rooms VALUES (?, ?)",
+        [
+            ["@guest-1:matrix.local", "@user-1:matrix.local"],
+            ["@user-1:matrix.local", "@guest-1:matrix.local"],
+            ["@user-1:matrix.local", "@user-2:matrix.local"],
+        ],
+    )
+
+
+class GuestPurgerTest(aiounittest.AsyncTestCase):
+    async def test_count_purgeable(self) -> None:
+        module, _, store = create_module(
+            {"reaper_purge_after_seconds": 60, "reaper_media_cleanup": "delete"}
+        )
+
+        await module.registry.setup()
+        insert_guests(store.conn)
+
+        # users whose media is not reclaimed yet are not purged, unless their
+        # media cleanup is parked
+        store.conn.executemany(
+            "INSERT INTO guest_module_media_cleanup (user_id, state) VALUES (?, ?)",
+            [
+                ["@guest-2:matrix.local", "parked"],
+                ["@guest-3:matrix.local", "pending"],
+            ],
+        )
+
+        self.assertEqual(await module.reaper.purger.count_purgeable(5000), 2)
+
+    async def test_purge_with_media_cleanup_off(self) -> None:
+        module, _, store = create_module({"reaper_purge_after_seconds": 60})
+
+        await module.registry.setup()
+        insert_guests(store.conn)
+
+        # users that were enqueued before the media cleanup was disabled
+        store.conn.executemany(
+            "INSERT INTO guest_module_media_cleanup (user_id, state) VALUES (?, ?)",
+            [
+                ["@guest-1:matrix.local", "pending"],
+                ["@guest-2:matrix.local", "parked"],
+            ],
+        )
+
+        self.assertEqual(await module.reaper.purger.count_purgeable(5000), 3)
+        self.assertEqual(
+            await module.reaper.purger.purge(5000),
+            [
+                "@guest-1:matrix.local",
+                "@guest-2:matrix.local",
+                "@guest-3:matrix.local",
+            ],
+        )
+        self.assertEqual(
+            store.conn.execute(
+                "SELECT user_id FROM guest_module_media_cleanup"
+            ).fetchall(),
+            [("@guest-2:matrix.local",)],
+        )
+
+    async def test_purge(self) -> None:
+        module, _, store = create_module(
+            {"reaper_purge_after_seconds": 60, "reaper_purge_batch_size": 2}
+        )
+
+        await module.registry.setup()
+        insert_guests(store.conn)
+
+        self.assertEqual(
+            await module.reaper.purger.purge(5000),
+            ["@guest-1:matrix.local", "@guest-2:matrix.local"],
+        )
+
+        self.assertEqual(
+            store.conn.execute(
+                "SELECT user_id FROM guest_module_guests ORDER BY user_id"
+            ).fetchall(),
+            [
+                ("@guest-3:matrix.local",),
+                ("@guest-expired:matrix.local",),
+                ("@guest-recent:matrix.local",),
+            ],
+        )
+        self.assertEqual(
+            store.conn.execute(
+                "SELECT full_user_id FROM profiles ORDER BY full_user_id"
+            ).fetchall(),
+            [("@guest-recent:matrix.local",), ("@user-1:matrix.local",)],
+        )
+        self.assertEqual(
+            store.conn.execute(
+                "SELECT * FROM users_who_share_private_rooms"
+            ).fetchall(),
+            [("@user-1:matrix.local", "@user-2:matrix.local")],
+        )
+
+    async def test_purge_invalidates_caches(self) -> None:
+        module, module_api, store = create_module(
+            {"reaper_purge_after_seconds": 60, "reaper_purge_batch_size": 2}
+        )
+
+        await module.registry.setup()
+        insert_guests(store.conn)
+        store.conn.executemany(
+            "INSERT INTO user_filters VALUES (?, ?)",
+            [["@guest-1:matrix.local", 0], ["@user-1:matrix.local", 0]],
+        )
+        store.conn.executemany(
+            "INSERT INTO e2e_cross_signing_signatures VALUES (?, ?)",
+            [
+                ["@guest-2:matrix.local", "MASTERKEY"],
+                ["@guest-2:matrix.local", "MASTERKEY"],
+                ["@user-1:matrix.local", "MASTERKEY"],
+            ],
+        )
+
+        main_store = module_api._hs.get_datastores().main
+
+        # the local caches are only invalidated after the transaction
+        def assert_purged(*args: object) -> None:
+            self.assertEqual(
+                store.conn.execute(
+                    "SELECT * FROM e2e_cross_signing_signatures"
+                ).fetchall(),
+                [("@user-1:matrix.local", "MASTERKEY")],
+            )
+
+        signatures_cache = main_store._get_e2e_cross_signing_signatures_for_device
+        signatures_cache.__name__ = "_get_e2e_cross_signing_signatures_for_device"
+        signatures_cache.invalidate.side_effect = assert_purged
+
+        await module.reaper.purger.purge(5000)
+
+        keys = [("@guest-1:matrix.local",), ("@guest-2:matrix.local",)]
+        main_store._invalidate_cache_and_stream_bulk.assert_has_calls(
+            [
+                call(ANY, main_store.user_last_seen_monthly_active, keys),
+                call(ANY, main_store._get_bare_e2e_cross_signing_keys, keys),
+            ],
+            any_order=True,
+        )
+        main_store._invalidate_cache_and_stream.assert_has_calls(
+            [
+                call(ANY, main_store.get_monthly_active_count, ()),
+                call(ANY, main_store.get_monthly_active_count_by_service, ()),
+            ],
+            any_order=True,
+        )
+        signatures_cache.invalidate.assert_called_once_with(
+            (("@guest-2:matrix.local", "MASTERKEY"),)
+        )
+        main_store._send_invalidation_to_replication_bulk.assert_called_once_with(
+            ANY,
+            cache_name="_get_e2e_cross_signing_signatures_for_device",
+            key_tuples=[('["@guest-2:matrix.local", "MASTERKEY"]',)],
+        )
+        main_store.get_user_filter.invalidate.assert_called_once_with(
+            (UserID.from_string("@guest-1:matrix.local"), 0)
+        )
+
+    async def test_purge_without_users_keeps_caches(self) -> None:
+        module, module_api, store = create_module({"reaper_purge_after_seconds": 60})
+
+        await module.registry.setup()
+
+        self.assertEqual(await module.reaper.purger.purge(5000), [])
+
+        main_store = module_api._hs.get_datastores().main
+        main_store._invalidate_cache_and_stream_bulk.assert_not_called()
+        main_store._invalidate_cache_and_stream.assert_not_called()
+
+    async def test_get_purge_before_ts(self) -> None:
+        module, _, _ = create_module({"reaper_purge_after_seconds": 60})
+
+        self.assertEqual(module.reaper.purger.get_purge_before_ts(100000), 40000)
@@ -14,13 +14,19 @@
 
 import io
 from typing import cast
-from unittest.mock import ANY
+from unittest.mock import ANY, patch
 
 import aiounittest
+from synapse.logging.context import make_deferred_yieldable
+from synapse.module_api.errors import Codes, SynapseError
+from twisted.internet import defer
+from twisted.internet.address import IPv4Address
+from twisted.internet.interfaces import IAddress
 from twisted.web.server import Request
 from twisted.web.test.requesthelper import DummyRequest
 
-from tests import create_module, make_awaitable
+from synapse_guest_module.guest_registration_servlet import generate_random_string
+from tests import create_module, get_sample_value, make_awaitable, mock_token_handlers
 
 
 class GuestUserReaperTest(aiounittest.AsyncTestCase):
@@ -67,9 +73,97 @@ class GuestUserReaperTest(aiounittest.AsyncTestCase):
 
         self.assertEqual(module_api.check_user_exists.call_count, 10)
 
-    async def test_async_render_POST_success(self) -> None:
+    async def test_async_render_POST_metrics(self) -> None:
         module, module_api, _ = create_module()
 
+        registered = get_sample_value(
+            "synapse_guest_module_registrations_total", {"outcome": "registered"}
+        )
+        no_free_username = get_sample_value(
+            "synapse_guest_module_registrations_total",
+            {"outcome": "no_free_username"},
+        )
+        register_user = get_sample_value(
+            "synapse_guest_module_registration_step_seconds_count",
+            {"step": "register_user"},
+        )
+
+        request = cast(Request, DummyRequest([]))
+        request.content = io.BytesIO(b'{"displayname":"My Name"}')
+        await module.registration_servlet._async_render_POST(request)
+
+        module_api.check_user_exists.return_value = make_awaitable(True)
+
+        request = cast(Request, DummyRequest([]))
+        request.content = io.BytesIO(b'{"displayname":"My Name"}')
+        await module.registration_servlet._async_render_POST(request)
+
+        self.assertEqual(
+            get_sample_value(
+                "synapse_guest_module_registrations_total", {"outcome": "registered"}
+            ),
+            registered + 1,
+        )
+        self.assertEqual(
+            get_sample_value(
+                "synapse_guest_module_registrations_total",
+                {"outcome": "no_free_username"},
+            ),
+            no_free_username + 1,
+        )
+        self.assertEqual(
+            get_sample_value(
+                "synapse_guest_module_registration_step_seconds_count",
+                {"step": "register_user"},
+            ),
+            register_user + 1,
+        )
+
+    async def test_async_render_POST_expiring_token(self) -> None:
+        module, module_api, _ = create_module(
+            {"guest_access_token_lifetime_seconds": 300}
+        )
+        mock_token_handlers(module_api)
+
+        request = cast(Request, DummyRequest([]))
+        request.content = io.BytesIO(b'{"displayname":"My Name"}')
+
+        status, response = await module.registration_servlet._async_render_POST(request)
+
+        self.assertEqual(status, 201)
+        self.assertEqual(response["deviceId"], "GUESTDEVICE")
+        self.assertEqual(response["accessToken"], "syt_access_token")
+        self.assertEqual(response["refreshToken"], "syr_refresh_token")
+        self.assertGreater(response["expiresInMs"], 290 * 1000)
+        self.assertLessEqual(response["expiresInMs"], 300 * 1000)
+        module_api.register_device.assert_not_called()
+
+    async def test_async_render_POST_spans(self) -> None:
+        module, _, _ = create_module()
+
+        request = cast(Request, DummyRequest([]))
+        request.content = io.BytesIO(b'{"displayname":"My Name"}')
+
+        with patch(
+            "synapse_guest_module.tracing.opentracing.start_active_span"
+        ) as start_active_span:
+            await module.registration_servlet._async_render_POST(request)
+
+        self.assertEqual(
+            [c.args[0] for c in start_active_span.call_args_list],
+            [
+                "guest_module.registration",
+                "guest_module.registration.wait_for_slot",
+                "guest_module.registration.check_user_exists",
+                "guest_module.registration.record_guest",
+                "guest_module.registration.register_user",
+                "guest_module.registration.register_device",
+            ],
+        )
+
+    async def test_async_render_POST_success(self) -> None:
+        module, module_api, store = create_module()
+
         request = cast(Request, DummyRequest([]))
         request.content = io.BytesIO(b'{"displayname":"My Name "}')
 
@@ -77,7 +171,8 @@ class GuestUserReaperTest(aiounittest.AsyncTestCase):
 
         self.assertEqual(status, 201)
 
-        self.assertRegex(response.pop("userId"), r"^@guest-[A-Za-z0-9]+:matrix.local$")
+        user_id = response.pop("userId")
+        self.assertRegex(user_id, r"^@guest-[A-Za-z0-9]+:matrix.local$")
         self.assertDictEqual(
             response,
             {
@@ -89,3 +184,305 @@ class GuestUserReaperTest(aiounittest.AsyncTestCase):
         )
 
         module_api.register_user.assert_called_with(ANY, "My Name (Guest)")
+
+        self.assertEqual(
+            store.conn.execute(
+                "SELECT user_id, state FROM guest_module_guests"
+            ).fetchall(),
+            [(user_id, "active")],
+        )
+
+    async def test_async_render_POST_optimistic_success(self) -> None:
+        module, module_api, _ = create_module({"registration_mode": "optimistic"})
+
+        request = cast(Request, DummyRequest([]))
+        request.content = io.BytesIO(b'{"displayname":"My Name"}')
+
+        status, _ = await module.registration_servlet._async_render_POST(request)
+
+        self.assertEqual(status, 201)
+        module_api.check_user_exists.assert_not_called()
+        module_api.register_user.assert_called_once_with(ANY, "My Name (Guest)")
+
+    async def test_async_render_POST_optimistic_retry_on_duplicate(self) -> None:
+        module, module_api, store = create_module({"registration_mode": "optimistic"})
+
+        request = cast(Request, DummyRequest([]))
+        request.content = io.BytesIO(b'{"displayname":"My Name"}')
+
+        user_ids = []
+
+        async def register_user(localpart: str, displayname: str) -> str:
+            user_ids.append(localpart)
+            if len(user_ids) == 1:
+                raise SynapseError(400, "User ID already taken.", Codes.USER_IN_USE)
+            return f"@{localpart}:matrix.local"
+
+        module_api.register_user.side_effect = register_user
+
+        status, response = await module.registration_servlet._async_render_POST(request)
+
+        self.assertEqual(status, 201)
+        self.assertEqual(len(user_ids), 2)
+        self.assertNotEqual(user_ids[0], user_ids[1])
+        self.assertEqual(response["userId"], f"@{user_ids[1]}:matrix.local")
+
+        # the taken user id is removed from the registry again
+        self.assertEqual(
+            store.conn.execute("SELECT user_id FROM guest_module_guests").fetchall(),
+            [(f"@{user_ids[1]}:matrix.local",)],
+        )
+
+    async def test_async_render_POST_optimistic_no_free_username(self) -> None:
+        module, module_api, _ = create_module({"registration_mode": "optimistic"})
+
+        request = cast(Request, DummyRequest([]))
+        request.content = io.BytesIO(b'{"displayname":"My Name"}')
+
+        module_api.register_user.side_effect = SynapseError(
+            400, "User ID already taken.", Codes.USER_IN_USE
+        )
+
+        status, response = await module.registration_servlet._async_render_POST(request)
+
+        self.assertEqual(status, 500)
+        self.assertEqual(
+            response, {"msg": "Internal error: Could not find a free username"}
+        )
+        self.assertEqual(module_api.register_user.call_count, 10)
+
+    async def test_async_render_POST_optimistic_other_error(self) -> None:
+        module, module_api, _ = create_module({"registration_mode": "optimistic"})
+
+        request = cast(Request, DummyRequest([]))
+        request.content = io.BytesIO(b'{"displayname":"My Name"}')
+
+        module_api.register_user.side_effect = SynapseError(
+            400, "Invalid username", Codes.INVALID_USERNAME
+        )
+
+        with self.assertRaises(SynapseError):
+            await module.registration_servlet._async_render_POST(request)
+
+        self.assertEqual(module_api.register_user.call_count, 1)
+
+    async def test_async_render_POST_record_guest_fails(self) -> None:
+        module, module_api, _ = create_module()
+
+        request = cast(Request, DummyRequest([]))
+        request.content = io.BytesIO(b'{"displayname":"My Name"}')
+
+        with patch.object(
+            module.registry, "record_guest", side_effect=Exception("database error")
+        ):
+            with self.assertRaises(Exception):
+                await module.registration_servlet._async_render_POST(request)
+
+        # the reaper would never find a user that is not in the registry
+        module_api.register_user.assert_not_called()
+
+    async def test_async_render_POST_register_user_fails(self) -> None:
+        module, module_api, store = create_module({"registration_mode": "optimistic"})
+
+        request = cast(Request, DummyRequest([]))
+        request.content = io.BytesIO(b'{"displayname":"My Name"}')
+
+        module_api.register_user.side_effect = SynapseError(
+            500, "Internal error", Codes.UNKNOWN
+        )
+
+        with self.assertRaises(SynapseError):
+            await module.registration_servlet._async_render_POST(request)
+
+        # the reaper must not try to deactivate a user that doesn't exist
+        self.assertEqual(
+            store.conn.execute("SELECT * FROM guest_module_guests").fetchall(), []
+        )
+
+    async def test_async_render_POST_register_user_database_error(self) -> None:
+        module, module_api, store = create_module()
+
+        request = cast(Request, DummyRequest([]))
+        request.content = io.BytesIO(b'{"displayname":"My Name"}')
+
+        module_api.register_user.side_effect = Exception("database error")
+
+        with self.assertRaisesRegex(Exception, "database error"):
+            await module.registration_servlet._async_render_POST(request)
+
+        self.assertEqual(module_api.register_user.call_count, 1)
+        self.assertEqual(
+            store.conn.execute("SELECT * FROM guest_module_guests").fetchall(), []
+        )
+
+    async def test_async_render_POST_skips_recorded_user_id(self) -> None:
+        module, module_api, store = create_module({"registration_mode": "optimistic"})
+
+        request = cast(Request, DummyRequest([]))
+        request.content = io.BytesIO(b'{"displayname":"My Name"}')
+
+        await module.registry.setup()
+        store.conn.execute(
+            "INSERT INTO guest_module_guests VALUES ('@guest-taken:matrix.local', 0, 0, 'active')"
+        )
+
+        with patch(
+            "synapse_guest_module.guest_registration_servlet.generate_random_string",
+            side_effect=["taken", "free"],
+        ):
+            status, response = await module.registration_servlet._async_render_POST(
+                request
+            )
+
+        self.assertEqual(status, 201)
+        self.assertEqual(response["userId"], "@guest-free:matrix.local")
+        module_api.register_user.assert_called_once_with("guest-free", ANY)
+
+    def test_generate_random_string(self) -> None:
+        value = generate_random_string()
+
+        self.assertRegex(value, r"^[a-z0-9]{32}$")
+        self.assertNotEqual(value, generate_random_string())
+
+    async def test_async_render_POST_rate_limited(self) -> None:
+        module, module_api, _ = create_module(
+            {
+                "registration_rate_limit_per_second": 0.5,
+                "registration_rate_limit_burst": 1,
+            }
+        )
+
+        statuses = []
+        for _ in range(2):
+            request = cast(Request, DummyRequest([]))
+            request.client = cast(IAddress, IPv4Address("TCP", "10.0.0.1", 1234))
+            request.content = io.BytesIO(b'{"displayname":"My Name"}')
+
+            status, response = await module.registration_servlet._async_render_POST(
+                request
+            )
+            statuses.append(status)
+
+        self.assertEqual(statuses, [201, 429])
+        self.assertEqual(response, {"msg": "Too many requests, please try again later"})
+        self.assertEqual(request.responseHeaders.getRawHeaders(b"Retry-After"), [b"2"])
+        self.assertEqual(module_api.register_user.call_count, 1)
+
+    async def test_async_render_POST_queue_full(self) -> None:
+        module, module_api, _ = create_module(
+            {
+                "registration_max_in_flight": 1,
+                "registration_max_queue": 0,
+            }
+        )
+
+        # another registration is in progress
+        await module.registration_servlet._admission_controller.acquire()
+
+        request = cast(Request, DummyRequest([]))
+        request.content = io.BytesIO(b'{"displayname":"My Name"}')
+
+        status, response = await module.registration_servlet._async_render_POST(request)
+
+        self.assertEqual(status, 503)
+        self.assertEqual(
+            response, {"msg": "Too many registrations, please try again later"}
+        )
+        self.assertEqual(request.responseHeaders.getRawHeaders(b"Retry-After"), [b"1"])
+        module_api.register_user.assert_not_called()
+
+    async def test_async_render_POST_releases_slot(self) -> None:
+        module, _, _ = create_module({"registration_max_in_flight": 1})
+
+        for _ in range(3):
+            request = cast(Request, DummyRequest([]))
+            request.content = io.BytesIO(b'{"displayname":"My Name"}')
+
+            status, _ = await module.registration_servlet._async_render_POST(request)
+            self.assertEqual(status, 201)
+
+        self.assertEqual(module.registration_servlet._admission_controller.in_flight, 0)
+
+    async def test_async_render_POST_idempotency_key(self) -> None:
+        module, module_api, _ = create_module()
+
+        responses = []
+        for address in ["10.0.0.1", "10.0.0.1", "10.0.0.2"]:
+            request = cast(Request, DummyRequest([]))
+            request.client = cast(IAddress, IPv4Address("TCP", address, 1234))
+            request.requestHeaders.setRawHeaders(b"Idempotency-Key", [b"retry-1"])
+            request.content = io.BytesIO(b'{"displayname":"My Name"}')
+
+            responses.append(
+                await module.registration_servlet._async_render_POST(request)
+            )
+
+        # the retry gets the original credentials, another client with the
+        # same key gets a new user
+        self.assertEqual(responses[0], responses[1])
+        self.assertNotEqual(responses[0][1]["userId"], responses[2][1]["userId"])
+        self.assertEqual(module_api.register_user.call_count, 2)
+        self.assertEqual(module_api.register_device.call_count, 2)
+
+    async def test_async_render_POST_idempotency_key_retry_after(self) -> None:
+        module, module_api, _ = create_module()
+        servlet = module.registration_servlet
+        acquired: "defer.Deferred[bool]" = defer.Deferred()
+
+        requests = []
+        for _ in range(2):
+            request = cast(Request, DummyRequest([]))
+            request.requestHeaders.setRawHeaders(b"Idempotency-Key", [b"retry-1"])
+            request.content = io.BytesIO(b'{"displayname":"My Name"}')
+            requests.append(request)
+
+        with patch.object(
+            servlet._admission_controller,
+            "acquire",
+            new=lambda: make_deferred_yieldable(acquired),
+        ):
+            first = defer.ensureDeferred(servlet._async_render_POST(requests[0]))
+            duplicate = defer.ensureDeferred(servlet._async_render_POST(requests[1]))
+
+            acquired.callback(False)
+
+            self.assertEqual((await first)[0], 503)
+            self.assertEqual((await duplicate)[0], 503)
+
+        # the duplicate shares the response of the first request, including
+        # its headers
+        for request in requests:
+            self.assertEqual(
+                request.responseHeaders.getRawHeaders(b"Retry-After"), [b"1"]
+            )
+        module_api.register_user.assert_not_called()
+
+    async def test_async_render_POST_invalid_idempotency_key(self) -> None:
+        module, module_api, _ = create_module()
+
+        request = cast(Request, DummyRequest([]))
+        request.requestHeaders.setRawHeaders(b"Idempotency-Key", [b"x" * 256])
+        request.content = io.BytesIO(b'{"displayname":"My Name"}')
+
+        status, response = await module.registration_servlet._async_render_POST(request)
+
+        self.assertEqual(status, 400)
+        self.assertEqual(
+            response, {"msg": "The 'Idempotency-Key' must have 1 to 255 characters"}
+        )
+        module_api.register_user.assert_not_called()
+
+    async def test_async_render_POST_idempotency_disabled(self) -> None:
+        module, module_api, _ = create_module(
+            {"registration_idempotency_cache_size": 0}
+        )
+
+        for _ in range(2):
+            request = cast(Request, DummyRequest([]))
+            request.requestHeaders.setRawHeaders(b"Idempotency-Key", [b"retry-1"])
+            request.content = io.BytesIO(b'{"displayname":"My Name"}')
+
+            status, _ = await module.registration_servlet._async_render_POST(request)
+            self.assertEqual(status, 201)
+
+        self.assertEqual(module_api.register_user.call_count, 2)
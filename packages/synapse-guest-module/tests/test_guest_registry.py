@@ -0,0 +1,191 @@
+# Copyright 2023 Nordeck IT + Consulting GmbH
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import time
+from unittest.mock import patch
+
+import aiounittest
+
+from synapse_guest_module.guest_registry import GuestRegistry
+from tests import CursorWrapper, create_module
+
+
+class GuestRegistryTest(aiounittest.AsyncTestCase):
+    async def test_setup_backfill(self) -> None:
+        module, _, store = create_module()
+
+        store.conn.executemany(
+            "INSERT INTO users (name, deactivated, creation_ts) VALUES (?, ?, ?)",
+            [
+                ["@user-1:matrix.local", 0, 10],
+                ["@guest-reaper:matrix.local", 0, 10],
+                ["@guest-active:matrix.local", 0, 20],
+                ["@guest-deactivated:matrix.local", 1, 30],
+            ],
+        )
+
+        await module.registry.setup()
+
+        self.assertEqual(
+            store.conn.execute(
+                "SELECT * FROM guest_module_guests ORDER BY user_id"
+            ).fetchall(),
+            [
+                ("@guest-active:matrix.local", 20000, 86420000, "active"),
+                ("@guest-deactivated:matrix.local", 30000, 86430000, "deactivated"),
+            ],
+        )
+
+    async def test_setup_backfill_only_once(self) -> None:
+        module, module_api, store = create_module()
+
+        await module.registry.setup()
+
+        store.conn.execute(
+            "INSERT INTO users (name, deactivated, creation_ts) VALUES ('@guest-active:matrix.local', 0, 20)",
+        )
+
+        # a restarted module must not copy the users again
+        registry = GuestRegistry(module_api, module.registry._config)
+        await registry.setup()
+
+        self.assertEqual(
+            store.conn.execute("SELECT * FROM guest_module_guests").fetchall(), []
+        )
+
+    async def test_setup_concurrent_backfill(self) -> None:
+        module, module_api, store = create_module()
+
+        await module.registry.setup()
+
+        # another worker checked the migrations before the backfill finished
+        cursor = CursorWrapper(store.conn.cursor())
+        registry = GuestRegistry(module_api, module.registry._config)
+        with patch.object(cursor, "fetchone", return_value=None):
+            registry._setup_txn(cursor)  # type: ignore[arg-type]
+
+        self.assertEqual(
+            store.conn.execute("SELECT * FROM guest_module_migrations").fetchall(),
+            [("backfill_guests",)],
+        )
+
+    async def test_record_guest(self) -> None:
+        module, _, store = create_module()
+
+        now = int(time.time() * 1000)
+        await module.registry.record_guest("@guest-new:matrix.local")
+
+        rows = store.conn.execute("SELECT * FROM guest_module_guests").fetchall()
+        self.assertEqual(len(rows), 1)
+
+        user_id, created_ts, expires_ts, state = rows[0]
+        self.assertEqual(user_id, "@guest-new:matrix.local")
+        self.assertGreaterEqual(created_ts, now)
+        self.assertEqual(expires_ts, created_ts + 24 * 60 * 60 * 1000)
+        self.assertEqual(state, "active")
+
+    async def test_get_expired_guests(self) -> None:
+        module, _, store = create_module()
+
+        await module.registry.setup()
+        store.conn.executemany(
+            "INSERT INTO guest_module_guests VALUES (?, ?, ?, ?)",
+            [
+                ["@guest-1:matrix.local", 0, 100, "active"],
+                ["@guest-2:matrix.local", 0, 100, "active"],
+                ["@guest-3:matrix.local", 0, 200, "deactivated"],
+                ["@guest-4:matrix.local", 0, 300, "active"],
+                ["@guest-5:matrix.local", 0, 400, "active"],
+            ],
+        )
+
+        page = await module.registry.get_expired_guests(400, None, 2)
+        self.assertEqual(
+            page, [(100, "@guest-1:matrix.local"), (100, "@guest-2:matrix.local")]
+        )
+
+        page = await module.registry.get_expired_guests(400, page[-1], 2)
+        self.assertEqual(page, [(300, "@guest-4:matrix.local")])
+
+    async def test_get_expired_backlog(self) -> None:
+        module, _, store = create_module()
+
+        self.assertEqual(await module.registry.get_expired_backlog(400), (0, None))
+
+        store.conn.executemany(
+            "INSERT INTO guest_module_guests VALUES (?, ?, ?, ?)",
+            [
+                ["@guest-1:matrix.local", 0, 100, "deactivated"],
+                ["@guest-2:matrix.local", 0, 200, "active"],
+                ["@guest-3:matrix.local", 0, 300, "pooled"],
+                ["@guest-4:matrix.local", 0, 500, "active"],
+            ],
+        )
+
+        self.assertEqual(await module.registry.get_expired_backlog(400), (2, 200))
+
+    async def test_get_expired_guests_skips_deactivated_guests(self) -> None:
+        module, _, store = create_module()
+
+        await module.registry.setup()
+        store.conn.executemany(
+            "INSERT INTO guest_module_guests VALUES (?, ?, ?, ?)",
+            [[f"@guest-{i}:matrix.local", 0, i, "deactivated"] for i in range(100)],
+        )
+        store.conn.execute("ANALYZE")
+
+        # the deactivated guest users must not be scanned by the index
+        plan = store.conn.execute(
+            """
+            EXPLAIN QUERY PLAN
+            SELECT expires_ts, user_id
+            FROM guest_module_guests
+            WHERE state IN ('active', 'pooled')
+            AND expires_ts < 1000
+            ORDER BY expires_ts, user_id
+            LIMIT 10
+            """
+        ).fetchall()
+        self.assertIn(
+            "guest_module_guests_state_expires_ts (state=? AND expires_ts<?)",
+            plan[0][3],
+        )
+        self.assertEqual(await module.registry.get_expired_guests(1000, None, 10), [])
+
+    async def test_get_expired_backlog_skips_deactivated_guests(self) -> None:
+        module, _, store = create_module()
+
+        await module.registry.setup()
+        store.conn.executemany(
+            "INSERT INTO guest_module_guests VALUES (?, ?, ?, ?)",
+            [[f"@guest-{i}:matrix.local", 0, i, "deactivated"] for i in range(100)],
+        )
+        store.conn.execute("ANALYZE")
+
+        # the gauge is read every cycle, so it must not count through the
+        # deactivated guest users
+        plan = store.conn.execute(
+            """
+            EXPLAIN QUERY PLAN
+            SELECT COUNT(*), MIN(expires_ts)
+            FROM guest_module_guests
+            WHERE state IN ('active', 'pooled', 'expired')
+            AND expires_ts < 1000
+            """
+        ).fetchall()
+        self.assertIn(
+            "COVERING INDEX guest_module_guests_state_expires_ts (state=? AND expires_ts<?)",
+            plan[0][3],
+        )
+        self.assertEqual(await module.registry.get_expired_backlog(1000), (0, None))
@@ -0,0 +1,81 @@
+# Copyright 2023 Nordeck IT + Consulting GmbH
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+import time
+from typing import cast
+
+import aiounittest
+
+from synapse_guest_module.guest_tokens import GuestSession, GuestTokenIssuer
+from tests import create_module, mock_token_handlers
+
+
+class GuestTokenIssuerTest(aiounittest.AsyncTestCase):
+    async def test_register_device_without_expiry(self) -> None:
+        module, module_api, _ = create_module()
+        tokens = GuestTokenIssuer(module_api, module._config)
+
+        session = await tokens.register_device("@guest-1:matrix.local", 0)
+
+        self.assertFalse(tokens.enabled)
+        self.assertEqual(session, GuestSession("DEVICEID", "syn_registered_token"))
+        module_api.register_device.assert_called_once_with("@guest-1:matrix.local")
+
+    async def test_register_device_with_expiry(self) -> None:
+        module, module_api, _ = create_module(
+            {"guest_access_token_lifetime_seconds": 300}
+        )
+        auth_handler = mock_token_handlers(module_api)
+        tokens = GuestTokenIssuer(module_api, module._config)
+
+        now = int(time.time() * 1000)
+        session = await tokens.register_device(
+            "@guest-1:matrix.local", now + 3600 * 1000
+        )
+
+        self.assertEqual(session.device_id, "GUESTDEVICE")
+        self.assertEqual(session.access_token, "syt_access_token")
+        self.assertEqual(session.refresh_token, "syr_refresh_token")
+        access_token_expires_ts = cast(int, session.access_token_expires_ts)
+        self.assertGreaterEqual(access_token_expires_ts, now + 300 * 1000)
+        self.assertLess(access_token_expires_ts, now + 310 * 1000)
+
+        module_api.register_device.assert_not_called()
+        auth_handler.create_refresh_token_for_user_id.assert_called_once_with(
+            "@guest-1:matrix.local",
+            device_id="GUESTDEVICE",
+            expiry_ts=None,
+            ultimate_session_expiry_ts=now + 3600 * 1000,
+        )
+        auth_handler.create_access_token_for_user_id.assert_called_once_with(
+            "@guest-1:matrix.local",
+            device_id="GUESTDEVICE",
+            valid_until_ms=session.access_token_expires_ts,
+            refresh_token_id=5,
+        )
+
+    async def test_issue_tokens_capped_by_session(self) -> None:
+        module, module_api, _ = create_module(
+            {"guest_access_token_lifetime_seconds": 300}
+        )
+        mock_token_handlers(module_api)
+        tokens = GuestTokenIssuer(module_api, module._config)
+
+        now = int(time.time() * 1000)
+        session = await tokens.issue_tokens(
+            "@guest-1:matrix.local", "GUESTDEVICE", now + 60 * 1000
+        )
+
+        self.assertEqual(session.access_token_expires_ts, now + 60 * 1000)
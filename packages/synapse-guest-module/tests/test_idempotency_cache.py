@@ -0,0 +1,149 @@
+# Copyright 2023 Nordeck IT + Consulting GmbH
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from typing import List, Tuple
+from unittest.mock import patch
+
+import aiounittest
+from synapse.logging.context import (  # type: ignore[attr-defined]
+    SENTINEL_CONTEXT,
+    LoggingContext,
+    current_context,
+    make_deferred_yieldable,
+)
+from twisted.internet import defer
+
+from synapse_guest_module.idempotency_cache import IdempotencyCache, Response
+
+
+class IdempotencyCacheTest(aiounittest.AsyncTestCase):
+    async def test_replay(self) -> None:
+        cache = IdempotencyCache(10, 60)
+        calls = 0
+
+        async def handler() -> Response:
+            nonlocal calls
+            calls += 1
+            return 201, {"userId": f"@guest-{calls}:matrix.local"}, {}
+
+        first = await cache.run("key", handler)
+        second = await cache.run("key", handler)
+        other = await cache.run("other-key", handler)
+
+        self.assertEqual(first, ((201, {"userId": "@guest-1:matrix.local"}, {}), False))
+        self.assertEqual(second, ((201, {"userId": "@guest-1:matrix.local"}, {}), True))
+        self.assertEqual(other, ((201, {"userId": "@guest-2:matrix.local"}, {}), False))
+        self.assertEqual(calls, 2)
+
+    async def test_errors_are_not_cached(self) -> None:
+        cache = IdempotencyCache(10, 60)
+        responses: List[Response] = [
+            (503, {}, {"Retry-After": "1"}),
+            (201, {"userId": "@guest-1:matrix.local"}, {}),
+        ]
+
+        async def handler() -> Response:
+            return responses.pop(0)
+
+        self.assertEqual(
+            await cache.run("key", handler), ((503, {}, {"Retry-After": "1"}), False)
+        )
+        self.assertEqual(
+            await cache.run("key", handler),
+            ((201, {"userId": "@guest-1:matrix.local"}, {}), False),
+        )
+        self.assertEqual(len(cache), 1)
+
+    async def test_concurrent_duplicates_wait(self) -> None:
+        cache = IdempotencyCache(10, 60)
+        registration: "defer.Deferred[Response]" = defer.Deferred()
+        calls = 0
+
+        async def handler() -> Response:
+            nonlocal calls
+            calls += 1
+            return await make_deferred_yieldable(registration)
+
+        first = defer.ensureDeferred(cache.run("key", handler))
+        duplicate = defer.ensureDeferred(cache.run("key", handler))
+
+        self.assertFalse(first.called)
+        self.assertFalse(duplicate.called)
+
+        registration.callback((201, {"userId": "@guest-1:matrix.local"}, {}))
+
+        self.assertEqual(
+            await first, ((201, {"userId": "@guest-1:matrix.local"}, {}), False)
+        )
+        self.assertEqual(
+            await duplicate, ((201, {"userId": "@guest-1:matrix.local"}, {}), True)
+        )
+        self.assertEqual(calls, 1)
+
+    async def test_concurrent_duplicates_keep_logcontext(self) -> None:
+        cache = IdempotencyCache(10, 60)
+        registration: "defer.Deferred[Response]" = defer.Deferred()
+        kept_context: List[bool] = []
+
+        async def handler() -> Response:
+            return await make_deferred_yieldable(registration)
+
+        async def run(name: str) -> Tuple[Response, bool]:
+            with LoggingContext(name=name, server_name="matrix.local") as context:
+                result = await cache.run("key", handler)
+                kept_context.append(current_context() is context)
+                return result
+
+        first = defer.ensureDeferred(run("first"))
+        self.assertIs(current_context(), SENTINEL_CONTEXT)
+        duplicate = defer.ensureDeferred(run("duplicate"))
+        self.assertIs(current_context(), SENTINEL_CONTEXT)
+
+        registration.callback((201, {"userId": "@guest-1:matrix.local"}, {}))
+
+        self.assertIs(current_context(), SENTINEL_CONTEXT)
+        self.assertEqual(
+            await first, ((201, {"userId": "@guest-1:matrix.local"}, {}), False)
+        )
+        self.assertEqual(
+            await duplicate, ((201, {"userId": "@guest-1:matrix.local"}, {}), True)
+        )
+        self.assertEqual(kept_context, [True, True])
+
+    async def test_expire(self) -> None:
+        cache = IdempotencyCache(10, 60)
+
+        async def handler() -> Response:
+            return 201, {}, {}
+
+        with patch("time.monotonic", return_value=1000.0):
+            await cache.run("key", handler)
+
+        with patch("time.monotonic", return_value=1061.0):
+            _, replayed = await cache.run("key", handler)
+
+        self.assertFalse(replayed)
+
+    async def test_evict_least_recently_used(self) -> None:
+        cache = IdempotencyCache(2, 60)
+
+        async def handler() -> Response:
+            return 201, {}, {}
+
+        for key in ["a", "b", "a", "c"]:
+            await cache.run(key, handler)
+
+        self.assertEqual(len(cache), 2)
+        self.assertTrue((await cache.run("a", handler))[1])
+        self.assertFalse((await cache.run("b", handler))[1])
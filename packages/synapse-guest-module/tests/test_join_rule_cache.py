@@ -0,0 +1,70 @@
+# Copyright 2023 Nordeck IT + Consulting GmbH
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from unittest.mock import patch
+
+import aiounittest
+
+from synapse_guest_module.join_rule_cache import JoinRuleCache
+
+
+class JoinRuleCacheTest(aiounittest.AsyncTestCase):
+    def test_get_unknown(self) -> None:
+        cache = JoinRuleCache(10, 60)
+
+        self.assertIsNone(cache.get("!room:matrix.local"))
+
+    def test_set_and_get(self) -> None:
+        cache = JoinRuleCache(10, 60)
+
+        cache.set("!knock:matrix.local", "knock")
+        cache.set("!knock-restricted:matrix.local", "knock_restricted")
+        cache.set("!public:matrix.local", "public")
+
+        self.assertTrue(cache.get("!knock:matrix.local"))
+        self.assertTrue(cache.get("!knock-restricted:matrix.local"))
+        self.assertFalse(cache.get("!public:matrix.local"))
+
+    def test_evict_least_recently_used(self) -> None:
+        cache = JoinRuleCache(2, 60)
+
+        cache.set("!room-1:matrix.local", "knock")
+        cache.set("!room-2:matrix.local", "knock")
+        cache.get("!room-1:matrix.local")
+        cache.set("!room-3:matrix.local", "knock")
+
+        self.assertEqual(len(cache), 2)
+        self.assertTrue(cache.get("!room-1:matrix.local"))
+        self.assertIsNone(cache.get("!room-2:matrix.local"))
+        self.assertTrue(cache.get("!room-3:matrix.local"))
+
+    def test_expire_entries(self) -> None:
+        cache = JoinRuleCache(10, 60)
+
+        with patch("time.monotonic", return_value=1000.0):
+            cache.set("!room:matrix.local", "knock")
+
+        with patch("time.monotonic", return_value=1030.0):
+            self.assertTrue(cache.get("!room:matrix.local"))
+
+        with patch("time.monotonic", return_value=1061.0):
+            self.assertIsNone(cache.get("!room:matrix.local"))
+
+    def test_disabled(self) -> None:
+        cache = JoinRuleCache(0, 60)
+
+        cache.set("!room:matrix.local", "knock")
+
+        self.assertIsNone(cache.get("!room:matrix.local"))
+        self.assertFalse(cache.enabled)
@@ -0,0 +1,58 @@
+# Copyright 2023 Nordeck IT + Consulting GmbH
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import aiounittest
+
+from synapse_guest_module.joined_room_counter import JoinedRoomCounter
+
+
+class JoinedRoomCounterTest(aiounittest.AsyncTestCase):
+    def test_limit(self) -> None:
+        counter = JoinedRoomCounter(2, 10)
+
+        counter.load("@guest-1:matrix.local", ["!a:matrix.local"])
+        self.assertTrue(counter.may_join("@guest-1:matrix.local", "!b:matrix.local"))
+
+        counter.join("@guest-1:matrix.local", "!b:matrix.local")
+        self.assertFalse(counter.may_join("@guest-1:matrix.local", "!c:matrix.local"))
+
+        # rejoining a room doesn't count
+        self.assertTrue(counter.may_join("@guest-1:matrix.local", "!a:matrix.local"))
+
+        counter.leave("@guest-1:matrix.local", "!a:matrix.local")
+        self.assertTrue(counter.may_join("@guest-1:matrix.local", "!c:matrix.local"))
+
+    def test_ignore_unknown_users(self) -> None:
+        counter = JoinedRoomCounter(2, 10)
+
+        counter.join("@guest-1:matrix.local", "!a:matrix.local")
+        counter.leave("@guest-1:matrix.local", "!a:matrix.local")
+
+        self.assertFalse(counter.is_known("@guest-1:matrix.local"))
+        self.assertEqual(len(counter), 0)
+
+    def test_evict_least_recently_used(self) -> None:
+        counter = JoinedRoomCounter(2, 2)
+
+        counter.load("@guest-1:matrix.local", [])
+        counter.load("@guest-2:matrix.local", [])
+        counter.join("@guest-1:matrix.local", "!a:matrix.local")
+        counter.load("@guest-3:matrix.local", [])
+
+        self.assertTrue(counter.is_known("@guest-1:matrix.local"))
+        self.assertFalse(counter.is_known("@guest-2:matrix.local"))
+        self.assertTrue(counter.is_known("@guest-3:matrix.local"))
+
+    def test_disabled(self) -> None:
+        self.assertFalse(JoinedRoomCounter(0, 10).enabled)
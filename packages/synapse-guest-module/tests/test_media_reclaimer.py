@@ -0,0 +1,193 @@
+# Copyright 2023 Nordeck IT + Consulting GmbH
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import sqlite3
+
+import aiounittest
+
+from synapse_guest_module.media_reclaimer import GuestMedia
+from tests import create_module, make_awaitable
+
+
+def insert_media(conn: sqlite3.Connection) -> None:
+    conn.executemany(
+        "INSERT INTO local_media_repository VALUES (?, ?, ?, ?, ?)",
+        [
+            ["media-a", 100, "@guest-1:matrix.local", None, False],
+            ["media-b", 200, "@guest-1:matrix.local", None, False],
+            ["media-c", 300, "@guest-2:matrix.local", None, False],
+            ["media-d", 400, "@guest-2:matrix.local", "@admin:matrix.local", False],
+            ["media-e", 500, "@guest-2:matrix.local", None, True],
+            ["media-f", 600, "@guest-active:matrix.local", None, False],
+        ],
+    )
+
+
+class GuestMediaReclaimerTest(aiounittest.AsyncTestCase):
+    async def test_setup_adds_deactivated_guests(self) -> None:
+        module, _, store = create_module({"reaper_media_cleanup": "delete"})
+
+        await module.registry.setup()
+        store.conn.executemany(
+            "INSERT INTO guest_module_guests VALUES (?, ?, ?, ?)",
+            [
+                ["@guest-1:matrix.local", 0, 100, "deactivated"],
+                ["@guest-2:matrix.local", 0, 100, "active"],
+            ],
+        )
+
+        await module.reaper.media.setup()
+
+        self.assertEqual(
+            store.conn.execute(
+                "SELECT user_id FROM guest_module_media_cleanup"
+            ).fetchall(),
+            [("@guest-1:matrix.local",)],
+        )
+
+    async def test_get_media_paginated(self) -> None:
+        module, _, store = create_module({"reaper_media_cleanup": "delete"})
+
+        insert_media(store.conn)
+        await module.reaper.media.enqueue(
+            ["@guest-1:matrix.local", "@guest-2:matrix.local"]
+        )
+
+        first_page = await module.reaper.media.get_media(None, 2)
+        second_page = await module.reaper.media.get_media(
+            ("@guest-1:matrix.local", "media-b"), 2
+        )
+
+        self.assertEqual(
+            first_page,
+            [
+                GuestMedia("@guest-1:matrix.local", "media-a", 100),
+                GuestMedia("@guest-1:matrix.local", "media-b", 200),
+            ],
+        )
+        # media that is protected from quarantine is skipped
+        self.assertEqual(
+            second_page,
+            [
+                GuestMedia("@guest-2:matrix.local", "media-c", 300),
+                GuestMedia("@guest-2:matrix.local", "media-d", 400),
+            ],
+        )
+
+    async def test_get_media_skips_quarantined(self) -> None:
+        module, _, store = create_module({"reaper_media_cleanup": "quarantine"})
+
+        insert_media(store.conn)
+        await module.reaper.media.enqueue(["@guest-2:matrix.local"])
+
+        self.assertEqual(
+            await module.reaper.media.get_media(None, 10),
+            [GuestMedia("@guest-2:matrix.local", "media-c", 300)],
+        )
+
+    async def test_reclaim_delete(self) -> None:
+        module, module_api, _ = create_module({"reaper_media_cleanup": "delete"})
+
+        media_repository = module_api._hs.get_media_repository()
+        media_repository.delete_local_media_ids.return_value = make_awaitable(
+            (["media-a"], 1)
+        )
+
+        self.assertTrue(
+            await module.reaper.media.reclaim(
+                GuestMedia("@guest-1:matrix.local", "media-a", 100)
+            )
+        )
+        media_repository.delete_local_media_ids.assert_called_once_with(["media-a"])
+
+    async def test_reclaim_delete_without_media_store(self) -> None:
+        module, module_api, _ = create_module({"reaper_media_cleanup": "delete"})
+        module_api._hs.config.media.can_load_media_repo = False
+
+        self.assertFalse(module.reaper.media.can_reclaim)
+        with self.assertRaises(RuntimeError):
+            await module.reaper.media.reclaim(
+                GuestMedia("@guest-1:matrix.local", "media-a", 100)
+            )
+
+        # the files would stay on the disk of the media repository
+        module_api._hs.get_media_repository().delete_local_media_ids.assert_not_called()
+
+    async def test_reclaim_quarantine(self) -> None:
+        module, module_api, _ = create_module({"reaper_media_cleanup": "quarantine"})
+
+        store = module_api._hs.get_datastores().main
+        store.quarantine_media_by_id.return_value = make_awaitable(0)
+
+        self.assertFalse(
+            await module.reaper.media.reclaim(
+                GuestMedia("@guest-1:matrix.local", "media-a", 100)
+            )
+        )
+        store.quarantine_media_by_id.assert_called_once_with(
+            "matrix.local", "media-a", "@guest-reaper:matrix.local"
+        )
+
+    async def test_prune(self) -> None:
+        module, _, store = create_module({"reaper_media_cleanup": "quarantine"})
+
+        insert_media(store.conn)
+        await module.reaper.media.enqueue(
+            ["@guest-1:matrix.local", "@guest-2:matrix.local", "@guest-3:matrix.local"]
+        )
+        store.conn.execute(
+            "UPDATE local_media_repository SET quarantined_by = ? WHERE user_id = ?",
+            ("@guest-reaper:matrix.local", "@guest-2:matrix.local"),
+        )
+
+        self.assertEqual(await module.reaper.media.prune(), 2)
+        self.assertEqual(
+            store.conn.execute(
+                "SELECT user_id FROM guest_module_media_cleanup"
+            ).fetchall(),
+            [("@guest-1:matrix.local",)],
+        )
+
+    async def test_fail_and_park(self) -> None:
+        module, _, store = create_module(
+            {"reaper_media_cleanup": "delete", "reaper_max_attempts": 2}
+        )
+
+        insert_media(store.conn)
+        await module.reaper.media.enqueue(
+            ["@guest-1:matrix.local", "@guest-2:matrix.local"]
+        )
+
+        await module.reaper.media.fail(["@guest-1:matrix.local"])
+        self.assertEqual(
+            [m.media_id for m in await module.reaper.media.get_media(None, 10)],
+            ["media-a", "media-b", "media-c", "media-d"],
+        )
+
+        await module.reaper.media.fail(["@guest-1:matrix.local"])
+
+        # the media of the parked user is no longer retried
+        self.assertEqual(
+            store.conn.execute(
+                "SELECT * FROM guest_module_media_cleanup ORDER BY user_id"
+            ).fetchall(),
+            [
+                ("@guest-1:matrix.local", 2, "parked"),
+                ("@guest-2:matrix.local", 0, "pending"),
+            ],
+        )
+        self.assertEqual(
+            [m.media_id for m in await module.reaper.media.get_media(None, 10)],
+            ["media-c", "media-d"],
+        )
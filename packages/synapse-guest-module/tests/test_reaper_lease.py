@@ -0,0 +1,62 @@
+# Copyright 2023 Nordeck IT + Consulting GmbH
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+import time
+
+import aiounittest
+
+from synapse_guest_module.reaper_lease import ReaperLease
+from tests import create_module
+
+
+class ReaperLeaseTest(aiounittest.AsyncTestCase):
+    async def test_acquire_free(self) -> None:
+        module, _, store = create_module()
+
+        self.assertTrue(await module.reaper.lease.acquire())
+
+        (holder, expires_ts) = store.conn.execute(
+            "SELECT holder, expires_ts FROM guest_module_reaper_lease"
+        ).fetchone()
+        self.assertEqual(holder, "master")
+        self.assertGreater(expires_ts, int(time.time() * 1000) + 50 * 1000)
+
+    async def test_acquire_held_by_other_worker(self) -> None:
+        module, module_api, _ = create_module()
+
+        self.assertTrue(await module.reaper.lease.acquire())
+
+        module_api.worker_name = "worker1"
+        other_lease = ReaperLease(module_api, module.registry._config, module.registry)
+
+        self.assertFalse(await other_lease.acquire())
+
+        # the holder renews its lease
+        self.assertTrue(await module.reaper.lease.acquire())
+
+    async def test_acquire_takeover_expired(self) -> None:
+        module, module_api, store = create_module()
+
+        await module.registry.setup()
+        store.conn.execute(
+            "INSERT INTO guest_module_reaper_lease VALUES ('reaper', 'worker1', 1000)"
+        )
+
+        self.assertTrue(await module.reaper.lease.acquire())
+
+        (holder,) = store.conn.execute(
+            "SELECT holder FROM guest_module_reaper_lease"
+        ).fetchone()
+        self.assertEqual(holder, "master")
@@ -0,0 +1,101 @@
+# Copyright 2023 Nordeck IT + Consulting GmbH
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+from unittest.mock import patch
+
+import aiounittest
+
+from synapse_guest_module.throughput import RatePacer, RoomLeaveLimiter
+from tests import create_module, make_awaitable
+
+
+class RatePacerTest(aiounittest.AsyncTestCase):
+    async def test_disabled(self) -> None:
+        _, module_api, _ = create_module()
+        pacer = RatePacer(module_api, 0)
+
+        for _ in range(10):
+            await pacer.wait()
+
+        module_api.sleep.assert_not_called()
+
+    async def test_spread_calls(self) -> None:
+        _, module_api, _ = create_module()
+        module_api.sleep.return_value = make_awaitable(None)
+        pacer = RatePacer(module_api, 4)
+
+        with patch("time.monotonic", return_value=1000.0):
+            for _ in range(3):
+                await pacer.wait()
+
+        self.assertEqual(
+            [c.args[0] for c in module_api.sleep.call_args_list], [0.25, 0.5]
+        )
+
+    async def test_spread_batches(self) -> None:
+        _, module_api, _ = create_module()
+        module_api.sleep.return_value = make_awaitable(None)
+        pacer = RatePacer(module_api, 4)
+
+        with patch("time.monotonic", return_value=1000.0):
+            await pacer.wait(10)
+            await pacer.wait(2)
+            await pacer.wait()
+
+        self.assertEqual(
+            [c.args[0] for c in module_api.sleep.call_args_list], [2.5, 3.0]
+        )
+
+
+class RoomLeaveLimiterTest(aiounittest.AsyncTestCase):
+    def test_disabled(self) -> None:
+        limiter = RoomLeaveLimiter(0, 60)
+
+        for _ in range(10):
+            self.assertEqual(limiter.acquire(["!room:matrix.local"]), 0)
+
+        self.assertFalse(limiter.enabled)
+
+    def test_limit_per_window(self) -> None:
+        limiter = RoomLeaveLimiter(2, 60)
+
+        with patch("time.monotonic", return_value=1000.0):
+            self.assertEqual(limiter.acquire(["!a:matrix.local"]), 0)
+
+        with patch("time.monotonic", return_value=1010.0):
+            self.assertEqual(limiter.acquire(["!a:matrix.local", "!b:matrix.local"]), 0)
+
+            # the limit of room a is reached, so nothing is recorded for room b
+            self.assertEqual(
+                limiter.acquire(["!b:matrix.local", "!a:matrix.local"]), 50
+            )
+            self.assertEqual(limiter.acquire(["!b:matrix.local"]), 0)
+
+        with patch("time.monotonic", return_value=1060.0):
+            self.assertEqual(limiter.acquire(["!a:matrix.local"]), 0)
+
+    def test_prune(self) -> None:
+        limiter = RoomLeaveLimiter(2, 60)
+
+        with patch("time.monotonic", return_value=1000.0):
+            limiter.acquire(["!a:matrix.local"])
+
+        with patch("time.monotonic", return_value=1030.0):
+            limiter.acquire(["!b:matrix.local"])
+
+        with patch("time.monotonic", return_value=1070.0):
+            limiter.prune()
+
+        self.assertEqual(len(limiter), 1)
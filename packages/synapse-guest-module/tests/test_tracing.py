@@ -0,0 +1,94 @@
+# Copyright 2023 Nordeck IT + Consulting GmbH
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+from unittest.mock import patch
+
+import aiounittest
+
+from synapse_guest_module.tracing import CallTracer, set_tag
+
+LOGGER = "synapse.contrib.synapse_guest_module.tracing"
+
+
+class CallTracerTest(aiounittest.AsyncTestCase):
+    def test_span(self) -> None:
+        tracer = CallTracer(0)
+
+        with patch(
+            "synapse_guest_module.tracing.opentracing.start_active_span"
+        ) as start_active_span, patch(
+            "synapse_guest_module.tracing.opentracing.set_tag"
+        ) as opentracing_set_tag:
+            with tracer.span("my_call", room_id="!room:matrix.local"):
+                set_tag("guest", True)
+
+        start_active_span.assert_called_once_with("guest_module.my_call")
+        self.assertEqual(
+            [c.args for c in opentracing_set_tag.call_args_list],
+            [("room_id", "!room:matrix.local"), ("guest", True)],
+        )
+
+    def test_slow_call_log(self) -> None:
+        tracer = CallTracer(100)
+
+        with patch("time.perf_counter", side_effect=[10.0, 10.25]):
+            with self.assertLogs(LOGGER, "WARNING") as logs:
+                with tracer.span("my_call", room_id="!room:matrix.local"):
+                    set_tag("guest", True)
+
+        self.assertEqual(
+            logs.output,
+            [
+                f"WARNING:{LOGGER}:Slow call my_call took 250.0 ms "
+                "room_id=!room:matrix.local guest=True"
+            ],
+        )
+
+    def test_slow_call_log_nested(self) -> None:
+        tracer = CallTracer(100)
+
+        with patch("time.perf_counter", side_effect=[10.0, 10.5, 10.75, 11.0]):
+            with self.assertLogs(LOGGER, "WARNING") as logs:
+                with tracer.span("outer"):
+                    with tracer.span("inner"):
+                        set_tag("step", "inner")
+                    set_tag("step", "outer")
+
+        self.assertEqual(
+            logs.output,
+            [
+                f"WARNING:{LOGGER}:Slow call inner took 250.0 ms step=inner",
+                f"WARNING:{LOGGER}:Slow call outer took 1000.0 ms step=outer",
+            ],
+        )
+
+    def test_fast_call(self) -> None:
+        tracer = CallTracer(100)
+
+        with patch("time.perf_counter", side_effect=[10.0, 10.05]):
+            with self.assertNoLogs(LOGGER, "WARNING"):
+                with tracer.span("my_call"):
+                    pass
+
+    def test_slow_call_log_disabled(self) -> None:
+        tracer = CallTracer(0)
+
+        with patch("time.perf_counter", side_effect=[10.0, 20.0, 30.0, 40.0]):
+            with self.assertNoLogs(LOGGER, "WARNING"):
+                with tracer.span("my_call"):
+                    pass
+
+                with CallTracer(100).span("my_group", log_slow=False):
+                    pass